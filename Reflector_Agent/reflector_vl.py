@@ -15,16 +15,12 @@ sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'Server
 from Reflector_Agent.base import AgentMemoryVL, Reflection
 from Reflector_Agent.reflector_prompt import DEFAULT_PERSONA_FORMAT_TEMPLATE, DEFAULT_REFLECTOR_SYSTEM_PROMPT_VL
 from utils.utils import query, log
-
-from openai import OpenAI
+from utils.llm_client import get_client, model_slot
 
 # 设置日志
 logger = logging.getLogger(__name__)
 
-client = OpenAI(
-    api_key="sk-c2cc873160714661aa76b6d5ab7239bf",
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-)
+REFLECTOR_VL_MODEL = "qwen3-vl-plus"
 
 # 编码函数：将本地文件转换为 Base64 编码的字符串
 def encode_image(image_path):
@@ -80,30 +76,31 @@ class ReflectorVL:
         user_content = "\n\n".join(content_sections)
 
         # 创建聊天完成请求
-        completion = client.chat.completions.create(
-            model="qwen3-vl-plus",
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt_content
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                        },
-                        {"type": "text", "text": user_content},
-                    ],
+        with model_slot(REFLECTOR_VL_MODEL):
+            completion = get_client().chat.completions.create(
+                model=REFLECTOR_VL_MODEL,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": system_prompt_content
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                            },
+                            {"type": "text", "text": user_content},
+                        ],
+                    },
+                ],
+                stream=False,
+                extra_body={
+                    'enable_thinking': False,
+                    "thinking_budget": 500,
                 },
-            ],
-            stream=False,
-            extra_body={
-                'enable_thinking': False,
-                "thinking_budget": 500,
-            },
-        )
+            )
 
         # 收集完整回复内容
         answer_content = ""
@@ -1,10 +1,18 @@
 import os
 
 from agents.prompts import action_summarize_prompt
-from utils.utils import query
+from utils.rate_limiter import BACKGROUND
+from utils.utils import aquery, query
 
 
 def summarize_actions(action_history: list):
     prompts = action_summarize_prompt.get_prompts(action_history)
-    response = query(prompts, model=os.getenv("ACTION_SUMMARIZE_AGENT_GPT_VERSION"))
-    return response
\ No newline at end of file
+    # 动作总结只用于后续提示词中的历史，排队时让位于 select / derive
+    response = query(prompts, model=os.getenv("ACTION_SUMMARIZE_AGENT_GPT_VERSION"), priority=BACKGROUND)
+    return response
+
+
+async def asummarize_actions(action_history: list):
+    prompts = action_summarize_prompt.get_prompts(action_history)
+    response = await aquery(prompts, model=os.getenv("ACTION_SUMMARIZE_AGENT_GPT_VERSION"), priority=BACKGROUND)
+    return response
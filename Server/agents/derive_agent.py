@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from copy import deepcopy
@@ -5,7 +6,10 @@ from copy import deepcopy
 from agents import action_summarize_agent
 from agents.prompts import derive_agent_prompt
 from memory.memory_manager import Memory
-from utils.utils import query, log, parse_completion_rate
+from utils.llm_cache import canonical_screen
+from utils.rate_limiter import INTERACTIVE
+from env_config import Config
+from utils.utils import aquery, query, query_streaming, log, parse_completion_rate
 from utils import action_utils, parsing_utils
 
 
@@ -17,13 +21,53 @@ class DeriveAgent:
         self.subtask_history = []
         self.action_history = []
         self.response_history = []
+        # 推测预取：(提示词键, Future)，仅当 derive 实际使用的提示词与之完全一致时才采用
+        self._prefetched = None
+        # 流式 derive 尚在后台接收的输出：(完整结果 Future, 已返回的响应, 示例)
+        self._streaming = None
 
     def init_subtask(self, subtask: dict, subtask_history: list) -> None:
+        self.__settle_stream()
         self.subtask = subtask
         self.subtask_history = subtask_history
         self.action_history = []
 
     def derive(self, screen: str, action_failed=False, suggestions=None, examples=None) -> (dict, dict):
+        derive_prompt, cache_key = self.__prepare(screen, action_failed, suggestions, examples)
+        future = self.__take_prefetched(derive_prompt)
+        response = self.__prefetched_result(future) if future is not None else None
+        if response is None and Config.LLM_STREAM_DERIVE:
+            # 流式：action 解析完成即返回给客户端执行，reasoning / plan 在后台接收，下一次使用历史前补全
+            response, full = query_streaming(derive_prompt, model=os.getenv("DERIVE_AGENT_GPT_VERSION"),
+                                             cache_key=cache_key, priority=INTERACTIVE)
+            action, example = self.__handle_response(response, screen, partial=True)
+            self._streaming = (full, self.response_history[-1], example)
+            return action, example
+        if response is None:
+            response = query(derive_prompt, model=os.getenv("DERIVE_AGENT_GPT_VERSION"), cache_key=cache_key,
+                             priority=INTERACTIVE)
+        return self.__handle_response(response, screen)
+
+    async def aderive(self, screen: str, action_failed=False, suggestions=None, examples=None) -> (dict, dict):
+        """derive 的协程版本"""
+        derive_prompt, cache_key = self.__prepare(screen, action_failed, suggestions, examples)
+        future = self.__take_prefetched(derive_prompt)
+        response = None
+        if future is not None:
+            try:
+                response = await asyncio.wrap_future(future)
+            except Exception as e:
+                log(f"derive 推测预取失败，改为直接请求: {e}", "yellow")
+            else:
+                log("derive 推测预取命中", "green")
+        if response is None:
+            response = await aquery(derive_prompt, model=os.getenv("DERIVE_AGENT_GPT_VERSION"), cache_key=cache_key,
+                                    priority=INTERACTIVE)
+        return self.__handle_response(response, screen)
+
+    def __prepare(self, screen: str, action_failed: bool, suggestions, examples) -> (list, tuple):
+        """返回 (提示词, LLM 缓存键)"""
+        self.__settle_stream()
         if examples is None:
             examples = []
         if suggestions is None:
@@ -34,14 +78,12 @@ class DeriveAgent:
                 self.action_history.pop()
             if len(self.response_history) > 0:
                 self.response_history.pop()
-            derive_prompt = derive_agent_prompt.get_prompts(self.instruction, self.subtask,
-                                                            self.subtask_history + self.action_history, screen,
-                                                            examples, suggestions)
         else:
             # 统一传入 suggestions 以兼容新签名
-            derive_prompt = derive_agent_prompt.get_prompts(self.instruction, self.subtask,
-                                                            self.subtask_history + self.action_history, screen,
-                                                            examples, [])
+            suggestions = []
+        history = self.subtask_history + self.action_history
+        derive_prompt = derive_agent_prompt.get_prompts(self.instruction, self.subtask, history, screen,
+                                                        examples, suggestions)
         # 生成大模型的提示词（整合所有推导依据）
         # derive_agent_prompt.get_prompts：传入用户指令、当前子任务、历史记录、界面信息、示例，生成结构化提示词
         # 提示词内容示例："用户要'发消息'，当前子任务是'点击发送'，历史已执行'输入文本'，界面有'发送按钮'，请生成点击坐标"
@@ -54,10 +96,35 @@ class DeriveAgent:
         #         log(f"      完整内容:\n{content}", "cyan")
         #     log("", "cyan")  # 空行分隔
         
-        response = query(derive_prompt, model=os.getenv("DERIVE_AGENT_GPT_VERSION"))
+        return derive_prompt, self.__cache_key(self.subtask, history, screen, examples, suggestions)
+
+    def __handle_response(self, response, screen: str, partial=False) -> (dict, dict):
         log(f"derive_agent收到AI响应: {response}", "blue")
         log(f"derive_agent收到AI响应类型: {type(response)}", "blue")
-        
+        response = self.__normalize(response, partial)
+        self.response_history.append(response)
+
+        history = "your past response: " + json.dumps(response) + " has been executed successfully."
+        self.action_history.append(history)
+        # 生成当前动作的示例（含指令、子任务、界面、响应，供后续复用）
+        example = self.__exemplify(response, screen)
+        # 返回推导的具体动作和示例
+        return response['action'], example
+
+        # Save in real time.
+        # self.__generalize_and_save_action(response, screen)
+
+        # generalized_action = self.__generalize_action(response, screen)
+        #
+        # return response['action'], generalized_action
+
+    # 这部分是注释掉的未启用功能，核心是 “动作泛化与实时保存”：
+    # self.__generalize_action(response, screen)：将本次推导的具体动作（如 “点击# x = 550, y = 850”）泛化为 “通用动作模板”（如 “点击‘发送’按钮的中心坐标”），便于跨界面复用（如不同手机分辨率下自动适配坐标）；
+    # self.__generalize_and_save_action(response, screen)：将泛化后的动作模板实时保存到 “动作知识库”（如# memory / < 应用 > / actions.csv），实现长期复用；
+
+    @staticmethod
+    def __normalize(response, partial=False) -> dict:
+        """补齐缺失字段；partial 为流式提前返回的部分响应（其余字段尚在接收，缺失时不告警）"""
         # 检查响应是否为有效字典
         if not isinstance(response, dict):
             log(f"❌ derive_agent返回无效响应格式: {type(response)}", "red")
@@ -79,7 +146,8 @@ class DeriveAgent:
         else:
             # 如果没有completion_rate字段，设置默认值
             response['completion_rate'] = 0
-            log(f"⚠️ derive_agent返回缺少completion_rate字段，设置默认值0", "yellow")
+            if not partial:
+                log(f"⚠️ derive_agent返回缺少completion_rate字段，设置默认值0", "yellow")
         
         # 确保必要的字段存在
         if 'action' not in response:
@@ -91,28 +159,76 @@ class DeriveAgent:
         
         if 'plan' not in response:
             response['plan'] = "AI未提供下一步计划"
-        
-        self.response_history.append(response)
+        return response
 
-        history = "your past response: " + json.dumps(response) + " has been executed successfully."
-        self.action_history.append(history)
-        # 生成当前动作的示例（含指令、子任务、界面、响应，供后续复用）
-        example = self.__exemplify(response, screen)
-        # 返回推导的具体动作和示例
-        return response['action'], example
+    def __settle_stream(self) -> None:
+        """等待上一次流式 derive 接收完毕，用完整输出补全历史与示例（动作保持已执行的那个）"""
+        if self._streaming is None:
+            return
+        full, response, example = self._streaming
+        self._streaming = None
+        try:
+            result = full.result(timeout=Config.LLM_TIMEOUT)
+        except Exception as e:
+            log(f"derive 流式输出未完整接收，历史中保留已解析的字段: {e}", "yellow")
+            return
+        if not isinstance(result, dict):
+            return
+        response.update({key: value for key, value in result.items() if key != 'action'})
+        self.__normalize(response)
+        # 响应仍在历史末尾（期间没有因动作失败被移除）时改写对应的历史
+        if self.response_history and self.response_history[-1] is response and self.action_history:
+            self.action_history[-1] = "your past response: " + json.dumps(response) + " has been executed successfully."
+        if example:
+            example['response'] = json.dumps(response)
 
-        # Save in real time.
-        # self.__generalize_and_save_action(response, screen)
 
-        # generalized_action = self.__generalize_action(response, screen)
-        #
-        # return response['action'], generalized_action
 
-    # 这部分是注释掉的未启用功能，核心是 “动作泛化与实时保存”：
-    # self.__generalize_action(response, screen)：将本次推导的具体动作（如 “点击# x = 550, y = 850”）泛化为 “通用动作模板”（如 “点击‘发送’按钮的中心坐标”），便于跨界面复用（如不同手机分辨率下自动适配坐标）；
-    # self.__generalize_and_save_action(response, screen)：将泛化后的动作模板实时保存到 “动作知识库”（如# memory / < 应用 > / actions.csv），实现长期复用；
+    def prefetch(self, subtask: dict, subtask_history: list, screen: str, executor) -> None:
+        """
+        推测执行：在 SelectAgent 仍在运行时，按预测的子任务提前发起 derive 请求（无示例、无建议的学习模式提示词）。
+        预测错误时结果被丢弃，不影响最终动作。
+        """
+        self.discard_prefetch()
+        derive_prompt = derive_agent_prompt.get_prompts(self.instruction, subtask, list(subtask_history), screen, [], [])
+        future = executor.submit(query, derive_prompt, model=os.getenv("DERIVE_AGENT_GPT_VERSION"),
+                                 cache_key=self.__cache_key(subtask, list(subtask_history), screen, [], []))
+        self._prefetched = (self.__prompt_key(derive_prompt), future)
+
+    def __cache_key(self, subtask: dict, history: list, screen: str, examples: list, suggestions: list) -> tuple:
+        """LLM 缓存的语义键：子任务 + 规范化界面（去掉每次运行都不同的 view id）+ 历史/示例/建议"""
+        return ("derive", self.instruction, subtask, history, canonical_screen(screen), examples, suggestions)
+
+    def discard_prefetch(self) -> None:
+        if self._prefetched is not None:
+            self._prefetched[1].cancel()
+            self._prefetched = None
 
+    def __take_prefetched(self, derive_prompt: list):
+        """取出与本次提示词一致的预取 Future（不一致时丢弃）"""
+        if self._prefetched is None:
+            return None
+        key, future = self._prefetched
+        self._prefetched = None
+        if key != self.__prompt_key(derive_prompt):
+            future.cancel()
+            log("derive 推测预取未命中，已丢弃", "yellow")
+            return None
+        return future
 
+    @staticmethod
+    def __prefetched_result(future):
+        try:
+            response = future.result()
+        except Exception as e:
+            log(f"derive 推测预取失败，改为同步请求: {e}", "yellow")
+            return None
+        log("derive 推测预取命中", "green")
+        return response
+
+    @staticmethod
+    def __prompt_key(derive_prompt: list) -> str:
+        return json.dumps(derive_prompt, sort_keys=True, ensure_ascii=False)
 
     def add_finish_action(self) -> None:
         finish_action = {
@@ -122,12 +238,22 @@ class DeriveAgent:
         self.memory.save_action(self.subtask['name'], finish_action, example=None)
 
     def summarize_actions(self) -> str:
+        self.__settle_stream()
         if len(self.response_history) > 0:
             action_summary = action_summarize_agent.summarize_actions(self.response_history)
             self.action_history = []
             self.response_history = []
             return action_summary
 
+    async def asummarize_actions(self) -> str:
+        """summarize_actions 的协程版本"""
+        self.__settle_stream()
+        if len(self.response_history) > 0:
+            action_summary = await action_summarize_agent.asummarize_actions(self.response_history)
+            self.action_history = []
+            self.response_history = []
+            return action_summary
+
     def __exemplify(self, response: dict, screen: str) -> dict:
         action = response['action']
         example = {}
@@ -1,10 +1,11 @@
+import asyncio
 import json
 import os
 
 from agents.prompts import explore_agent_prompt
 from memory.memory_manager import Memory
 from utils.parsing_utils import get_trigger_ui_attributes, get_extra_ui_attributes
-from utils.utils import query, log
+from utils.utils import aquery, query, log
 
 import xml.etree.ElementTree as ET
 
@@ -24,6 +25,16 @@ class ExploreAgent:
         prompts = explore_agent_prompt.get_prompts(html_xml)
         # 使用指定的大语言模型（版本由环境变量EXPLORE_AGENT_GPT_VERSION设定），生成当前屏幕可执行的子任务列表（subtasks_raw）
         subtasks_raw = query(prompts, model=os.getenv("EXPLORE_AGENT_GPT_VERSION"), is_list=True)
+        return self.__add_node(subtasks_raw, parsed_xml, hierarchy_xml, screen_num)
+
+    async def aexplore(self, parsed_xml, hierarchy_xml, html_xml, screen_num=None) -> int:
+        """explore 的协程版本；写入记忆（含嵌入计算与数据库写入）在线程池中执行"""
+        log(":::EXPLORE:::", "blue")
+        prompts = explore_agent_prompt.get_prompts(html_xml)
+        subtasks_raw = await aquery(prompts, model=os.getenv("EXPLORE_AGENT_GPT_VERSION"), is_list=True)
+        return await asyncio.to_thread(self.__add_node, subtasks_raw, parsed_xml, hierarchy_xml, screen_num)
+
+    def __add_node(self, subtasks_raw, parsed_xml, hierarchy_xml, screen_num) -> int:
         # 遍历原始子任务列表，确保每个子任务都包含必要字段
         for subtask in subtasks_raw:
             if "parameters" not in subtask:
@@ -1,7 +1,7 @@
 import os
 
 from agents.prompts import param_fill_agent_prompt
-from utils.utils import query, log
+from utils.utils import aquery, query, log
 
 
 def parm_fill_subtask(instruction: str, subtask: dict, qa_history: list, screen: str, example: dict):
@@ -11,3 +11,12 @@ def parm_fill_subtask(instruction: str, subtask: dict, qa_history: list, screen:
     else:
         response = query(prompts, model="gpt-4o")
     return response
+
+
+async def aparm_fill_subtask(instruction: str, subtask: dict, qa_history: list, screen: str, example: dict):
+    prompts = param_fill_agent_prompt.get_prompts(instruction, subtask, qa_history, screen, example)
+    if len(example) > 0:
+        response = await aquery(prompts, model=os.getenv("PARAMETER_FILLER_AGENT_GPT_VERSION"))
+    else:
+        response = await aquery(prompts, model="gpt-4o")
+    return response
@@ -3,16 +3,68 @@ import os
 
 from agents.prompts import select_agent_prompt
 from memory.memory_manager import Memory
-from utils.utils import query, log, parse_completion_rate
+from utils.llm_cache import canonical_screen
+from utils.rate_limiter import INTERACTIVE
+from utils.utils import aquery, query, log, parse_completion_rate
 
 
 class SelectAgent:
+    # 响应无效时追加给 LLM 的错误提示
+    MISSING_ACTION_ERROR = "Error: Response missing 'action' key. Always include 'action'. If you propose a new action, also include 'new_action' and duplicate it to 'action'."
+    INVALID_ACTION_ERROR = "Error: The selected action is not in the available actions list. You may propose 'new_action', but you must also include it as 'action'."
+
     def __init__(self, memory: Memory, instruction: str):
         self.memory = memory
         self.instruction = instruction
 
     def select(self, available_subtasks: list, subtask_history: list, qa_history: list, screen: str, subtask_failed=False, suggestions=None) -> (dict, dict):
         log(f":::SELECT:::", "blue")
+        select_prompts, cache_key = self.__prepare(available_subtasks, subtask_history, qa_history, screen,
+                                                   subtask_failed, suggestions)
+        response = query(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"), cache_key=cache_key,
+                         priority=INTERACTIVE)
+        response = self.__normalize(response)
+
+        # 若仍然缺action，进行一次带错误提示的重试
+        if 'action' not in response:
+            log(f"Response missing 'action' key. Response: {response}", "red")
+            self.__append_error(select_prompts, response, self.MISSING_ACTION_ERROR)
+            response = self.__map_new_action(query(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"),
+                                                   priority=INTERACTIVE))
+
+        # 循环验证响应：若LLM选择的子任务无效（不在可执行列表且未新增），则重新提问修正
+        while not self.__check_response_validity(response, available_subtasks):
+            self.__append_error(select_prompts, response, self.INVALID_ACTION_ERROR)
+            # 重新调用LLM，获取修正后的响应
+            response = self.__map_new_action(query(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"),
+                                                   priority=INTERACTIVE))
+
+        return self.__finish(response, available_subtasks, screen)
+
+    async def aselect(self, available_subtasks: list, subtask_history: list, qa_history: list, screen: str, subtask_failed=False, suggestions=None) -> (dict, dict):
+        """select 的协程版本"""
+        log(":::SELECT:::", "blue")
+        select_prompts, cache_key = self.__prepare(available_subtasks, subtask_history, qa_history, screen,
+                                                   subtask_failed, suggestions)
+        response = await aquery(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"), cache_key=cache_key,
+                                priority=INTERACTIVE)
+        response = self.__normalize(response)
+
+        if 'action' not in response:
+            log(f"Response missing 'action' key. Response: {response}", "red")
+            self.__append_error(select_prompts, response, self.MISSING_ACTION_ERROR)
+            response = self.__map_new_action(await aquery(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"),
+                                                          priority=INTERACTIVE))
+
+        while not self.__check_response_validity(response, available_subtasks):
+            self.__append_error(select_prompts, response, self.INVALID_ACTION_ERROR)
+            response = self.__map_new_action(await aquery(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"),
+                                                          priority=INTERACTIVE))
+
+        return self.__finish(response, available_subtasks, screen)
+
+    def __prepare(self, available_subtasks, subtask_history, qa_history, screen, subtask_failed, suggestions) -> (list, tuple):
+        """返回 (提示词, LLM 缓存键)"""
         # 用户原始指令（子任务选择的目标依据）
         # 当前可执行子任务列表（LLM只能从这里选，或新增）
         # 子任务历史（避免重复选择已完成的子任务）
@@ -21,16 +73,18 @@ class SelectAgent:
         if suggestions is None:
             suggestions = []
 
-        if subtask_failed:
-            select_prompts = select_agent_prompt.get_prompts(self.instruction, available_subtasks, subtask_history,
-                                                             qa_history, screen, suggestions)
-        else:
+        if not subtask_failed:
             # 一些版本的 get_prompts 要求显式提供 suggestions 参数
-            select_prompts = select_agent_prompt.get_prompts(self.instruction, available_subtasks, subtask_history,
-                                                             qa_history, screen, [])
+            suggestions = []
+        select_prompts = select_agent_prompt.get_prompts(self.instruction, available_subtasks, subtask_history,
+                                                         qa_history, screen, suggestions)
 
-        response = query(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"))
-        
+        # LLM 缓存的语义键：可选子任务 + 历史 + 规范化界面（去掉每次运行都不同的 view id）
+        cache_key = ("select", self.instruction, available_subtasks, subtask_history, qa_history,
+                     canonical_screen(screen), suggestions)
+        return select_prompts, cache_key
+
+    def __normalize(self, response):
         # Check if response is valid JSON
         if not isinstance(response, dict):
             log(f"Invalid JSON response from LLM: {response}", "red")
@@ -47,35 +101,24 @@ class SelectAgent:
                         "speak": "I encountered an error and will finish the task."
                     }
         # 规范化响应：若缺action但有new_action，则将new_action映射为action（保留new_action用于回写）
-        if 'action' not in response and 'new_action' in response:
+        if isinstance(response, dict) and 'action' not in response and 'new_action' in response:
             log("Response missing 'action', mapping from 'new_action'", "yellow")
             response['action'] = response['new_action']
+        return response
 
-        # 若仍然缺action，进行一次带错误提示的重试
-        if 'action' not in response:
-            log(f"Response missing 'action' key. Response: {response}", "red")
-            assistant_message = {"role": "assistant", "content": json.dumps(response)}
-            select_prompts.append(assistant_message)
-            error_message = {"role": "user", "content": "Error: Response missing 'action' key. Always include 'action'. If you propose a new action, also include 'new_action' and duplicate it to 'action'."}
-            select_prompts.append(error_message)
-            response = query(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"))
-            # 二次兜底
-            if isinstance(response, dict) and 'action' not in response and 'new_action' in response:
-                response['action'] = response['new_action']
+    @staticmethod
+    def __map_new_action(response):
+        if isinstance(response, dict) and 'action' not in response and 'new_action' in response:
+            response['action'] = response['new_action']
+        return response
 
-        # 循环验证响应：若LLM选择的子任务无效（不在可执行列表且未新增），则重新提问修正
-        while not self.__check_response_validity(response, available_subtasks):
-            # 1. 将之前的无效响应作为“助手消息”加入提示词（让LLM知道自己之前错了）
-            assistant_msg = {"role": "assistant", "content": json.dumps(response)}
-            select_prompts.append(assistant_msg)
-            # 2. 加入“错误提示消息”，明确告知LLM错误原因（选择的子任务不在列表中）
-            error_msg = {"role": "user", "content": "Error: The selected action is not in the available actions list. You may propose 'new_action', but you must also include it as 'action'."}
-            select_prompts.append(error_msg)
-            # 3. 重新调用LLM，获取修正后的响应
-            response = query(select_prompts, model=os.getenv("SELECT_AGENT_GPT_VERSION"))
-            if isinstance(response, dict) and 'action' not in response and 'new_action' in response:
-                response['action'] = response['new_action']
+    @staticmethod
+    def __append_error(select_prompts: list, response, error: str) -> None:
+        # 将之前的无效响应作为“助手消息”加入提示词（让LLM知道自己之前错了），再加入错误提示消息
+        select_prompts.append({"role": "assistant", "content": json.dumps(response)})
+        select_prompts.append({"role": "user", "content": error})
 
+    def __finish(self, response: dict, available_subtasks: list, screen: str) -> (dict, dict):
         next_subtask_filled = response['action']
         for subtask in available_subtasks:
             if subtask['name'] == next_subtask_filled['name']:
@@ -4,7 +4,7 @@ import os
 import pandas as pd
 
 from agents.prompts import task_agent_prompt
-from utils.utils import query, log
+from utils.utils import aquery, query, log
 from utils.mongo_utils import load_dataframe, save_dataframe
 # task_agent.py 就是 MobileGPT 的“任务翻译机”：
 # 把用户的自然语言指令（如“帮我把这张发票发到微信群里”）翻译成结构化的任务 API（任务名、描述、所需参数、目标 App），
@@ -19,6 +19,20 @@ class TaskAgent:
         self._cache_dirty = False  # 缓存脏标记
 
     def get_task(self, instruction) -> (dict, bool):
+        known_tasks = self.__known_tasks()
+        # 调用提示词模板生成查询，调用大模型
+        response = query(messages=task_agent_prompt.get_prompts(instruction, known_tasks),
+                         model=os.getenv("TASK_AGENT_GPT_VERSION"))
+        return self.__handle_response(response)
+
+    async def aget_task(self, instruction) -> (dict, bool):
+        """get_task 的协程版本"""
+        known_tasks = self.__known_tasks()
+        response = await aquery(messages=task_agent_prompt.get_prompts(instruction, known_tasks),
+                                model=os.getenv("TASK_AGENT_GPT_VERSION"))
+        return self.__handle_response(response)
+
+    def __known_tasks(self) -> list:
         # 如果缓存脏了，重新加载数据
         if self._cache_dirty:
             self.database = load_dataframe(self.collection, ['name', 'description', 'parameters'], use_cache=False)
@@ -26,11 +40,9 @@ class TaskAgent:
         
         known_tasks = self.database.to_dict(orient='records') # 读取已知任务列表
         log(f"📋 任务匹配检查: 已知任务数量={len(known_tasks)}", "blue")
-        
-        # 调用提示词模板生成查询，调用大模型
-        response = query(messages=task_agent_prompt.get_prompts(instruction, known_tasks),
-                         model=os.getenv("TASK_AGENT_GPT_VERSION"))
+        return known_tasks
 
+    def __handle_response(self, response: dict) -> (dict, bool):
         task = response["api"]
         is_new = True # 默认标记为新任务
         
@@ -4,6 +4,7 @@
 """
 
 import asyncio
+import contextvars
 import threading
 import time
 import queue
@@ -16,6 +17,7 @@ import json
 
 from log_config import log
 from session_manager import SessionManager, ClientSession
+from utils.write_behind import write_behind
 
 
 class ProcessingTask:
@@ -199,8 +201,9 @@ class AsyncProcessor:
         try:
             log(f"开始处理任务: {task.task_id}", "blue")
             
-            # 根据任务类型选择处理方法
-            result = self._execute_task(task)
+            # 根据任务类型选择处理方法；任务内登记的写后持久化归属于其会话
+            with write_behind.owner(task.session_id):
+                result = self._execute_task(task)
             
             # 存储结果
             self.completed_tasks[task.task_id] = result
@@ -286,7 +289,7 @@ class AsyncProcessor:
                         result_container['error'] = e
                 
                 # 启动任务线程
-                worker_thread = threading.Thread(target=task_worker, daemon=True)
+                worker_thread = threading.Thread(target=contextvars.copy_context().run, args=(task_worker,), daemon=True)
                 worker_thread.start()
                 
                 # 等待30秒或直到完成
@@ -412,16 +415,8 @@ class AsyncProcessor:
 
             if db_available:
                 # 仅解析到内存并写 Mongo 临时集合
-                from screenParser import parseXML
-                import xml.etree.ElementTree as ET
-                parsed_xml = parseXML.parse(xml_content)
-                hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-                tree = ET.fromstring(parsed_xml)
-                for element in tree.iter():
-                    for k in ("bounds", "important", "class"):
-                        if k in element.attrib:
-                            del element.attrib[k]
-                encoded_xml = ET.tostring(tree, encoding='unicode')
+                from screenParser.cache import get_screen
+                parsed_xml, hierarchy_xml, encoded_xml = get_screen(xml_content).encode()
 
                 try:
                     db = get_db()
@@ -445,16 +440,8 @@ class AsyncProcessor:
                     pass
             else:
                 # 本地模式：不立即写盘，解析并缓存，待任务名可用后统一落盘
-                from screenParser import parseXML
-                import xml.etree.ElementTree as ET
-                parsed_xml = parseXML.parse(xml_content)
-                hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-                tree = ET.fromstring(parsed_xml)
-                for element in tree.iter():
-                    for k in ("bounds", "important", "class"):
-                        if k in element.attrib:
-                            del element.attrib[k]
-                encoded_xml = ET.tostring(tree, encoding='unicode')
+                from screenParser.cache import get_screen
+                parsed_xml, hierarchy_xml, encoded_xml = get_screen(xml_content).encode()
                 # 缓存原始XML，供事后落盘；不再依赖索引去重，后续按 page_index 配对
                 screen_count = getattr(mobilegpt, '_screen_count', 0)
                 buf = getattr(mobilegpt, '_local_buffer', None)
@@ -0,0 +1,233 @@
+"""
+asyncio 服务器模式
+单事件循环承载所有设备连接，阻塞的 MobileGPT 业务在有界线程池中执行，
+空闲连接不再占用 OS 线程
+"""
+
+import asyncio
+import json
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from env_config import Config
+from log_config import log
+from mobilegpt import MobileGPT
+from server import Server
+
+
+class StreamSocket:
+    """
+    将 asyncio StreamWriter 包装为类 socket 对象。
+    MobileGPT 与各消息处理器在工作线程中直接调用 socket.send()，这里统一转交给事件循环写出，
+    保证发送顺序与线程安全。
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self._writer = writer
+        self._loop = loop
+
+    def send(self, data: bytes) -> int:
+        if self._writer.is_closing():
+            raise ConnectionError("client stream is closed")
+        self._loop.call_soon_threadsafe(self._writer.write, bytes(data))
+        return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        self.send(data)
+
+    def close(self) -> None:
+        if not self._writer.is_closing():
+            self._loop.call_soon_threadsafe(self._writer.close)
+
+
+class AsyncServer(Server):
+    """基于 asyncio.start_server 的服务器，协议与 Server 完全一致（旧格式 I/X/S/A/E/G + JSON 格式）"""
+
+    # StreamReader.readline 的单行上限（长度行/指令行/问答行）
+    STREAM_LIMIT = 1024 * 1024
+
+    def __init__(self, host=None, port=None, buffer_size=None, max_workers=None):
+        super().__init__(host, port, buffer_size)
+        self.max_workers = max_workers or Config.SERVER_MAX_WORKERS
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mobilegpt-worker")
+
+    def open(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            log("收到中断信号，停止 asyncio 服务器", "yellow")
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def serve(self):
+        # 事件循环即进程级共享循环，_run_coroutine 会把协程提交到这里
+        self._loop = asyncio.get_running_loop()
+
+        real_ip = self.host
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 80))
+            real_ip = s.getsockname()[0]
+        except OSError:
+            pass
+        finally:
+            s.close()
+
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            reuse_address=True, limit=self.STREAM_LIMIT)
+
+        log("--------------------------------------------------------")
+        log(f"Server (asyncio, workers={self.max_workers}) is listening on {real_ip}:{self.port}\n"
+            f"Input this IP address into the app. : [{real_ip}]", "green")
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        client_socket = StreamSocket(writer, loop)
+        session = self.session_manager.create_session(client_socket, client_address)
+        log(f"处理客户端会话: {session.session_id} from {client_address}", "green")
+
+        try:
+            mobileGPT = MobileGPT(client_socket)
+            setattr(mobileGPT, 'session_id', session.session_id)
+            session.mobilegpt = mobileGPT
+
+            while True:
+                message = await self._receive_message_async(reader)
+                if not message:
+                    break
+
+                session.update_activity()
+
+                # 同一连接内的消息按到达顺序串行处理（与线程模式一致），阻塞业务交给有界线程池
+                try:
+                    await loop.run_in_executor(self.executor, self._handle_message_async, session, message)
+                except Exception as e:
+                    log(f"处理消息时出错: {e}", "red")
+                    break
+                await writer.drain()
+
+        except Exception as e:
+            log(f"处理客户端会话时出错: {e}", "red")
+        finally:
+            # 会话清理（关闭套接字、落盘该会话的写后持久化）是阻塞操作，同样交给线程池
+            await loop.run_in_executor(self.executor, self.session_manager.remove_session, session.session_id)
+            log(f"客户端会话已清理: {session.session_id}", "yellow")
+
+    async def _receive_message_async(self, reader: asyncio.StreamReader) -> Optional[dict]:
+        """asyncio 版本的 _receive_message_with_file"""
+        try:
+            message_type_byte = await reader.read(1)
+            if not message_type_byte:
+                log("客户端断开连接", "yellow")
+                return None
+
+            message_type = message_type_byte.decode()
+            log(f"检测到消息类型: {message_type}", "blue")
+
+            if message_type in ['I', 'X', 'S', 'A', 'E', 'G']:
+                return await self._receive_legacy_message_async(reader, message_type)
+            else:
+                return await self._receive_json_message_async(reader)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log("客户端断开连接", "yellow")
+            return None
+        except Exception as e:
+            log(f"接收消息失败: {e}", "red")
+            return None
+
+    async def _read_length_prefixed(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        length_line = await reader.readline()
+        if not length_line:
+            return None
+        message_length = int(length_line.decode().strip())
+        return await reader.readexactly(message_length)
+
+    async def _receive_legacy_message_async(self, reader: asyncio.StreamReader, message_type: str) -> Optional[dict]:
+        """asyncio 版本的 _receive_legacy_message"""
+        try:
+            if message_type == 'I':
+                instruction_line = await reader.readline()
+                if not instruction_line:
+                    return None
+                return {
+                    'messageType': 'instruction',
+                    'instruction': instruction_line.decode().strip()
+                }
+            elif message_type == 'X':
+                xml_data = await self._read_length_prefixed(reader)
+                if xml_data is None:
+                    return None
+                return {
+                    'messageType': 'xml',
+                    'xml': xml_data.decode('utf-8')
+                }
+            elif message_type == 'S':
+                screenshot_data = await self._read_length_prefixed(reader)
+                if screenshot_data is None:
+                    return None
+                return {
+                    'messageType': 'screenshot',
+                    'screenshot': screenshot_data
+                }
+            elif message_type == 'A':
+                qa_line = await reader.readline()
+                if not qa_line:
+                    return None
+                return {
+                    'messageType': 'qa',
+                    'qa': qa_line.decode().strip()
+                }
+            elif message_type == 'E':
+                error_data = await self._read_length_prefixed(reader)
+                if error_data is None:
+                    return None
+                error_content = error_data.decode('utf-8')
+                error_info = self._parse_error_message(error_content)
+                return {
+                    'messageType': 'error',
+                    'error': error_content,
+                    'screenshot': error_info.get('screenshot', None)
+                }
+            elif message_type == 'G':
+                return {
+                    'messageType': 'get_actions'
+                }
+            else:
+                log(f"未知的旧格式消息类型: {message_type}", "yellow")
+                return None
+
+        except asyncio.IncompleteReadError:
+            raise
+        except Exception as e:
+            log(f"解析旧格式消息失败: {e}", "red")
+            return None
+
+    async def _receive_json_message_async(self, reader: asyncio.StreamReader) -> Optional[dict]:
+        """asyncio 版本的 _receive_json_message"""
+        try:
+            message_data = await self._read_length_prefixed(reader)
+            if message_data is None:
+                return None
+            return json.loads(message_data.decode('utf-8'))
+        except asyncio.IncompleteReadError as e:
+            log(f"消息长度不匹配: 期望{e.expected}, 实际{len(e.partial)}", "red")
+            return None
+        except ValueError as e:
+            log(f"解析JSON消息失败: {e}", "red")
+            return None
+
+    def get_server_status(self):
+        status = super().get_server_status()
+        status['server']['mode'] = 'asyncio'
+        status['server']['max_workers'] = self.max_workers
+        return status
+
+    def shutdown(self):
+        super().shutdown()
+        self.executor.shutdown(wait=True)
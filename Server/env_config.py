@@ -18,6 +18,9 @@ class Config:
     SERVER_HOST: str = os.getenv("SERVER_HOST", "0.0.0.0")
     SERVER_PORT: int = int(os.getenv("SERVER_PORT", "12345"))
     SERVER_BUFFER_SIZE: int = int(os.getenv("SERVER_BUFFER_SIZE", "4096"))
+    # 服务器模式：thread（每连接一个线程）或 asyncio（单事件循环 + 有界线程池）
+    SERVER_MODE: str = os.getenv("SERVER_MODE", "thread").lower()
+    SERVER_MAX_WORKERS: int = int(os.getenv("SERVER_MAX_WORKERS", "32"))
     
     # 日志配置
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
@@ -26,10 +29,58 @@ class Config:
     # 内存配置
     MEMORY_DIRECTORY: str = os.getenv("MEMORY_DIRECTORY", "./memory")
     ENABLE_DB: bool = os.getenv("ENABLE_DB", "false").lower() == "true"
+    # 本地模式页面行日志：累计多少行后合并进 CSV 快照；fsync 批量间隔（毫秒）
+    LOCAL_LOG_COMPACT_ROWS: int = int(os.getenv("LOCAL_LOG_COMPACT_ROWS", "200"))
+    LOCAL_LOG_FSYNC_INTERVAL_MS: int = int(os.getenv("LOCAL_LOG_FSYNC_INTERVAL_MS", "200"))
+    # 本地模式快照格式：csv 或 parquet（parquet 需要安装 pyarrow，缺失时回退到 csv）
+    LOCAL_STORE_FORMAT: str = os.getenv("LOCAL_STORE_FORMAT", "csv").lower()
+    # 写后持久化：Memory/PageManager 的整表写入由后台线程合并落盘；合并等待时间（毫秒）
+    WRITE_BEHIND_ENABLED: bool = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+    WRITE_BEHIND_DELAY_MS: int = int(os.getenv("WRITE_BEHIND_DELAY_MS", "50"))
+    # 截图/XML 内容寻址仓库：XML 是否以 zstd 压缩存放（需要安装 zstandard）
+    BLOB_STORE_COMPRESS_XML: bool = os.getenv("BLOB_STORE_COMPRESS_XML", "true").lower() == "true"
+    # load_dataframe 缓存：容量上限（MB）、无变更流时的最长存活时间（秒）、是否订阅 MongoDB 变更流
+    DATAFRAME_CACHE_MAX_MB: int = int(os.getenv("DATAFRAME_CACHE_MAX_MB", "256"))
+    DATAFRAME_CACHE_TTL_SECONDS: float = float(os.getenv("DATAFRAME_CACHE_TTL_SECONDS", "300"))
+    DATAFRAME_CACHE_CHANGE_STREAMS: bool = os.getenv("DATAFRAME_CACHE_CHANGE_STREAMS", "true").lower() == "true"
+    # pandas Copy-on-Write：DataFrame 缓存命中时返回浅拷贝而不是深拷贝（调用方修改时才复制）
+    PANDAS_COPY_ON_WRITE: bool = os.getenv("PANDAS_COPY_ON_WRITE", "true").lower() == "true"
     
     # 其他配置
     OPENAI_API_KEY: Optional[str] = os.getenv("OPENAI_API_KEY")
     
+    # 大模型客户端配置（OpenAI 兼容接口，进程内共享连接池）
+    LLM_API_KEY: str = os.getenv("LLM_API_KEY", "sk-c2cc873160714661aa76b6d5ab7239bf")
+    LLM_BASE_URL: str = os.getenv("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+    LLM_TIMEOUT: float = float(os.getenv("LLM_TIMEOUT", "60"))
+    LLM_CONNECT_TIMEOUT: float = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+    LLM_MAX_CONNECTIONS: int = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+    LLM_MAX_KEEPALIVE: int = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+    LLM_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+    # 每个模型的最大并发请求数；LLM_MODEL_CONCURRENCY 形如 "qwen3-32b=8,qwen3-8b=16"
+    LLM_DEFAULT_CONCURRENCY: int = int(os.getenv("LLM_DEFAULT_CONCURRENCY", "16"))
+    LLM_MODEL_CONCURRENCY: str = os.getenv("LLM_MODEL_CONCURRENCY", "")
+    # 按模型的速率限制："qwen3-32b=600:1000000,..."（每分钟请求数:每分钟 token 数，0 表示不限）；未列出的模型使用默认值
+    LLM_MODEL_RATE_LIMITS: str = os.getenv("LLM_MODEL_RATE_LIMITS", "")
+    LLM_DEFAULT_RPM: int = int(os.getenv("LLM_DEFAULT_RPM", "0"))
+    LLM_DEFAULT_TPM: int = int(os.getenv("LLM_DEFAULT_TPM", "0"))
+    # 自适应并发：429 或耗时超过 LLM_LATENCY_TARGET 秒（0 表示不按耗时调整）时并发上限减半，最低 LLM_MIN_CONCURRENCY
+    LLM_MIN_CONCURRENCY: int = int(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+    LLM_LATENCY_TARGET: float = float(os.getenv("LLM_LATENCY_TARGET", "30"))
+    # 后台请求（动作总结、嵌入回填）最多占用的并发比例
+    LLM_BACKGROUND_SHARE: float = float(os.getenv("LLM_BACKGROUND_SHARE", "0.5"))
+    # LLM 响应缓存后端：memory（默认，只用进程内缓存）/ sqlite（本机多进程共享，重启后仍有效）/ mongo（多服务器共享）
+    # 持久化后端需显式开启：缓存的决策会跨重启、跨任务复用
+    LLM_CACHE_BACKEND: str = os.getenv("LLM_CACHE_BACKEND", "memory").lower()
+    LLM_CACHE_PATH: str = os.getenv("LLM_CACHE_PATH", "")
+    LLM_CACHE_TTL_SECONDS: int = int(os.getenv("LLM_CACHE_TTL_SECONDS", "900"))
+    LLM_CACHE_MAX_ENTRIES: int = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+    # 缓存键命名空间：修改提示词模板后更换，使旧响应失效
+    LLM_CACHE_NAMESPACE: str = os.getenv("LLM_CACHE_NAMESPACE", "v1")
+    # derive 使用流式输出：action 解析完成即返回，reasoning / plan 等其余字段在后台接收
+    LLM_STREAM_DERIVE: bool = os.getenv("LLM_STREAM_DERIVE", "true").lower() == "true"
+    LLM_STREAM_WORKERS: int = int(os.getenv("LLM_STREAM_WORKERS", "32"))
+    
     @classmethod
     def get_mongodb_config(cls) -> dict:
         """获取MongoDB配置"""
@@ -46,7 +97,22 @@ class Config:
         return {
             'host': cls.SERVER_HOST,
             'port': cls.SERVER_PORT,
-            'buffer_size': cls.SERVER_BUFFER_SIZE
+            'buffer_size': cls.SERVER_BUFFER_SIZE,
+            'mode': cls.SERVER_MODE,
+            'max_workers': cls.SERVER_MAX_WORKERS
+        }
+    
+    @classmethod
+    def get_llm_config(cls) -> dict:
+        """获取大模型客户端配置"""
+        return {
+            'base_url': cls.LLM_BASE_URL,
+            'timeout': cls.LLM_TIMEOUT,
+            'connect_timeout': cls.LLM_CONNECT_TIMEOUT,
+            'max_connections': cls.LLM_MAX_CONNECTIONS,
+            'max_keepalive': cls.LLM_MAX_KEEPALIVE,
+            'default_concurrency': cls.LLM_DEFAULT_CONCURRENCY,
+            'model_concurrency': cls.LLM_MODEL_CONCURRENCY
         }
     
     @classmethod
@@ -59,5 +125,12 @@ class Config:
         print(f"MongoDB Min Pool Size: {cls.MONGODB_MIN_POOL_SIZE}")
         print(f"Server Host: {cls.SERVER_HOST}")
         print(f"Server Port: {cls.SERVER_PORT}")
+        print(f"Server Mode: {cls.SERVER_MODE} (max workers: {cls.SERVER_MAX_WORKERS})")
         print(f"Enable DB: {cls.ENABLE_DB}")
+        print(f"LLM Base URL: {cls.LLM_BASE_URL} (timeout: {cls.LLM_TIMEOUT}s, max connections: {cls.LLM_MAX_CONNECTIONS})")
         print("===============")
+
+
+if Config.PANDAS_COPY_ON_WRITE:
+    import pandas as pd
+    pd.set_option("mode.copy_on_write", True)
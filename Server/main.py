@@ -1,6 +1,7 @@
 import os, sys
 from dotenv import load_dotenv
 from server import Server
+from env_config import Config
 
 # os.chdir('./MobileGPT_server')
 sys.path.append('.')
@@ -34,7 +35,12 @@ def main():
     server_port = 12345 #服务端监听的端口号。
     server_vision = False
 
-    mobilGPT_server = Server(host=server_ip, port=int(server_port), buffer_size=4096) #4096：每次通信最多接收4096字节数据。
+    if Config.SERVER_MODE == "asyncio":
+        # 单事件循环 + 有界线程池，空闲连接不占用线程
+        from async_server import AsyncServer
+        mobilGPT_server = AsyncServer(host=server_ip, port=int(server_port), buffer_size=4096)
+    else:
+        mobilGPT_server = Server(host=server_ip, port=int(server_port), buffer_size=4096) #4096：每次通信最多接收4096字节数据。
     mobilGPT_server.open()
 
     # mobilGPT_explorer = Explorer(host=server_ip, port=int(server_port), buffer_size=4096) #用于 探索模式（Explorer）
@@ -0,0 +1,145 @@
+import threading
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+
+def normalize_embedding(vector) -> np.ndarray:
+    """转为 float32 单位向量；零向量/非有限值返回全零（相似度恒为 0）"""
+    v = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(v)
+    if norm == 0 or not np.isfinite(norm):
+        return np.zeros_like(v)
+    return v / norm
+
+
+class EmbeddingIndex:
+    """
+    任务维度的页面嵌入向量索引。
+    所有向量预先归一化后存放在一块连续的 float32 矩阵中，
+    top-k 检索 = 一次矩阵-向量乘法 + argpartition，替代逐行 cosine_similarity。
+
+    与 utils.cosine_similarity 的语义保持一致：空向量、维度不一致、零向量的相似度均视为 0。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._size = 0
+        self._dim = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    def rebuild(self, items: Iterable[Tuple[int, object]]) -> None:
+        """用 (page_index, embedding) 序列整体重建索引；无效向量被跳过"""
+        ids, rows = [], []
+        dim = 0
+        for page_index, embedding in items:
+            if embedding is None:
+                continue
+            v = np.asarray(embedding).ravel()
+            if v.size == 0:
+                continue
+            if dim == 0:
+                dim = v.size
+            if v.size != dim:
+                continue
+            try:
+                page_index = int(page_index)
+            except (TypeError, ValueError):
+                continue
+            ids.append(page_index)
+            rows.append(normalize_embedding(v))
+
+        with self._lock:
+            self._dim = dim
+            self._size = len(ids)
+            self._ids = np.asarray(ids, dtype=np.int64)
+            self._matrix = np.vstack(rows).astype(np.float32, copy=False) if rows \
+                else np.empty((0, dim), dtype=np.float32)
+
+    @classmethod
+    def from_dataframe(cls, df, id_column: str = 'index', embedding_column: str = 'embedding') -> 'EmbeddingIndex':
+        index = cls()
+        if df is not None and not df.empty and id_column in df.columns and embedding_column in df.columns:
+            index.rebuild(zip(df[id_column].tolist(), df[embedding_column].tolist()))
+        return index
+
+    @classmethod
+    def from_normalized(cls, ids: np.ndarray, matrix: np.ndarray) -> 'EmbeddingIndex':
+        """
+        直接以已归一化的 float32 矩阵（可为只读 memmap）构建索引，不做拷贝。
+        同一 page_index 出现多次时以最后一次写入为准。
+        """
+        index = cls()
+        n = min(len(ids), matrix.shape[0]) if matrix.ndim == 2 else 0
+        if n == 0:
+            return index
+        ids, matrix = np.asarray(ids[:n], dtype=np.int64), matrix[:n]
+        _, first_in_reversed = np.unique(ids[::-1], return_index=True)
+        if len(first_in_reversed) != n:
+            keep = np.sort(n - 1 - first_in_reversed)
+            ids, matrix = ids[keep], np.ascontiguousarray(matrix[keep], dtype=np.float32)
+        index._ids, index._matrix = ids, matrix
+        index._size, index._dim = len(ids), matrix.shape[1]
+        return index
+
+    def upsert(self, page_index: int, embedding) -> bool:
+        """新增或覆盖一个页面的向量；维度不一致时返回 False（由调用方决定是否重建）"""
+        v = np.asarray(embedding).ravel() if embedding is not None else np.empty(0)
+        if v.size == 0:
+            return False
+        page_index = int(page_index)
+        with self._lock:
+            if self._size == 0:
+                self._dim = v.size
+                self._matrix = np.empty((0, v.size), dtype=np.float32)
+            if v.size != self._dim:
+                return False
+            row = normalize_embedding(v)
+
+            hit = np.flatnonzero(self._ids[:self._size] == page_index)
+            if hit.size:
+                if not self._matrix.flags.writeable:
+                    # memmap 只读，首次修改时复制到内存
+                    self._matrix = np.array(self._matrix[:self._size], dtype=np.float32)
+                    self._ids = np.array(self._ids[:self._size], dtype=np.int64)
+                self._matrix[hit[0]] = row
+                return True
+
+            # 按倍增扩容，摊还 O(1) 追加
+            if self._size == self._matrix.shape[0]:
+                capacity = max(16, self._size * 2)
+                matrix = np.empty((capacity, self._dim), dtype=np.float32)
+                matrix[:self._size] = self._matrix[:self._size]
+                ids = np.empty(capacity, dtype=np.int64)
+                ids[:self._size] = self._ids[:self._size]
+                self._matrix, self._ids = matrix, ids
+            self._matrix[self._size] = row
+            self._ids[self._size] = page_index
+            self._size += 1
+            return True
+
+    def search(self, vector, k: int = 5) -> List[Tuple[int, float]]:
+        """返回按相似度降序的 [(page_index, similarity), ...]，最多 k 个"""
+        query = np.asarray(vector).ravel() if vector is not None else np.empty(0)
+        with self._lock:
+            n = self._size
+            if n == 0 or k <= 0 or query.size != self._dim:
+                return []
+            scores = self._matrix[:n] @ normalize_embedding(query)
+            ids = self._ids[:n]
+
+        k = min(k, n)
+        if k < n:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(n)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(ids[i]), float(scores[i])) for i in top]
@@ -0,0 +1,150 @@
+import os
+import threading
+from typing import Iterable, Tuple
+
+import numpy as np
+
+from memory.embedding_index import normalize_embedding
+from utils.local_store import get_task_dir
+
+_HEADER_BYTES = 8
+# 同一进程内多个会话可能写同一任务的向量文件，按路径串行化追加
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _file_locks_guard:
+        if path not in _file_locks:
+            _file_locks[path] = threading.Lock()
+        return _file_locks[path]
+
+
+class EmbeddingStore:
+    """
+    本地模式的二进制嵌入向量库（替代 hierarchy.csv 中 str(embedding) 的存储方式）。
+
+    memory/log/<task>/<name>_embeddings.f32  连续的已归一化 float32 行向量，只追加
+    memory/log/<task>/<name>_embeddings.idx  int64 头（向量维度）+ 每行对应的 page_index
+
+    加载时以只读 memmap 映射向量文件，不做解析与拷贝；同一 page_index 重复写入时以最后一行为准。
+    先写向量再写索引，进程中断时多出的半行会在加载时被忽略，下次追加前经临时文件 + os.replace 截掉。
+    截断或删除文件前先释放本实例持有的 memmap（Windows 上仍被映射的文件无法替换或删除）；
+    POSIX 上其他会话已有的映射继续指向旧文件，不会被截断。
+    """
+
+    def __init__(self, task_name: str, name: str = "hierarchy"):
+        task_dir = get_task_dir(task_name)
+        self.vectors_path = os.path.join(task_dir, f"{name}_embeddings.f32")
+        self.index_path = os.path.join(task_dir, f"{name}_embeddings.idx")
+        self._lock = _lock_for(self.index_path)
+        # 最近一次 load() 返回的 memmap
+        self._matrix = None
+
+    def _read_dim(self) -> int:
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) < _HEADER_BYTES:
+            return 0
+        return int(np.fromfile(self.index_path, dtype=np.int64, count=1)[0])
+
+    def exists(self) -> bool:
+        return self._read_dim() > 0
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray]:
+        """返回 (page_ids, matrix)；matrix 为只读 memmap，形状 (n, dim)"""
+        with self._lock:
+            dim = self._read_dim()
+            if dim <= 0 or not os.path.exists(self.vectors_path):
+                return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+            ids = np.fromfile(self.index_path, dtype=np.int64, offset=_HEADER_BYTES)
+            rows = os.path.getsize(self.vectors_path) // (dim * 4)
+            n = min(len(ids), rows)
+            if n == 0:
+                return np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32)
+            self._release()
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(n, dim))
+            return ids[:n], self._matrix
+
+    def append(self, page_index: int, embedding) -> bool:
+        return self.append_many([(page_index, embedding)]) > 0
+
+    def append_many(self, items: Iterable[Tuple[int, object]]) -> int:
+        """追加若干 (page_index, embedding)；维度与已有文件不一致的向量被跳过，返回写入行数"""
+        with self._lock:
+            dim = self._read_dim()
+            ids, rows = [], []
+            for page_index, embedding in items:
+                v = np.asarray(embedding).ravel() if embedding is not None else np.empty(0)
+                if v.size == 0:
+                    continue
+                if dim == 0:
+                    dim = v.size
+                    self._reset(dim)
+                if v.size != dim:
+                    continue
+                ids.append(int(page_index))
+                rows.append(normalize_embedding(v))
+            if not rows:
+                return 0
+
+            self._truncate_partial(dim)
+            with open(self.vectors_path, 'ab') as f:
+                np.vstack(rows).astype(np.float32, copy=False).tofile(f)
+                f.flush()
+            with open(self.index_path, 'ab') as f:
+                np.asarray(ids, dtype=np.int64).tofile(f)
+                f.flush()
+            return len(rows)
+
+    @property
+    def dim(self) -> int:
+        return self._read_dim()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._unlink()
+
+    def _release(self) -> None:
+        """释放本实例持有的 memmap；调用方（如 EmbeddingIndex）仍持有的引用需自行丢弃"""
+        matrix, self._matrix = self._matrix, None
+        del matrix
+
+    def _unlink(self) -> None:
+        # 先删除再重建（而不是原地截断），避免其他会话仍持有的 memmap 映射到被截断的页面
+        self._release()
+        for path in (self.vectors_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _reset(self, dim: int) -> None:
+        self._unlink()
+        with open(self.index_path, 'wb') as f:
+            np.asarray([dim], dtype=np.int64).tofile(f)
+        open(self.vectors_path, 'wb').close()
+
+    def _truncate_partial(self, dim: int) -> None:
+        """丢弃上次中断留下的、未配对的尾部数据，保证两文件行数一致"""
+        if not os.path.exists(self.vectors_path):
+            open(self.vectors_path, 'wb').close()
+        n_ids = (os.path.getsize(self.index_path) - _HEADER_BYTES) // 8
+        n_rows = os.path.getsize(self.vectors_path) // (dim * 4)
+        n = min(n_ids, n_rows)
+        for path, size in ((self.vectors_path, n * dim * 4), (self.index_path, _HEADER_BYTES + n * 8)):
+            if os.path.getsize(path) != size:
+                self._release()
+                _replace_truncated(path, size)
+
+
+def _replace_truncated(path: str, size: int) -> None:
+    """把文件前 size 字节写入临时文件后原子替换原文件，不原地截断仍可能被映射的文件"""
+    tmp_path = path + ".tmp"
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        remaining = size
+        while remaining > 0:
+            chunk = src.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, path)
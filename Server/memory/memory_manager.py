@@ -3,17 +3,18 @@ import os
 from collections import defaultdict
 from typing import Dict
 
-import numpy as np
 import pandas as pd
 
 from agents import param_fill_agent, subtask_merge_agent
 from memory.page_manager import PageManager
 from memory.node_manager import NodeManager
+from memory.embedding_index import EmbeddingIndex
+from memory.embedding_store import EmbeddingStore
 from utils import parsing_utils
 from env_config import Config
 from utils.mongo_utils import check_connection
 from utils.action_utils import generalize_action
-from utils.utils import get_openai_embedding, log, safe_literal_eval, cosine_similarity
+from utils.utils import get_openai_embedding, get_openai_embeddings, log, safe_literal_eval
 from utils.mongo_utils import load_dataframe, save_dataframe
 from utils.local_store import write_dataframe_csv, read_dataframe_csv
 from utils.local_store import write_dataframe_csv
@@ -26,6 +27,34 @@ def init_database(path: str, headers: list, use_cache: bool = True):
     return load_dataframe(path, headers, use_cache=use_cache)
 
 
+def reembed_hierarchy(task_name: str) -> int:
+    """
+    批量重新生成层级库的全部嵌入向量（如更换嵌入模型后），返回写入的向量数。
+    本地模式重建 memory/log/<task>/ 下的二进制向量库；DB 模式重写 hierarchy 集合的 embedding 字段。
+    """
+    header = ['index', 'screen', 'embedding']
+    if not Config.ENABLE_DB:
+        hierarchy_db = read_dataframe_csv("hierarchy", header, task_name=task_name)
+    else:
+        hierarchy_db = init_database("hierarchy", header, use_cache=False)
+    hierarchy_db = hierarchy_db[hierarchy_db['screen'].notna()]
+    if hierarchy_db.empty:
+        return 0
+
+    embeddings = get_openai_embeddings(hierarchy_db['screen'].astype(str).tolist())
+    if not Config.ENABLE_DB:
+        store = EmbeddingStore(task_name, "hierarchy")
+        store.reset()
+        count = store.append_many(zip(hierarchy_db['index'].tolist(), embeddings))
+    else:
+        hierarchy_db = hierarchy_db.copy()
+        hierarchy_db['embedding'] = [str(e) for e in embeddings]
+        save_dataframe("hierarchy", hierarchy_db)
+        count = len(embeddings)
+    log(f"📦 层级向量批量重建完成: 任务='{task_name}', 数量={count}", "cyan")
+    return count
+
+
 class Memory:
     def __init__(self, instruction: str, task_name: str):
 
@@ -60,10 +89,18 @@ class Memory:
         log(f"📊 页面数据库加载: 页面数量={len(self.page_db)}", "cyan")
         
         if not Config.ENABLE_DB:
-            self.hierarchy_db = read_dataframe_csv(self.screen_hierarchy_path, hierarchy_header, task_name=self.task_name)
+            # 本地模式：向量存放在二进制向量库中（memmap 加载），CSV 只保留 index/screen
+            self.embedding_store = EmbeddingStore(self.task_name, self.screen_hierarchy_path)
+            # 向量库已存在时初始化只需要 index 列（screen 是整页 XML，按需在 add_hierarchy_xml 中读取）
+            columns = ['index'] if self.embedding_store.exists() else hierarchy_header
+            self.hierarchy_db = read_dataframe_csv(self.screen_hierarchy_path, columns, task_name=self.task_name)
+            self.__migrate_csv_embeddings()
+            self.hierarchy_index = EmbeddingIndex.from_normalized(*self.embedding_store.load())
         else:
+            self.embedding_store = None
             self.hierarchy_db = init_database(self.screen_hierarchy_path, hierarchy_header, use_cache=True)
-        self.hierarchy_db['embedding'] = self.hierarchy_db.embedding.apply(safe_literal_eval)
+            self.hierarchy_db['embedding'] = self.hierarchy_db.embedding.apply(safe_literal_eval)
+            self.hierarchy_index = EmbeddingIndex.from_dataframe(self.hierarchy_db)
         log(f"📊 层级数据库加载: 层级数量={len(self.hierarchy_db)}", "cyan")
         
         self.task_path = self.__get_task_data(self.task_name)
@@ -133,14 +170,13 @@ class Memory:
                    'extra_uis': json.dumps(extra_uis), "screen": screen}
         # 将更新后的页面信息保存到 MongoDB 集合
         self.page_db = pd.concat([self.page_db, pd.DataFrame([new_row])], ignore_index=True)
-        save_dataframe(self.page_path, self.page_db)
-        write_dataframe_csv(self.page_path, self.page_db, task_name=self.task_name)
+        save_dataframe(self.page_path, self.page_db, deferred=True)
+        write_dataframe_csv(self.page_path, self.page_db, task_name=self.task_name, deferred=True)
 
         # 保存available_subtasks的补充代码，如后续有bug可检查这里
-        available_subtasks_path = f"page_{new_index}_available_subtasks"
-        available_subtasks_df = pd.DataFrame(available_subtasks)
-        save_dataframe(available_subtasks_path, available_subtasks_df)
-        write_dataframe_csv(available_subtasks_path, available_subtasks_df, task_name=self.task_name, page_index=new_index)
+        if new_index not in self.page_managers:
+            self.page_managers[new_index] = PageManager(self.task_name, new_index)
+        self.page_managers[new_index].save_available_subtasks(available_subtasks)
 
         # 根据配置与连通性：优先写入数据库；不可用时不写DB，保留本地文件
         try:
@@ -176,8 +212,8 @@ class Memory:
                        'extra_uis': json.dumps(merged_extra_uis), "screen": new_screen}
 
         self.page_db.loc[page_index] = updated_row
-        save_dataframe(self.page_path, self.page_db)
-        write_dataframe_csv(self.page_path, self.page_db, task_name=self.task_name)
+        save_dataframe(self.page_path, self.page_db, deferred=True)
+        write_dataframe_csv(self.page_path, self.page_db, task_name=self.task_name, deferred=True)
 
         # available_subtasks 的持久化由 PageManager 负责到 MongoDB，不再写 CSV
 
@@ -185,7 +221,12 @@ class Memory:
         #  生成界面XML的嵌入向量
         embedding = get_openai_embedding(screen)
         # 构造层级数据（页面索引、XML、嵌入向量）
-        new_screen_hierarchy = {'index': page_index, 'screen': screen, 'embedding': str(embedding)}
+        if not Config.ENABLE_DB:
+            # 本地模式：向量追加写入二进制向量库，CSV 中不再保存字符串化的向量
+            self.__append_local_embedding(page_index, embedding)
+            new_screen_hierarchy = {'index': page_index, 'screen': screen, 'embedding': None}
+        else:
+            new_screen_hierarchy = {'index': page_index, 'screen': screen, 'embedding': str(embedding)}
         # 写入界面层级库并重新加载（确保后续匹配可用）
         if not Config.ENABLE_DB:
             hierarchy_db = read_dataframe_csv(self.screen_hierarchy_path, ['index', 'screen', 'embedding'], task_name=self.task_name)
@@ -203,15 +244,48 @@ class Memory:
         else:
             hierarchy_db = pd.concat([hierarchy_db, pd.DataFrame([new_screen_hierarchy])], ignore_index=True)
         
-        save_dataframe(self.screen_hierarchy_path, hierarchy_db)
-        write_dataframe_csv(self.screen_hierarchy_path, hierarchy_db, task_name=self.task_name)
+        save_dataframe(self.screen_hierarchy_path, hierarchy_db, deferred=True)
+        write_dataframe_csv(self.screen_hierarchy_path, hierarchy_db, task_name=self.task_name, deferred=True)
 
         if not Config.ENABLE_DB:
-            self.hierarchy_db = read_dataframe_csv(self.screen_hierarchy_path, ['index', 'screen', 'embedding'], task_name=self.task_name)
-        else:
-            self.hierarchy_db = init_database(self.screen_hierarchy_path, ['index', 'screen', 'embedding'])
+            # 刚写入的 DataFrame 即为最新数据，无需再从 CSV 读回
+            self.hierarchy_db = hierarchy_db
+            # 增量同步向量索引；失败时从向量库重建（可能包含其他会话写入的页面）
+            if not self.hierarchy_index.upsert(page_index, embedding):
+                self.hierarchy_index = EmbeddingIndex.from_normalized(*self.embedding_store.load())
+            return
+
+        self.hierarchy_db = init_database(self.screen_hierarchy_path, ['index', 'screen', 'embedding'])
         self.hierarchy_db['embedding'] = self.hierarchy_db.embedding.apply(safe_literal_eval)
 
+        # 增量同步向量索引；若与持久化数据不一致（如其他会话也写入了该任务），则整体重建
+        if not self.hierarchy_index.upsert(page_index, embedding) or \
+                len(self.hierarchy_index) != len(self.hierarchy_db):
+            self.hierarchy_index = EmbeddingIndex.from_dataframe(self.hierarchy_db)
+
+    def __append_local_embedding(self, page_index, embedding):
+        if self.embedding_store.append(page_index, embedding):
+            return
+        if embedding is not None and len(embedding) > 0:
+            # 嵌入模型变更导致维度不一致：旧向量已无法比较，重建向量库
+            log(f"⚠️ 嵌入维度变化({self.embedding_store.dim} -> {len(embedding)})，重建本地向量库", "yellow")
+            # 先丢弃索引对向量文件 memmap 的引用，再删除重建文件
+            self.hierarchy_index = EmbeddingIndex()
+            self.embedding_store.reset()
+            self.embedding_store.append(page_index, embedding)
+
+    def __migrate_csv_embeddings(self):
+        """一次性迁移：旧版 hierarchy.csv 中字符串化的向量写入二进制向量库，并从 CSV 中清除"""
+        if self.hierarchy_db.empty or self.embedding_store.exists():
+            return
+        embeddings = self.hierarchy_db.embedding.apply(safe_literal_eval)
+        if not any(len(e) > 0 for e in embeddings):
+            return
+        migrated = self.embedding_store.append_many(zip(self.hierarchy_db['index'].tolist(), embeddings.tolist()))
+        self.hierarchy_db['embedding'] = None
+        write_dataframe_csv(self.screen_hierarchy_path, self.hierarchy_db, task_name=self.task_name)
+        log(f"📦 层级向量迁移到二进制向量库: {migrated} 条", "cyan")
+
     def get_next_subtask(self, page_index, qa_history, screen):
         # Initialize action step
         self.curr_action_step = 0
@@ -359,8 +433,8 @@ class Memory:
         else:
             self.task_db = pd.concat([self.task_db, pd.DataFrame([new_task_path])], ignore_index=True)
         # 将更新后的任务库写入 MongoDB
-        save_dataframe(self.task_db_path, self.task_db)
-        write_dataframe_csv(self.task_db_path, self.task_db, task_name=self.task_name)
+        save_dataframe(self.task_db_path, self.task_db, deferred=True)
+        write_dataframe_csv(self.task_db_path, self.task_db, task_name=self.task_name, deferred=True)
         log(f":::TASK SAVE::: Path saved: {new_task_path}")
 
     def save_task_path(self, new_task_path: dict):
@@ -382,7 +456,7 @@ class Memory:
         else:
             self.task_db = pd.concat([self.task_db, pd.DataFrame([new_task_data])], ignore_index=True)
 
-        save_dataframe(self.task_db_path, self.task_db)
+        save_dataframe(self.task_db_path, self.task_db, deferred=True)
 
     def __get_task_data(self, task_name):
         # Search for the task
@@ -407,31 +481,23 @@ class Memory:
             return task_path
 
     def __search_similar_hierarchy_nodes(self, hierarchy) -> list:
-        new_hierarchy_vector = np.array(get_openai_embedding(hierarchy))
-        self.hierarchy_db["similarity"] = self.hierarchy_db.embedding.apply(
-            lambda x: cosine_similarity(x, new_hierarchy_vector))
+        new_hierarchy_vector = get_openai_embedding(hierarchy)
 
         # get top apps with the highest similarity
-        candidates = self.hierarchy_db.sort_values('similarity', ascending=False).head(5).to_dict(orient='records')
-        candidate_node_indexes = []
-        for node in candidates:
-            candidate_node_indexes.append(node['index'])
-
-        return candidate_node_indexes
+        candidates = self.hierarchy_index.search(new_hierarchy_vector, k=5)
+        return [node_index for node_index, _ in candidates]
 
     def __search_most_similar_hierarchy_node(self, hierarchy) -> int:
-        new_hierarchy_vector = np.array(get_openai_embedding(hierarchy))
-        self.hierarchy_db["similarity"] = self.hierarchy_db.embedding.apply(
-            lambda x: cosine_similarity(x, new_hierarchy_vector))
+        new_hierarchy_vector = get_openai_embedding(hierarchy)
 
         # get top apps with the highest similarity
-        candidates = self.hierarchy_db.sort_values('similarity', ascending=False).head(5).to_dict(orient='records')
+        candidates = self.hierarchy_index.search(new_hierarchy_vector, k=1)
         if candidates:
-            highest_similarity = candidates[0]['similarity']
+            node_index, highest_similarity = candidates[0]
             log(f"📊 相似度计算: 最高相似度={highest_similarity:.4f}, 阈值=0.97", "cyan")
             if highest_similarity > 0.97:
-                log(f"✅ 页面匹配成功: 页面索引={candidates[0]['index']}, 相似度={highest_similarity:.4f}", "green")
-                return candidates[0]['index']
+                log(f"✅ 页面匹配成功: 页面索引={node_index}, 相似度={highest_similarity:.4f}", "green")
+                return node_index
             else:
                 log(f"❌ 页面匹配失败: 相似度{highest_similarity:.4f}低于阈值0.97", "yellow")
         else:
@@ -462,8 +528,8 @@ class Memory:
 
                 page_data['available_subtasks'] = json.dumps(available_subtasks)
                 self.page_db.loc[page_index] = page_data
-                save_dataframe(self.page_path, self.page_db)
-                write_dataframe_csv(self.page_path, self.page_db, task_name=self.task_name)
+                save_dataframe(self.page_path, self.page_db, deferred=True)
+                write_dataframe_csv(self.page_path, self.page_db, task_name=self.task_name, deferred=True)
 
                 self.page_managers[page_index].update_subtask_info(merged_subtask_dict)
 
@@ -0,0 +1,80 @@
+"""
+进程级页面缓存
+同一任务的多个会话共享页面的 subtasks / available_subtasks / actions 数据，首次访问时才加载；
+页面有写入时作废对应条目并递增版本号，下次访问重新加载。
+缓存中的 DataFrame 和动作记录由所有会话共享，只读使用，修改前必须先复制。
+"""
+
+import threading
+from typing import Callable, Dict, Hashable, List
+
+import pandas as pd
+
+
+class PageData:
+
+    def __init__(self, version: int, subtask_db: pd.DataFrame, available_subtask_db: pd.DataFrame,
+                 action_db: pd.DataFrame):
+        self.version = version
+        self.subtask_db = subtask_db
+        self.available_subtask_db = available_subtask_db
+        self.action_db = action_db
+        self.action_records: List[dict] = action_db.to_dict(orient='records')
+
+
+class PageCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, PageData] = {}
+        self._versions: Dict[Hashable, int] = {}
+        self._load_locks: Dict[Hashable, threading.Lock] = {}
+        self._stats = {'hits': 0, 'loads': 0, 'invalidations': 0}
+
+    def get(self, key: Hashable, loader: Callable[[int], PageData]) -> PageData:
+        """返回页面数据；未缓存时调用 loader(version) 加载，同一页面并发访问只加载一次"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._stats['hits'] += 1
+                return entry
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._stats['hits'] += 1
+                    return entry
+                version = self._versions.get(key, 0)
+            entry = loader(version)
+            with self._lock:
+                self._stats['loads'] += 1
+                # 加载期间页面被写入（版本已变化）时不缓存，避免留下旧数据
+                if self._versions.get(key, 0) == version:
+                    self._entries[key] = entry
+            return entry
+
+    def version(self, key: Hashable) -> int:
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._stats['invalidations'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in self._entries:
+                self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, pages=len(self._entries))
+
+
+# 全局页面缓存实例
+page_cache = PageCache()
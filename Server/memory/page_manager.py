@@ -1,76 +1,136 @@
 import json
 import os
+from typing import Dict, List
 
 import pandas as pd
 
 from agents import param_fill_agent
+from memory.page_cache import PageData, page_cache
 from utils.action_utils import adapt_action
 from log_config import log
-from utils.mongo_utils import load_dataframe, save_dataframe
+from utils.mongo_utils import PAGE_COLLECTIONS, PAGE_SCOPE_FIELDS, load_dataframe, save_dataframe
 from utils.local_store import write_dataframe_csv, append_one_csv, read_dataframe_csv
 
 
-def init_database(collection: str, headers: list):
+def init_database(collection: str, headers: list, scope: dict = None):
     from env_config import Config
     if not Config.ENABLE_DB:
         return read_dataframe_csv(collection, headers)
-    return load_dataframe(collection, headers)
+    return load_dataframe(collection, headers, scope=scope)
+
+
+def _action_signature(action: dict) -> tuple:
+    return action.get("subtask_name", ""), action.get("step"), action.get("action")
 
 
 class PageManager:
+    """
+    页面的子任务/动作数据。数据本身来自进程级 page_cache（多个会话共享、首次访问时加载），
+    每个会话只保存自己的 traversed 状态：按动作签名记录已遍历的条数，不修改共享的动作记录。
+    """
+
     def __init__(self, task_name: str, page_index: int):
         self.task_name = task_name
         self.page_index = page_index
 
-        subtask_header = ['name', 'description', 'parameters', 'example']
-        action_header = ['subtask_name', 'step', 'action', 'example']
-        available_subtask_header = ['name', 'description', 'parameters']
-
-        # MongoDB 集合名（简化结构，不再按应用拆分）
+        # 本地 CSV 的逻辑名（local_store 映射到 pages/<index>/ 下的文件）
         self.subtask_db_path = f"page_{page_index}_subtasks"
         self.available_subtask_db_path = f"page_{page_index}_available_subtasks"
         self.action_db_path = f"page_{page_index}_actions"
 
+        # DB 模式下页面数据不区分任务（pages / hierarchy 集合为全局），本地模式按任务目录存放
+        from env_config import Config
+        self._cache_key = (None if Config.ENABLE_DB else task_name, page_index)
+        # MongoDB：三个合并集合，按 (task_name, page_index) 限定到本页面
+        self._db_scope = dict(zip(PAGE_SCOPE_FIELDS, self._cache_key))
+        self._traversed: Dict[tuple, int] = {}
+
+    def _load(self, version: int) -> PageData:
+        subtask_header = ['name', 'description', 'parameters', 'example']
+        action_header = ['subtask_name', 'step', 'action', 'example']
+        available_subtask_header = ['name', 'description', 'parameters']
+        task_name, page_index = self.task_name, self.page_index
+
         # 根据ENABLE_DB配置选择数据源
         from env_config import Config
-        
+
         if Config.ENABLE_DB:
             # 使用MongoDB
-            self.subtask_db = init_database(self.subtask_db_path, subtask_header)
-            self.available_subtask_db = init_database(self.available_subtask_db_path, available_subtask_header)
-            self.action_db = init_database(self.action_db_path, action_header)
+            subtask_db = init_database(PAGE_COLLECTIONS['subtasks'], subtask_header, self._db_scope)
+            available_subtask_db = init_database(PAGE_COLLECTIONS['available_subtasks'], available_subtask_header, self._db_scope)
+            action_db = init_database(PAGE_COLLECTIONS['actions'], action_header, self._db_scope)
         else:
             # 使用本地CSV文件
-            self.subtask_db = read_dataframe_csv(self.subtask_db_path, subtask_header, task_name=task_name, page_index=page_index)
-            self.available_subtask_db = read_dataframe_csv(self.available_subtask_db_path, available_subtask_header, task_name=task_name, page_index=page_index)
-            self.action_db = read_dataframe_csv(self.action_db_path, action_header, task_name=task_name, page_index=page_index)
+            subtask_db = read_dataframe_csv(self.subtask_db_path, subtask_header, task_name=task_name, page_index=page_index)
+            available_subtask_db = read_dataframe_csv(self.available_subtask_db_path, available_subtask_header, task_name=task_name, page_index=page_index)
+            action_db = read_dataframe_csv(self.action_db_path, action_header, task_name=task_name, page_index=page_index)
 
         # 确保动作数据正确加载
-        if self.action_db.empty:
+        if action_db.empty:
             log(f"⚠️ 页面{page_index}动作数据库为空，尝试重新加载", "yellow")
             if not Config.ENABLE_DB:
                 # 再次尝试从CSV加载
                 try:
-                    self.action_db = read_dataframe_csv(self.action_db_path, action_header, task_name=task_name, page_index=page_index)
+                    action_db = read_dataframe_csv(self.action_db_path, action_header, task_name=task_name, page_index=page_index)
                 except Exception as e:
                     log(f"⚠️ 无法从CSV加载动作数据: {e}", "yellow")
-                    self.action_db = pd.DataFrame(columns=action_header)
+                    action_db = pd.DataFrame(columns=action_header)
 
-        self.action_data = self.action_db.to_dict(orient='records')
+        page = PageData(version, subtask_db, available_subtask_db, action_db)
+        log(f"📊 页面{page_index}动作数据加载: 动作数量={len(page.action_records)}, 数据源={'MongoDB' if Config.ENABLE_DB else 'CSV'}, 版本={version}", "cyan")
+        return page
 
-        # 添加traversed标记
-        for action in self.action_data:
-            action['traversed'] = False
-            
-        log(f"📊 页面{page_index}动作数据加载: 动作数量={len(self.action_data)}, 数据源={'MongoDB' if Config.ENABLE_DB else 'CSV'}", "cyan")
+    def _page(self) -> PageData:
+        return page_cache.get(self._cache_key, self._load)
+
+    def _invalidate(self) -> None:
+        page_cache.invalidate(self._cache_key)
+
+    @property
+    def subtask_db(self) -> pd.DataFrame:
+        return self._page().subtask_db
+
+    @property
+    def available_subtask_db(self) -> pd.DataFrame:
+        return self._page().available_subtask_db
+
+    @property
+    def action_db(self) -> pd.DataFrame:
+        return self._page().action_db
+
+    def _iter_actions(self):
+        """按顺序返回 (共享动作记录, 本会话是否已遍历)；相同签名的动作中前 N 条视为已遍历"""
+        seen: Dict[tuple, int] = {}
+        for record in self._page().action_records:
+            signature = _action_signature(record)
+            occurrence = seen.get(signature, 0)
+            seen[signature] = occurrence + 1
+            yield record, occurrence < self._traversed.get(signature, 0)
+
+    def _mark_traversed(self, action: dict) -> None:
+        signature = _action_signature(action)
+        self._traversed[signature] = self._traversed.get(signature, 0) + 1
+
+    @property
+    def action_data(self) -> List[dict]:
+        """动作列表（带本会话的 traversed 标记）的副本"""
+        return [dict(record, traversed=traversed) for record, traversed in self._iter_actions()]
 
     def get_available_subtasks(self):
         return self.available_subtask_db.to_dict(orient='records')
 
+    def save_available_subtasks(self, available_subtasks: list) -> None:
+        """新页面的初始可用子任务（Memory.add_node 调用）"""
+        available_subtask_db = pd.DataFrame(available_subtasks)
+        save_dataframe(PAGE_COLLECTIONS['available_subtasks'], available_subtask_db, deferred=True, scope=self._db_scope)
+        write_dataframe_csv(self.available_subtask_db_path, available_subtask_db, task_name=self.task_name, page_index=self.page_index, deferred=True)
+        self._invalidate()
+
     def add_new_action(self, new_action):
-        self.available_subtask_db = pd.concat([self.available_subtask_db, pd.DataFrame([new_action])], ignore_index=True)
-        save_dataframe(self.available_subtask_db_path, self.available_subtask_db)
-        write_dataframe_csv(self.available_subtask_db_path, self.available_subtask_db, task_name=self.task_name, page_index=self.page_index)
+        available_subtask_db = pd.concat([self.available_subtask_db, pd.DataFrame([new_action])], ignore_index=True)
+        save_dataframe(PAGE_COLLECTIONS['available_subtasks'], available_subtask_db, deferred=True, scope=self._db_scope)
+        write_dataframe_csv(self.available_subtask_db_path, available_subtask_db, task_name=self.task_name, page_index=self.page_index, deferred=True)
+        self._invalidate()
 
     def save_subtask(self, subtask_raw: dict, example: dict):
         # 检查是否已存在
@@ -86,12 +146,9 @@ class PageManager:
 
         # 使用批量操作优化
         from utils.mongo_utils import append_one
-        append_one(self.subtask_db_path, subtask_data)
+        append_one(PAGE_COLLECTIONS['subtasks'], subtask_data, deferred=True, scope=self._db_scope)
         append_one_csv(self.subtask_db_path, subtask_data, task_name=self.task_name, page_index=self.page_index)
-        
-        # 更新内存中的DataFrame
-        new_row = pd.DataFrame([subtask_data])
-        self.subtask_db = pd.concat([self.subtask_db, new_row], ignore_index=True)
+        self._invalidate()
         log("added new subtask to the database")
 
     def get_next_subtask_data(self, subtask_name: str) -> dict:
@@ -130,35 +187,25 @@ class PageManager:
 
         # 使用批量操作优化
         from utils.mongo_utils import append_one
-        append_one(self.action_db_path, new_action_db)
+        append_one(PAGE_COLLECTIONS['actions'], new_action_db, deferred=True, scope=self._db_scope)
         append_one_csv(self.action_db_path, new_action_db, task_name=self.task_name, page_index=self.page_index)
+        self._invalidate()
 
-        # 更新内存中的DataFrame
-        new_row = pd.DataFrame([new_action_db])
-        self.action_db = pd.concat([self.action_db, new_row], ignore_index=True)
-
-        # Append to action data 同步更新内存中的动作列表（添加"traversed"标记，标记为已执行）
-        new_action_data = {
-            "subtask_name": subtask_name,
-            'step': step,
-            "action": json.dumps(action),
-            "example": json.dumps(example),
-            "traversed": True
-        }
-        self.action_data.append(new_action_data)
+        # 新动作对本会话视为已执行（traversed=True），其他会话重新加载后看到的是未遍历状态
+        self._mark_traversed(new_action_db)
 
     def get_next_action(self, subtask: dict, screen: str, step: int):
         # 步骤1：获取当前子任务名（如"click_send_button"）
         curr_subtask_name = subtask['name']
         examples = []
-        log(f"🔍 动作匹配检查: 子任务='{curr_subtask_name}', 步骤={step}, 历史动作数量={len(self.action_data)}", "blue")
+        log(f"🔍 动作匹配检查: 子任务='{curr_subtask_name}', 步骤={step}, 历史动作数量={len(self._page().action_records)}", "blue")
         
-        # 步骤2：遍历内存中的动作列表，查找匹配的动作
-        for action_data in self.action_data:
-            # 匹配条件：1. 关联的子任务名一致；2. 动作步骤一致；3. 未被执行过（traversed=False）
+        # 步骤2：遍历共享的动作列表，查找匹配的动作
+        for action_data, traversed in self._iter_actions():
+            # 匹配条件：1. 关联的子任务名一致；2. 动作步骤一致；3. 本会话未执行过（traversed=False）
             if action_data.get("subtask_name", "") == curr_subtask_name and action_data.get("step") == step:
-                if not action_data.get("traversed", False):
-                    action_data['traversed'] = True
+                if not traversed:
+                    self._mark_traversed(action_data)
                     next_base_action = json.loads(action_data.get("action")) #action："{""name"": ""click"", ""parameters"": {""index"": 40, ""description"": ""Create contact""}}"
                     examples.append(json.loads(action_data.get("example")))
 
@@ -180,14 +227,17 @@ class PageManager:
         return None
 
     def update_subtask_info(self, subtask) -> None:
-        condition = (self.subtask_db['name'] == subtask['name'])
+        # 缓存中的 DataFrame 为共享只读数据，先复制再修改
+        subtask_db = self.subtask_db.copy()
+        condition = (subtask_db['name'] == subtask['name'])
         if condition.any():
-            self.subtask_db.loc[condition, 'name'] = subtask['name']
-            self.subtask_db.loc[condition, 'description'] = subtask['description']
-            self.subtask_db.loc[condition, 'parameters'] = json.dumps(subtask['parameters'])
+            subtask_db.loc[condition, 'name'] = subtask['name']
+            subtask_db.loc[condition, 'description'] = subtask['description']
+            subtask_db.loc[condition, 'parameters'] = json.dumps(subtask['parameters'])
 
-            save_dataframe(self.subtask_db_path, self.subtask_db)
-            write_dataframe_csv(self.subtask_db_path, self.subtask_db, task_name=self.task_name, page_index=self.page_index)
+            save_dataframe(PAGE_COLLECTIONS['subtasks'], subtask_db, deferred=True, scope=self._db_scope)
+            write_dataframe_csv(self.subtask_db_path, subtask_db, task_name=self.task_name, page_index=self.page_index, deferred=True)
+            self._invalidate()
 
     def merge_subtask_into(self, base_subtask_name, prev_subtask_name, target_subtask_name):
         actions = self.action_db.to_dict(orient="records")
@@ -206,23 +256,26 @@ class PageManager:
                 action['subtask_name'] = base_subtask_name
                 action['step'] = starting_step + action['step']
 
-        self.action_db = pd.DataFrame(actions)
-        save_dataframe(self.action_db_path, self.action_db)
-        write_dataframe_csv(self.action_db_path, self.action_db, task_name=self.task_name, page_index=self.page_index)
+        action_db = pd.DataFrame(actions)
+        save_dataframe(PAGE_COLLECTIONS['actions'], action_db, deferred=True, scope=self._db_scope)
+        write_dataframe_csv(self.action_db_path, action_db, task_name=self.task_name, page_index=self.page_index, deferred=True)
+        self._invalidate()
     def delete_subtask(self, subtask_name):
         """
         仅根据子任务名称删除数据
         """
         # 1. 删除subtask_db中名称匹配的记录
         # 筛选条件：仅匹配子任务名称
-        subtask_condition = (self.subtask_db['name'] == subtask_name)
+        subtask_db = self.subtask_db
+        subtask_condition = (subtask_db['name'] == subtask_name)
 
         if subtask_condition.any():
             # 保留不满足条件的记录（即删除名称匹配的记录）
-            self.subtask_db = self.subtask_db[~subtask_condition]
+            subtask_db = subtask_db[~subtask_condition]
             # 持久化到CSV
-            save_dataframe(self.subtask_db_path, self.subtask_db)
-            write_dataframe_csv(self.subtask_db_path, self.subtask_db, task_name=self.task_name, page_index=self.page_index)
+            save_dataframe(PAGE_COLLECTIONS['subtasks'], subtask_db, deferred=True, scope=self._db_scope)
+            write_dataframe_csv(self.subtask_db_path, subtask_db, task_name=self.task_name, page_index=self.page_index, deferred=True)
+            self._invalidate()
             log(f"已删除子任务: {subtask_name} (共 {subtask_condition.sum()} 条记录)", "blue")
         else:
             log(f"未找到名称为 {subtask_name} 的子任务", "yellow")
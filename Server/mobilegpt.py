@@ -2,6 +2,10 @@ import json
 import os
 from enum import Enum
 import time
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
@@ -13,6 +17,17 @@ from log_config import log
 from utils.utils import parse_completion_rate
 from utils.mongo_utils import load_dataframe, save_dataframe
 from utils.local_store import get_screen_bundle_dir
+from utils.blob_store import write_screen_bundle
+from screenParser.cache import get_screen
+from utils.parallel_ai import parallel_executor
+
+# __choose_subtask 的返回值：继续推导动作
+_CONTINUE = object()
+
+# 后台任务（页面持久化、推测预取）专用线程池：这些任务不会等待其他任务，
+# 与执行决策步骤的 parallel_executor 分开，避免决策线程等待后台结果时线程池耗尽而死锁
+_background_executor = ThreadPoolExecutor(max_workers=int(os.getenv("MOBILEGPT_BACKGROUND_WORKERS", "8")),
+                                          thread_name_prefix="mobilegpt-bg")
 
 
 class Status(Enum):
@@ -37,6 +52,8 @@ class MobileGPT:
         self.current_screen_xml = ""
         self.current_page_index = -1
         self.current_subtask_data = {}
+        # 保护 _local_buffer 的重标与取出（决策线程池、后台线程与消息处理线程都会访问）
+        self._buffer_lock = threading.RLock()
 
         self.subtask_history = []
         self.task_path = []
@@ -98,6 +115,93 @@ class MobileGPT:
 
     def get_next_action(self, parsed_xml=None, hierarchy_xml=None, encoded_xml=None, subtask_failed=False, action_failed=False, suggestions=None):
         log(":::::::::MobileGPT received new screen:::::::::", 'blue')
+        parsed_xml, hierarchy_xml, encoded_xml = self.__set_screen(parsed_xml, hierarchy_xml, encoded_xml)
+        # 检查当前界面是否匹配历史页面（调用内存的search_node方法）
+        page_index, new_subtasks = self.memory.search_node(parsed_xml, hierarchy_xml, encoded_xml)
+
+        # 若未匹配到历史页面（page_index == -1），调用ExploreAgent探索新界面
+        if page_index == -1:
+            page_index = self.explore_agent.explore(parsed_xml, hierarchy_xml, encoded_xml)
+
+        # 若页面索引变化（进入新页面），初始化页面管理器并结束当前子任务
+        if page_index != self.current_page_index:
+            self.__enter_page(page_index)
+            self.__persist_page(hierarchy_xml, page_index)
+
+            if self.subtask_status == Status.LEARN:
+                self.__finish_subtask()
+
+        result = self.__choose_subtask(page_index, new_subtasks, encoded_xml, subtask_failed, suggestions)
+        if result is not _CONTINUE:
+            return result
+
+        next_action, recurse = self.__derive_next_action(action_failed, suggestions)
+        if recurse:
+            return self.get_next_action(parsed_xml, hierarchy_xml, encoded_xml)
+        return next_action
+
+    async def get_next_action_optimized(self, parsed_xml=None, hierarchy_xml=None, encoded_xml=None, subtask_failed=False, action_failed=False, suggestions=None):
+        """
+        get_next_action 的并行版本，运行在服务器共享事件循环上（阻塞调用均交给线程池），决策逻辑与串行版本一致：
+        - 进入新页面时，缓冲重标与层级持久化在结束子任务前完成；截图/XML 写盘在后台执行，与结束子任务/选择子任务并行，在任何递归或返回前等待其完成
+        - SelectAgent 运行期间，按本页历史选择示例预测子任务并推测预取 derive 请求；预测错误则丢弃
+        """
+        loop = asyncio.get_running_loop()
+        executor = parallel_executor.executor
+
+        def run(func, *args):
+            # 带上当前上下文（写后队列的会话归属），run_in_executor 默认不传递
+            return loop.run_in_executor(executor, contextvars.copy_context().run, func, *args)
+
+        log(":::::::::MobileGPT received new screen (optimized):::::::::", 'blue')
+        parsed_xml, hierarchy_xml, encoded_xml = self.__set_screen(parsed_xml, hierarchy_xml, encoded_xml)
+        page_index, new_subtasks = await run(self.memory.search_node, parsed_xml, hierarchy_xml, encoded_xml)
+
+        if page_index == -1:
+            page_index = await run(self.explore_agent.explore, parsed_xml, hierarchy_xml, encoded_xml)
+
+        persist = None
+        if page_index != self.current_page_index:
+            # 缓冲重标/取出与层级写入在结束子任务前完成，只把截图/XML 写盘放到后台
+            writes = []
+            await run(self.__enter_page, page_index, writes)
+            await run(self.__persist_page, hierarchy_xml, page_index, writes)
+            if writes:
+                persist = _background_executor.submit(contextvars.copy_context().run, self.__write_screen_pairs, writes)
+
+            if self.subtask_status == Status.LEARN:
+                await run(self.__finish_subtask)
+
+        def wait_persist():
+            if persist is not None:
+                persist.result()
+
+        def speculative_select(available_subtasks, subtask_history, qa_history, screen, failed, select_suggestions):
+            predicted = None if action_failed else self.__predict_subtask(available_subtasks)
+            if predicted is not None:
+                self.derive_agent.prefetch(predicted, subtask_history, screen, _background_executor)
+            response, new_action = self.select_agent.select(available_subtasks, subtask_history, qa_history,
+                                                            screen, failed, select_suggestions)
+            if predicted is not None and response.get('action') != predicted:
+                self.derive_agent.discard_prefetch()
+            return response, new_action
+
+        try:
+            result = await run(self.__choose_subtask, page_index, new_subtasks, encoded_xml, subtask_failed,
+                               suggestions, speculative_select, wait_persist)
+            if result is not _CONTINUE:
+                return result
+            next_action, recurse = await run(self.__derive_next_action, action_failed, suggestions)
+        finally:
+            self.derive_agent.discard_prefetch()
+            if persist is not None:
+                await asyncio.wrap_future(persist)
+
+        if recurse:
+            return await self.get_next_action_optimized(parsed_xml, hierarchy_xml, encoded_xml)
+        return next_action
+
+    def __set_screen(self, parsed_xml, hierarchy_xml, encoded_xml):
         parsed_xml = parsed_xml or self.parsed_xml
         hierarchy_xml = hierarchy_xml or self.hierarchy_xml
         encoded_xml = encoded_xml or self.encoded_xml
@@ -107,17 +211,12 @@ class MobileGPT:
         self.encoded_xml = encoded_xml
 
         self.current_screen_xml = encoded_xml
-        # 检查当前界面是否匹配历史页面（调用内存的search_node方法）
-        page_index, new_subtasks = self.memory.search_node(parsed_xml, hierarchy_xml, encoded_xml)
-
-        # 若未匹配到历史页面（page_index == -1），调用ExploreAgent探索新界面
-        if page_index == -1:
-            page_index = self.explore_agent.explore(parsed_xml, hierarchy_xml, encoded_xml)
+        return parsed_xml, hierarchy_xml, encoded_xml
 
-        # 若页面索引变化（进入新页面），初始化页面管理器并结束当前子任务
-        if page_index != self.current_page_index:
-            # 页面切换前先尝试将上一页的数据写入上一页目录，避免错位
-            try:
+    def __enter_page(self, page_index: int, writes=None) -> None:
+        # 页面切换前先尝试将上一页的数据写入上一页目录，避免错位
+        try:
+            with self._buffer_lock:
                 if self.current_page_index is not None and self.current_page_index >= 0:
                     buf = getattr(self, '_local_buffer', None)
                     if buf:
@@ -150,23 +249,26 @@ class MobileGPT:
                             pass
                         # 无论是否存在共同索引，均尝试按页面落盘上一页
                         log(f"[debug] 尝试flush上一页 page={self.current_page_index}，缓冲状态: shots={len(buf.get('shots', []))}, xmls={len(buf.get('xmls', []))}", "cyan")
-                        self.__flush_buffer_to_page(self.current_page_index)
-            except Exception:
-                pass
-            self.memory.init_page_manager(page_index)
-            self.current_page_index = page_index
-            try:
-                # 确保每个新页面的层级信息都被持久化（存在则更新，不存在则追加）
-                # 这样不依赖于是否走到了 Explore 分支
-                self.memory.add_hierarchy_xml(hierarchy_xml, page_index)
-            except Exception:
-                pass
-            # 切到新页后再记录当前页缓冲概况
+                        self.__flush_buffer_to_page(self.current_page_index, writes)
+        except Exception:
+            pass
+        self.memory.init_page_manager(page_index)
+        self.current_page_index = page_index
+
+    def __persist_page(self, hierarchy_xml: str, page_index: int, writes=None) -> None:
+        try:
+            # 确保每个新页面的层级信息都被持久化（存在则更新，不存在则追加）
+            # 这样不依赖于是否走到了 Explore 分支
+            self.memory.add_hierarchy_xml(hierarchy_xml, page_index)
+        except Exception:
+            pass
+        # 切到新页后再记录当前页缓冲概况
+        try:
+            task_name = getattr(getattr(self, 'memory', None), 'task_name', 'task') or 'task'
+            buf = getattr(self, '_local_buffer', None)
+            # 首次识别到新页面时，将未标记页的项(-1/None)统一标到当前页，并尝试立即落盘当前页
             try:
-                task_name = getattr(getattr(self, 'memory', None), 'task_name', 'task') or 'task'
-                buf = getattr(self, '_local_buffer', None)
-                # 首次识别到新页面时，将未标记页的项(-1/None)统一标到当前页，并尝试立即落盘当前页
-                try:
+                with self._buffer_lock:
                     if buf:
                         unmarked_xmls = 0
                         unmarked_shots = 0
@@ -181,20 +283,20 @@ class MobileGPT:
                         if unmarked_xmls > 0 or unmarked_shots > 0:
                             log(f"[debug] 新页page={page_index}标记了 {unmarked_xmls}个XML, {unmarked_shots}个截图", "cyan")
                     log(f"[debug] 尝试flush新页 page={page_index}，缓冲状态: shots={len(buf.get('shots', []))}, xmls={len(buf.get('xmls', []))}", "cyan")
-                    self.__flush_buffer_to_page(page_index)
-                except Exception as e:
-                    log(f"[debug] 新页flush出错: {e}", "red")
-                    pass
-                xml_idx = sorted({it.get('index') for it in (buf.get('xmls') if buf else []) if 'index' in it})
-                shot_idx = sorted({it.get('index') for it in (buf.get('shots') if buf else []) if 'index' in it})
-                common = sorted(list(set(xml_idx).intersection(shot_idx)))
-                log(f"[page] now at curr={page_index}, task={task_name}, xml_idx={xml_idx}, shot_idx={shot_idx}, common={common}, dest_curr=memory/log/{task_name}/pages/{page_index}/screen", "blue")
-            except Exception:
+                    self.__flush_buffer_to_page(page_index, writes)
+            except Exception as e:
+                log(f"[debug] 新页flush出错: {e}", "red")
                 pass
+            xml_idx = sorted({it.get('index') for it in (buf.get('xmls') if buf else []) if 'index' in it})
+            shot_idx = sorted({it.get('index') for it in (buf.get('shots') if buf else []) if 'index' in it})
+            common = sorted(list(set(xml_idx).intersection(shot_idx)))
+            log(f"[page] now at curr={page_index}, task={task_name}, xml_idx={xml_idx}, shot_idx={shot_idx}, common={common}, dest_curr=memory/log/{task_name}/pages/{page_index}/screen", "blue")
+        except Exception:
+            pass
 
-            if self.subtask_status == Status.LEARN:
-                self.__finish_subtask()
-
+    def __choose_subtask(self, page_index, new_subtasks, encoded_xml, subtask_failed, suggestions, select=None, before_primitive=None):
+        """确定当前子任务；返回 _CONTINUE 表示继续推导动作，否则即为 get_next_action 的返回值"""
+        select = select or self.select_agent.select
         # 获取当前页面的可用子任务（含新生成的子任务）
         available_subtasks = self.memory.get_available_subtasks(page_index)
         if len(new_subtasks) > 0:
@@ -212,9 +314,9 @@ class MobileGPT:
             # 若内存中无可用子任务，调用SelectAgent从可用子任务中选择
             if not next_subtask:
                 # 调用SelectAgent.select：结合历史和当前界面选择子任务
-                response, new_action = self.select_agent.select(available_subtasks, self.subtask_history,
-                                                                self.qa_history,
-                                                                encoded_xml, subtask_failed, suggestions)
+                response, new_action = select(available_subtasks, self.subtask_history,
+                                              self.qa_history,
+                                              encoded_xml, subtask_failed, suggestions)
                 # 若生成了新动作，添加到内存（供后续复用）
                 if new_action:
                     self.memory.add_new_action(new_action, page_index)
@@ -238,8 +340,14 @@ class MobileGPT:
             self.current_subtask = next_subtask  # 更新当前子任务
 
             if next_subtask['name'] in ['finish', 'speak']:  # 移除 'scroll_screen'
+                if before_primitive is not None:
+                    before_primitive()
                 return self.__handle_primitive_subtask(next_subtask)
 
+        return _CONTINUE
+
+    def __derive_next_action(self, action_failed, suggestions):
+        """推导当前子任务的下一步动作；返回 (动作, 是否需要重新调用 get_next_action)"""
         subtask_parameters = self.current_subtask['parameters']
         # for key, value in subtask_parameters.items():
         #     if value == "unknown":
@@ -290,20 +398,46 @@ class MobileGPT:
             elif self.subtask_status == Status.RECALL:
                 log(f"⚠️ 任务分歧: 回忆模式但无历史动作，重新选择子任务", "yellow")
                 self.__prepare_diverge_subtask()
-                return self.get_next_action(parsed_xml, hierarchy_xml, encoded_xml)
+                return None, True
         # 记录当前动作到子任务数据
         self.current_subtask_data['actions'].append(current_action_data)
 
         # 若动作是“finish”，结束当前子任务并继续获取下一步
         if next_action['name'] == 'finish':
             self.__finish_subtask(mark_finish=False, explicit_finish=True)
-            next_action = self.get_next_action(parsed_xml, hierarchy_xml, encoded_xml)
+            return next_action, True
         # 返回生成的下一步动作
-        return next_action
+        return next_action, False
 
-    def __flush_buffer_to_page(self, page_index: int) -> None:
+    def __predict_subtask(self, available_subtasks: list):
+        """按本页已保存的选择示例预测 SelectAgent 将选出的子任务（仅预测尚未学习过动作的子任务），无法预测时返回 None"""
+        page_manager = self.memory.page_manager
+        if page_manager is None or page_manager.subtask_db.empty:
+            return None
+        available = {subtask.get('name') for subtask in available_subtasks}
+        executed = {data.get('subtask_name') for data in self.task_path + [self.current_subtask_data]
+                    if data and data.get('page_index') == self.current_page_index}
+        learned = {data.get('subtask_name') for data in page_manager.action_data if data.get('step') == 0}
+        for row in page_manager.subtask_db.to_dict(orient='records'):
+            name = row.get('name')
+            if name not in available or name in executed or name in learned:
+                continue
+            try:
+                action = json.loads(row.get('example') or '{}').get('response', {}).get('action')
+            except Exception:
+                continue
+            if isinstance(action, dict) and action.get('name') == name:
+                return action
+        return None
+
+    def __flush_buffer_to_page(self, page_index: int, writes=None) -> None:
         """将缓冲中所有属于指定页面的(shot+xml)对写入对应页面的 screen 目录。
-        优先按 page_index 配对；仅在双方都无 page_index 标签时，才回退按 index 配对。"""
+        优先按 page_index 配对；仅在双方都无 page_index 标签时，才回退按 index 配对。
+        writes 不为 None 时只从缓冲中取出配对，写盘参数追加到 writes，由调用方在后台执行 __write_screen_pairs。"""
+        with self._buffer_lock:
+            self.__pair_buffer_for_page(page_index, writes)
+
+    def __pair_buffer_for_page(self, page_index: int, writes=None) -> None:
         buf = getattr(self, '_local_buffer', None)
         if not buf or (not buf.get('xmls') or not buf.get('shots')):
             return
@@ -334,54 +468,10 @@ class MobileGPT:
             task_name = getattr(getattr(self, 'memory', None), 'task_name', 'task') or 'task'
             dest_dir = get_screen_bundle_dir(task_name, target_page)
 
-            try:
-                import os
-                shot_bytes = shot_item.get('bytes', b'')
-                screenshot_path = os.path.join(dest_dir, 'screenshot.jpg')
-                with open(screenshot_path, 'wb') as f:
-                    f.write(shot_bytes)
-                log(f"[flush] wrote screenshot idx={shot_item.get('index')} -> {screenshot_path} ({len(shot_bytes)} bytes)", "blue")
-            except Exception as e:
-                log(f"[flush] write screenshot failed (page={page_index}): {e}", "red")
-                continue
-
-            raw_xml = xml_item.get('xml', '')
-            try:
-                from screenParser import parseXML
-                import xml.etree.ElementTree as ET
-                import xml.dom.minidom as minidom
-                parsed = parseXML.parse(raw_xml)
-                hierarchy = parseXML.hierarchy_parse(parsed)
-                tree = ET.fromstring(parsed)
-                for element in tree.iter():
-                    for k in ("bounds", "important", "class"):
-                        if k in element.attrib:
-                            del element.attrib[k]
-                encoded = ET.tostring(tree, encoding='unicode')
-                pretty = minidom.parseString(encoded).toprettyxml()
-
-                import os
-                os.makedirs(dest_dir, exist_ok=True)
-                with open(os.path.join(dest_dir, 'raw.xml'), 'w', encoding='utf-8') as f:
-                    f.write(raw_xml)
-                with open(os.path.join(dest_dir, 'parsed.xml'), 'w', encoding='utf-8') as f:
-                    f.write(parsed)
-                with open(os.path.join(dest_dir, 'hierarchy.xml'), 'w', encoding='utf-8') as f:
-                    f.write(hierarchy)
-                with open(os.path.join(dest_dir, 'html.xml'), 'w', encoding='utf-8') as f:
-                    f.write(encoded)
-                with open(os.path.join(dest_dir, 'pretty.xml'), 'w', encoding='utf-8') as f:
-                    f.write(pretty)
-                log(f"[flush] wrote xmls idx={xml_item.get('index')} -> {dest_dir}/(raw|parsed|hierarchy|html|pretty).xml", "blue")
+            if writes is not None:
+                writes.append((dest_dir, xml_item, shot_item, page_index, ""))
+            elif self.__write_screen_pair(dest_dir, xml_item, shot_item, page_index):
                 flushed_count += 1
-            except Exception as e:
-                try:
-                    import os
-                    with open(os.path.join(dest_dir, 'raw.xml'), 'w', encoding='utf-8') as f:
-                        f.write(raw_xml)
-                except Exception:
-                    pass
-                log(f"[flush] write xml failed (page={page_index}): {e}", "red")
 
         # 2) 兜底：仅针对仍未打 page_index 的项，按 index 相同进行配对
         xml_indices = {it.get('index') for it in buf['xmls'] if 'index' in it and it.get('page_index') is None}
@@ -405,58 +495,49 @@ class MobileGPT:
             task_name = getattr(getattr(self, 'memory', None), 'task_name', 'task') or 'task'
             dest_dir = get_screen_bundle_dir(task_name, target_page)
 
-            try:
-                import os
-                shot_bytes = shot_item.get('bytes', b'')
-                screenshot_path = os.path.join(dest_dir, 'screenshot.jpg')
-                with open(screenshot_path, 'wb') as f:
-                    f.write(shot_bytes)
-                log(f"[flush] wrote screenshot (fallback) -> {screenshot_path} ({len(shot_bytes)} bytes)", "blue")
-            except Exception as e:
-                log(f"[flush] write screenshot failed (fallback, page={page_index}): {e}", "red")
-                continue
-
-            raw_xml = xml_item.get('xml', '')
-            try:
-                from screenParser import parseXML
-                import xml.etree.ElementTree as ET
-                import xml.dom.minidom as minidom
-                parsed = parseXML.parse(raw_xml)
-                hierarchy = parseXML.hierarchy_parse(parsed)
-                tree = ET.fromstring(parsed)
-                for element in tree.iter():
-                    for k in ("bounds", "important", "class"):
-                        if k in element.attrib:
-                            del element.attrib[k]
-                encoded = ET.tostring(tree, encoding='unicode')
-                pretty = minidom.parseString(encoded).toprettyxml()
-
-                import os
-                os.makedirs(dest_dir, exist_ok=True)
-                with open(os.path.join(dest_dir, 'raw.xml'), 'w', encoding='utf-8') as f:
-                    f.write(raw_xml)
-                with open(os.path.join(dest_dir, 'parsed.xml'), 'w', encoding='utf-8') as f:
-                    f.write(parsed)
-                with open(os.path.join(dest_dir, 'hierarchy.xml'), 'w', encoding='utf-8') as f:
-                    f.write(hierarchy)
-                with open(os.path.join(dest_dir, 'html.xml'), 'w', encoding='utf-8') as f:
-                    f.write(encoded)
-                with open(os.path.join(dest_dir, 'pretty.xml'), 'w', encoding='utf-8') as f:
-                    f.write(pretty)
-                log(f"[flush] wrote xmls (fallback) -> {dest_dir}/(raw|parsed|hierarchy|html|pretty).xml", "blue")
+            if writes is not None:
+                writes.append((dest_dir, xml_item, shot_item, page_index, "fallback"))
+            elif self.__write_screen_pair(dest_dir, xml_item, shot_item, page_index, label="fallback"):
                 flushed_count += 1
-            except Exception as e:
-                try:
-                    import os
-                    with open(os.path.join(dest_dir, 'raw.xml'), 'w', encoding='utf-8') as f:
-                        f.write(raw_xml)
-                except Exception:
-                    pass
-                log(f"[flush] write xml failed (fallback, page={page_index}): {e}", "red")
 
         if flushed_count > 0:
             log(f"[flush] flushed {flushed_count} pairs to page {page_index}", "green")
 
+    def __write_screen_pairs(self, writes) -> None:
+        """执行 __flush_buffer_to_page 延迟的写盘（只涉及截图/XML 文件，不访问缓冲与记忆）"""
+        flushed = {}
+        for dest_dir, xml_item, shot_item, page_index, label in writes:
+            if self.__write_screen_pair(dest_dir, xml_item, shot_item, page_index, label=label):
+                flushed[page_index] = flushed.get(page_index, 0) + 1
+        for page_index, count in flushed.items():
+            log(f"[flush] flushed {count} pairs to page {page_index}", "green")
+
+    def __write_screen_pair(self, dest_dir: str, xml_item: dict, shot_item: dict, page_index: int, label: str = "") -> bool:
+        """截图与 XML 各视图写入内容寻址仓库，并在页面 screen 目录的清单中追加引用；XML 解析成功时返回 True"""
+        suffix = f" ({label})" if label else ""
+        raw_xml = xml_item.get('xml', '')
+        parsed_ok = True
+        try:
+            screen = get_screen(raw_xml)
+            parsed, hierarchy, encoded = screen.encode()
+            views = {'raw': raw_xml, 'parsed': parsed, 'hierarchy': hierarchy, 'html': encoded,
+                     'pretty': screen.pretty_xml}
+        except Exception as e:
+            # 解析失败时仍保留原始 XML
+            views = {'raw': raw_xml}
+            parsed_ok = False
+            log(f"[flush] parse xml failed{suffix} (page={page_index}): {e}", "red")
+        try:
+            shot_bytes = shot_item.get('bytes', b'')
+            record = write_screen_bundle(dest_dir, shot_bytes, views, index=xml_item.get('index'),
+                                         page_index=page_index)
+            log(f"[flush] wrote screen bundle{suffix} idx={xml_item.get('index')} -> {dest_dir}/manifest.jsonl "
+                f"(screenshot={str(record.get('screenshot', ''))[:12]}, {len(shot_bytes)} bytes)", "blue")
+        except Exception as e:
+            log(f"[flush] write screen bundle failed{suffix} (page={page_index}): {e}", "red")
+            return False
+        return parsed_ok
+
     def set_qa_answer(self, info_name: str, question: str, answer: str):
         qa = {"info": info_name, "question": question, "answer": answer}
         self.qa_history.append(qa)
@@ -0,0 +1,409 @@
+"""
+录制回放压测工具：不需要手机与 DashScope，测量流水线中非模型部分的耗时。
+
+录制（正常启动服务器时开启）:
+    REPLAY_RECORD_FILE=memory/replay/session.jsonl python main.py
+
+回放录制文件:
+    python -m replay.bench memory/replay/session.jsonl
+
+用仓库根目录的 0_*.xml 与 requests.jsonl 合成语料回放:
+    python -m replay.bench --synthesize 5 --screens 3
+
+回放时服务器运行在本机随机端口，使用临时 MEMORY_DIRECTORY 且不连接 MongoDB；
+模型请求由 replay.stub.ReplayClient 按录制内容应答，未录制的请求返回确定性兜底响应。
+报告各阶段（parse / embed / search / explore / select / derive / persist）与端到端每帧耗时。
+"""
+
+import argparse
+import functools
+import glob
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(SERVER_DIR)
+
+# 需要等待服务器回复的消息类型
+_REPLY_TYPES = ('xml', 'qa', 'error')
+_LEGACY_TYPES = {'instruction': 'I', 'xml': 'X', 'screenshot': 'S', 'qa': 'A', 'error': 'E', 'get_actions': 'G'}
+
+
+class StageTimer:
+    """包装类方法并累计每次调用耗时（毫秒）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+
+    def add(self, stage: str, elapsed_ms: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, []).append(elapsed_ms)
+
+    def wrap(self, owner, attr: str, stage: str) -> None:
+        original = getattr(owner, attr)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(stage, (time.perf_counter() - start) * 1000.0)
+
+        setattr(owner, attr, timed)
+
+    def summary(self) -> Dict[str, dict]:
+        result = {}
+        with self._lock:
+            items = {stage: sorted(values) for stage, values in self.samples.items()}
+        for stage, values in items.items():
+            n = len(values)
+            result[stage] = {
+                'count': n,
+                'total_ms': round(sum(values), 3),
+                'mean_ms': round(sum(values) / n, 3),
+                'p50_ms': round(values[int(0.50 * (n - 1))], 3),
+                'p95_ms': round(values[int(0.95 * (n - 1))], 3),
+                'max_ms': round(values[-1], 3),
+            }
+        return result
+
+
+def install_stage_timers(timer: StageTimer) -> None:
+    from screenParser.pipeline import ScreenPipeline
+    from utils.embedder import MicroBatchEmbedder
+    from memory.memory_manager import Memory
+    from agents.explore_agent import ExploreAgent
+    from agents.select_agent import SelectAgent
+    from agents.derive_agent import DeriveAgent
+    from mobilegpt import MobileGPT
+
+    timer.wrap(ScreenPipeline, 'encode', 'parse')
+    timer.wrap(MicroBatchEmbedder, 'embed', 'embed')
+    timer.wrap(MicroBatchEmbedder, 'embed_many', 'embed')
+    timer.wrap(Memory, 'search_node', 'search')
+    timer.wrap(ExploreAgent, 'explore', 'explore')
+    timer.wrap(SelectAgent, 'select', 'select')
+    timer.wrap(DeriveAgent, 'derive', 'derive')
+    timer.wrap(MobileGPT, '_MobileGPT__persist_page', 'persist')
+
+
+def encode_frame(message: dict) -> bytes:
+    """按客户端的线格式编码一条消息（旧格式 I/X/S/A/E/G，其余走 JSON 格式）"""
+    message_type = message.get('messageType', '')
+    code = _LEGACY_TYPES.get(message_type)
+    if code == 'I':
+        return b'I' + message.get('instruction', '').encode('utf-8') + b'\n'
+    if code == 'A':
+        return b'A' + message.get('qa', '').encode('utf-8') + b'\n'
+    if code == 'G':
+        return b'G'
+    if code in ('X', 'S', 'E'):
+        payload = {'X': message.get('xml', ''), 'S': message.get('screenshot', b''),
+                   'E': message.get('error', '')}[code]
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return code.encode() + str(len(payload)).encode() + b'\n' + payload
+    payload = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    return b'J' + str(len(payload)).encode() + b'\n' + payload
+
+
+def is_terminal_reply(line: str) -> bool:
+    """speak 只是过程播报，其余回复（动作 / ask / $$$$$）视为本帧处理完成"""
+    if line == '$$$$$':
+        return True
+    try:
+        reply = json.loads(line)
+    except ValueError:
+        return True
+    return not (isinstance(reply, dict) and reply.get('name') == 'speak')
+
+
+class ReplayConnection:
+    """模拟手机客户端的一条连接"""
+
+    def __init__(self, host: str, port: int):
+        self._sock = socket.create_connection((host, port))
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._reader = threading.Thread(target=self._read, name="replay-reader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        stream = self._sock.makefile('rb')
+        try:
+            for raw in stream:
+                self._lines.put(raw.decode('utf-8', errors='replace').strip())
+        except OSError:
+            pass
+        finally:
+            self._lines.put(None)
+
+    def send(self, message: dict) -> None:
+        self._sock.sendall(encode_frame(message))
+
+    def wait_reply(self, timeout: float) -> Tuple[bool, List[str]]:
+        """等待直到收到终止性回复；返回 (是否按时收到, 收到的所有行)"""
+        deadline = time.monotonic() + timeout
+        lines = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, lines
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                return False, lines
+            if line is None:
+                return False, lines
+            if not line:
+                continue
+            lines.append(line)
+            if is_terminal_reply(line):
+                return True, lines
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+def sessions_from_recording(events: List[dict]) -> List[List[dict]]:
+    from replay.recorder import decode_message
+
+    sessions: Dict[str, List[dict]] = {}
+    for event in events:
+        if event.get('event') == 'frame':
+            sessions.setdefault(event.get('session'), []).append(decode_message(event['message']))
+    return list(sessions.values())
+
+
+def _to_raw_node(element: ET.Element) -> ET.Element:
+    """把解析后的 HTML 风格元素还原为无障碍服务 dump 的 <node> 格式"""
+    attrib = {'class': element.get('class', element.tag)}
+    text = element.get('text') or (element.text or '').strip()
+    for key, value in (('resource-id', element.get('id')), ('text', text),
+                       ('content-desc', element.get('description')), ('bounds', element.get('bounds')),
+                       ('index', element.get('index')), ('important', element.get('important'))):
+        if value:
+            attrib[key] = value
+    if element.tag == 'button':
+        attrib['clickable'] = 'true'
+    elif element.tag == 'checker':
+        attrib['checkable'] = 'true'
+        attrib['checked'] = element.get('checked', 'false')
+    elif element.tag == 'scroll':
+        attrib['scrollable'] = 'true'
+    node = ET.Element('node', attrib)
+    for child in element:
+        node.append(_to_raw_node(child))
+    return node
+
+
+def load_fixture_screens(fixtures_dir: str) -> List[str]:
+    """读取 0_*.xml；只有带 bounds 的解析结果（如 0_parsed.xml）能还原为原始 XML"""
+    screens = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, '0_*.xml'))):
+        try:
+            root = ET.parse(path).getroot()
+        except ET.ParseError:
+            continue
+        if root.get('bounds') is None:
+            continue
+        hierarchy = ET.Element('hierarchy', {'rotation': '0'})
+        hierarchy.append(_to_raw_node(root))
+        screens.append(ET.tostring(hierarchy, encoding='unicode'))
+    return screens
+
+
+def load_instructions(path: str) -> List[str]:
+    instructions = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    title = json.loads(line).get('title')
+                except ValueError:
+                    continue
+                if title:
+                    instructions.append(title)
+    return instructions or ["replay task"]
+
+
+def synthesize_sessions(count: int, screens_per_session: int, fixtures_dir: str, instructions_path: str) -> List[List[dict]]:
+    screens = load_fixture_screens(fixtures_dir)
+    if not screens:
+        raise SystemExit(f"在 {fixtures_dir} 中没有可用的 0_*.xml 屏幕样本")
+    instructions = load_instructions(instructions_path)
+    sessions = []
+    for i in range(count):
+        frames = [{'messageType': 'instruction', 'instruction': instructions[i % len(instructions)]}]
+        for j in range(screens_per_session):
+            frames.append({'messageType': 'xml', 'xml': screens[(i + j) % len(screens)]})
+        sessions.append(frames)
+    return sessions
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode: str, port: int):
+    """在后台线程中启动服务器（只监听 127.0.0.1）"""
+    if mode == 'asyncio':
+        from async_server import AsyncServer
+        server = AsyncServer(host='127.0.0.1', port=port)
+        threading.Thread(target=server.open, name="replay-server", daemon=True).start()
+    else:
+        from server import Server
+        server = Server(host='127.0.0.1', port=port)
+
+        def accept_loop():
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((server.host, server.port))
+            listener.listen()
+            while True:
+                client_socket, client_address = listener.accept()
+                session = server.session_manager.create_session(client_socket, client_address)
+                threading.Thread(target=server.handle_client_with_session, args=(session,),
+                                 name=f"Client-{session.session_id}", daemon=True).start()
+
+        threading.Thread(target=accept_loop, name="replay-server", daemon=True).start()
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit("回放服务器启动失败")
+
+
+def replay_session(port: int, frames: List[dict], timer: StageTimer, timeout: float, counters: dict) -> None:
+    connection = ReplayConnection('127.0.0.1', port)
+    try:
+        for message in frames:
+            message_type = message.get('messageType', '')
+            start = time.perf_counter()
+            connection.send(message)
+            counters['frames'] += 1
+            if message_type not in _REPLY_TYPES:
+                continue
+            ok, _ = connection.wait_reply(timeout)
+            if ok:
+                timer.add(f"e2e:{message_type}", (time.perf_counter() - start) * 1000.0)
+            else:
+                counters['timeouts'] += 1
+    finally:
+        connection.close()
+
+
+def format_report(stages: Dict[str, dict]) -> str:
+    header = f"{'stage':<14}{'count':>7}{'total_ms':>12}{'mean_ms':>10}{'p50_ms':>10}{'p95_ms':>10}{'max_ms':>10}"
+    rows = [header, '-' * len(header)]
+    for stage in sorted(stages):
+        s = stages[stage]
+        rows.append(f"{stage:<14}{s['count']:>7}{s['total_ms']:>12.1f}{s['mean_ms']:>10.2f}"
+                    f"{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['max_ms']:>10.2f}")
+    return "\n".join(rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MobileGPT 服务器录制回放压测")
+    parser.add_argument('recording', nargs='?', help="REPLAY_RECORD_FILE 录制的 JSONL 文件")
+    parser.add_argument('--synthesize', type=int, default=0, metavar='N',
+                        help="不使用录制文件，用 0_*.xml 与 requests.jsonl 合成 N 个会话")
+    parser.add_argument('--screens', type=int, default=3, help="合成会话中每个会话发送的屏幕数")
+    parser.add_argument('--fixtures-dir', default=REPO_ROOT, help="0_*.xml 所在目录")
+    parser.add_argument('--instructions', default=os.path.join(REPO_ROOT, 'requests.jsonl'),
+                        help="合成指令来源（JSONL，取 title 字段）")
+    parser.add_argument('--repeat', type=int, default=1, help="整个语料回放的轮数")
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread', help="服务器模式")
+    parser.add_argument('--llm-latency-ms', type=float, default=0.0, help="模型替身每次请求的模拟耗时")
+    parser.add_argument('--timeout', type=float, default=30.0, help="等待每帧回复的超时（秒）")
+    parser.add_argument('--memory-dir', help="回放使用的 MEMORY_DIRECTORY（默认临时目录）")
+    parser.add_argument('--log-level', default='WARNING', help="服务器日志级别")
+    parser.add_argument('--json', dest='json_path', help="把报告另存为 JSON")
+    args = parser.parse_args(argv)
+    if not args.recording and args.synthesize <= 0:
+        parser.error("需要提供录制文件或 --synthesize N")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    # 必须在导入服务器模块（env_config 读取环境变量）之前设置
+    os.environ['MEMORY_DIRECTORY'] = args.memory_dir or tempfile.mkdtemp(prefix="mobilegpt-replay-")
+    os.environ['ENABLE_DB'] = 'false'
+    os.environ.pop('REPLAY_RECORD_FILE', None)
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+
+    from replay.recorder import load_events
+    from replay.stub import ReplayClient
+    from utils.llm_client import set_client_override
+
+    events = load_events(args.recording) if args.recording else []
+    if args.recording:
+        sessions = sessions_from_recording(events)
+    else:
+        sessions = synthesize_sessions(args.synthesize, args.screens, args.fixtures_dir, args.instructions)
+    if not sessions:
+        raise SystemExit("录制文件中没有消息帧")
+
+    stub = ReplayClient(events, latency_ms=args.llm_latency_ms)
+    set_client_override(stub)
+
+    timer = StageTimer()
+    install_stage_timers(timer)
+
+    port = _free_port()
+    start_server(args.mode, port)
+    # log() 通过 logger.handle 直接分发，只有处理器级别能过滤
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(args.log_level.upper())
+
+    counters = {'sessions': 0, 'frames': 0, 'timeouts': 0}
+    wall_start = time.perf_counter()
+    for _ in range(max(1, args.repeat)):
+        for frames in sessions:
+            replay_session(port, frames, timer, args.timeout, counters)
+            counters['sessions'] += 1
+    wall_ms = (time.perf_counter() - wall_start) * 1000.0
+
+    stages = timer.summary()
+    report = {
+        'mode': args.mode,
+        'memory_directory': os.environ['MEMORY_DIRECTORY'],
+        'wall_ms': round(wall_ms, 3),
+        'counters': counters,
+        'llm_stub': stub.get_stats(),
+        'stages': stages,
+    }
+    print(format_report(stages))
+    print(f"\nsessions={counters['sessions']} frames={counters['frames']} timeouts={counters['timeouts']} "
+          f"wall={wall_ms:.1f}ms stub={report['llm_stub']}")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0 if counters['timeouts'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
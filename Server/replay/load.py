@@ -0,0 +1,302 @@
+"""
+多设备压测：模拟 N 台 Android 客户端并发使用旧版 socket 协议（与 MobileGPTClient.kt 相同的线格式）。
+
+每台设备：I 指令 → 每步发送 S 截图 + X 界面 XML，读取以 \\r\\n 结尾的 JSON 动作（或 $$$$$）作为一步结束；
+按 --error-rate 以 E 错误代替 X，按 --qa-rate 在步前插入 A 问答。模型请求由 replay.stub.ReplayClient 应答。
+
+    python -m replay.load --devices 1,4,16 --duration 20 --llm-latency-ms 300
+
+按并发级别依次运行，报告吞吐、单步延迟 p50/p95/p99、进程线程数、RSS，
+以及 AsyncProcessor 队列与 SessionManager 会话数的峰值，用于定位 Server / AsyncProcessor / SessionManager 的饱和点。
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from replay.bench import REPO_ROOT, SERVER_DIR, ReplayConnection, _free_port, load_fixture_screens, \
+    load_instructions, start_server
+
+# 客户端侧的辅助线程（不计入服务器线程数）
+_CLIENT_THREAD_PREFIXES = ("replay-reader", "load-device", "load-sampler", "MainThread")
+
+
+def synthetic_jpeg(size_kb: int, seed: int = 0) -> bytes:
+    """生成指定大小的 JPEG 形态数据（SOI/APP0 头 + 随机负载 + EOI），服务器只转存截图、不解码"""
+    header = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    body_size = max(0, size_kb * 1024 - len(header) - 2)
+    body = random.Random(seed).randbytes(body_size).replace(b'\xff', b'\x00')
+    return header + body + b'\xff\xd9'
+
+
+def current_rss_mb() -> float:
+    """当前常驻内存（Linux 读 /proc，其他平台退回到峰值 ru_maxrss）"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def server_thread_count() -> int:
+    return sum(1 for t in threading.enumerate() if not t.name.startswith(_CLIENT_THREAD_PREFIXES))
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * (len(sorted_values) - 1) + 0.5))]
+
+
+class ResourceSampler:
+    """按固定间隔采样线程数、RSS、AsyncProcessor 队列与会话数，记录峰值"""
+
+    def __init__(self, server, interval: float = 0.5):
+        self.server = server
+        self.interval = interval
+        self.peaks = {'threads': 0, 'rss_mb': 0.0, 'sessions': 0, 'async_queue': 0, 'async_active': 0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="load-sampler", daemon=True)
+
+    def _sample(self):
+        from async_processor import async_processor
+
+        queue_status = async_processor.get_queue_status()
+        current = {
+            'threads': server_thread_count(),
+            'rss_mb': current_rss_mb(),
+            'sessions': len(self.server.session_manager.get_active_sessions()),
+            'async_queue': queue_status['queue_size'],
+            'async_active': queue_status['active_tasks'],
+        }
+        for key, value in current.items():
+            self.peaks[key] = max(self.peaks[key], value)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._sample()
+            except Exception:
+                pass
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return dict(self.peaks)
+
+
+class Device(threading.Thread):
+    """一台模拟设备：循环执行“指令 + 若干步”的会话，直到截止时间"""
+
+    def __init__(self, device_id: int, port: int, args, screens: List[str], instructions: List[str],
+                 deadline: float, results: dict, lock: threading.Lock):
+        super().__init__(name=f"load-device-{device_id}", daemon=True)
+        self.device_id = device_id
+        self.port = port
+        self.args = args
+        self.screens = screens
+        self.instructions = instructions
+        self.deadline = deadline
+        self.results = results
+        self.lock = lock
+        self.rng = random.Random(args.seed + device_id)
+        self.screenshot = synthetic_jpeg(args.screenshot_kb, seed=device_id)
+
+    def _record(self, key: str, value=1):
+        with self.lock:
+            if key == 'latencies':
+                self.results['latencies'].append(value)
+            else:
+                self.results[key] += value
+
+    def _error_frame(self, screen: str) -> dict:
+        # 与 MobileGPTClient.buildErrorData 相同的分行格式
+        error = "\n".join(["ERROR_TYPE:ACTION", "ERROR_MESSAGE:load test", "ACTION:{}",
+                           f"INSTRUCTION:{self.instructions[self.device_id % len(self.instructions)]}",
+                           f"SCREENSHOT_DATA:{base64.b64encode(self.screenshot).decode('ascii')}",
+                           "PRE_XML:", screen, "CUR_XML:", screen])
+        return {'messageType': 'error', 'error': error}
+
+    def _step(self, connection: ReplayConnection, screen: str) -> bool:
+        if self.rng.random() < self.args.qa_rate:
+            # A 问答不一定有回复：短暂等待可能的后续动作，不计入单步延迟
+            connection.send({'messageType': 'qa', 'qa': "info\\question\\answer"})
+            self._record('qa_sent')
+            connection.wait_reply(self.args.qa_wait)
+
+        connection.send({'messageType': 'screenshot', 'screenshot': self.screenshot})
+        if self.rng.random() < self.args.error_rate:
+            message = self._error_frame(screen)
+            self._record('errors_sent')
+        else:
+            message = {'messageType': 'xml', 'xml': screen}
+
+        start = time.perf_counter()
+        connection.send(message)
+        ok, lines = connection.wait_reply(self.args.timeout)
+        if not ok:
+            self._record('timeouts')
+            return False
+        self._record('latencies', (time.perf_counter() - start) * 1000.0)
+        self._record('steps')
+        if lines and lines[-1] == '$$$$$':
+            self._record('tasks_finished')
+        return True
+
+    def run(self):
+        session_no = 0
+        while time.monotonic() < self.deadline:
+            try:
+                connection = ReplayConnection('127.0.0.1', self.port)
+            except OSError:
+                self._record('connect_errors')
+                time.sleep(0.1)
+                continue
+            try:
+                instruction = self.instructions[(self.device_id + session_no) % len(self.instructions)]
+                connection.send({'messageType': 'instruction', 'instruction': instruction})
+                self._record('sessions')
+                for step in range(self.args.steps):
+                    if time.monotonic() >= self.deadline:
+                        break
+                    screen = self.screens[(self.device_id + step) % len(self.screens)]
+                    if not self._step(connection, screen):
+                        break
+                    if self.args.think_ms:
+                        time.sleep(self.args.think_ms / 1000.0)
+            except OSError:
+                self._record('socket_errors')
+            finally:
+                connection.close()
+            session_no += 1
+
+
+def run_level(devices: int, port: int, server, args, screens, instructions) -> dict:
+    results = {'latencies': [], 'steps': 0, 'sessions': 0, 'tasks_finished': 0, 'timeouts': 0,
+               'errors_sent': 0, 'qa_sent': 0, 'connect_errors': 0, 'socket_errors': 0}
+    lock = threading.Lock()
+    sampler = ResourceSampler(server)
+    sampler.start()
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    workers = [Device(i, port, args, screens, instructions, deadline, results, lock) for i in range(devices)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(args.duration + args.timeout + 5)
+    elapsed = time.monotonic() - start
+    peaks = sampler.stop()
+
+    latencies = sorted(results.pop('latencies'))
+    return {
+        'devices': devices,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_steps_per_s': round(results['steps'] / elapsed, 3) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        **results,
+        'peak': peaks,
+    }
+
+
+def format_levels(levels: List[dict]) -> str:
+    header = (f"{'devices':>8}{'steps/s':>10}{'p50_ms':>10}{'p95_ms':>10}{'p99_ms':>10}{'steps':>8}"
+              f"{'timeouts':>10}{'threads':>9}{'rss_mb':>9}{'sessions':>10}{'async_q':>9}")
+    rows = [header, '-' * len(header)]
+    for level in levels:
+        peak = level['peak']
+        rows.append(f"{level['devices']:>8}{level['throughput_steps_per_s']:>10.2f}{level['p50_ms']:>10.1f}"
+                    f"{level['p95_ms']:>10.1f}{level['p99_ms']:>10.1f}{level['steps']:>8}{level['timeouts']:>10}"
+                    f"{peak['threads']:>9}{peak['rss_mb']:>9.1f}{peak['sessions']:>10}{peak['async_queue']:>9}")
+    return "\n".join(rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MobileGPT 服务器多设备压测（旧版 socket 协议）")
+    parser.add_argument('--devices', default='1,4,16', help="并发设备数，逗号分隔时按级别依次运行")
+    parser.add_argument('--duration', type=float, default=15.0, help="每个并发级别的持续时间（秒）")
+    parser.add_argument('--steps', type=int, default=5, help="每个会话的步数（每步 S + X）")
+    parser.add_argument('--think-ms', type=float, default=0.0, help="每步之间的设备侧等待")
+    parser.add_argument('--screenshot-kb', type=int, default=150, help="每张截图的大小")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="以 E 错误消息代替 X 的概率")
+    parser.add_argument('--qa-rate', type=float, default=0.0, help="每步先发送一条 A 问答消息的概率")
+    parser.add_argument('--qa-wait', type=float, default=1.0, help="A 问答后等待可能回复的时间（秒）")
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread', help="服务器模式")
+    parser.add_argument('--llm-latency-ms', type=float, default=0.0, help="模型替身每次请求的模拟耗时")
+    parser.add_argument('--timeout', type=float, default=30.0, help="等待每步回复的超时（秒）")
+    parser.add_argument('--fixtures-dir', default=REPO_ROOT, help="0_*.xml 所在目录")
+    parser.add_argument('--instructions', default=os.path.join(REPO_ROOT, 'requests.jsonl'),
+                        help="指令来源（JSONL，取 title 字段）")
+    parser.add_argument('--memory-dir', help="压测使用的 MEMORY_DIRECTORY（默认临时目录）")
+    parser.add_argument('--log-level', default='ERROR', help="服务器日志级别")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--json', dest='json_path', help="把报告另存为 JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    levels = [int(n) for n in str(args.devices).split(',') if n.strip()]
+
+    os.environ['MEMORY_DIRECTORY'] = args.memory_dir or tempfile.mkdtemp(prefix="mobilegpt-load-")
+    os.environ['ENABLE_DB'] = 'false'
+    os.environ.pop('REPLAY_RECORD_FILE', None)
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+
+    from replay.stub import ReplayClient
+    from utils.llm_client import set_client_override
+
+    screens = load_fixture_screens(args.fixtures_dir)
+    if not screens:
+        raise SystemExit(f"在 {args.fixtures_dir} 中没有可用的 0_*.xml 屏幕样本")
+    instructions = load_instructions(args.instructions)
+
+    stub = ReplayClient(latency_ms=args.llm_latency_ms)
+    set_client_override(stub)
+
+    port = _free_port()
+    server = start_server(args.mode, port)
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(args.log_level.upper())
+
+    baseline = {'threads': server_thread_count(), 'rss_mb': round(current_rss_mb(), 1)}
+    results: List[Dict] = []
+    for devices in levels:
+        result = run_level(devices, port, server, args, screens, instructions)
+        results.append(result)
+        print(format_levels(results[-1:]).splitlines()[-1] if len(results) > 1 else format_levels(results), flush=True)
+        # 等上一级别的会话清理完再进入下一级别
+        time.sleep(1.0)
+
+    print(f"\nbaseline threads={baseline['threads']} rss={baseline['rss_mb']}MB, stub={stub.get_stats()}")
+    if args.json_path:
+        report = {'mode': args.mode, 'memory_directory': os.environ['MEMORY_DIRECTORY'],
+                  'baseline': baseline, 'levels': results, 'server_status': server.get_server_status()}
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    return 0 if all(level['timeouts'] == 0 for level in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
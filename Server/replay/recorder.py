@@ -0,0 +1,167 @@
+"""
+会话录制器
+设置 REPLAY_RECORD_FILE 后，服务器把每个会话收到的消息帧、每次 query / 嵌入请求及其响应追加写入一个 JSONL 文件，
+供 replay.bench 在没有手机和 DashScope 的情况下回放压测。
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from log_config import log
+
+
+def request_key(kind: str, model: str, payload) -> str:
+    """录制与回放共用的请求指纹"""
+    raw = json.dumps([kind, model, payload], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+
+def encode_message(message: dict) -> dict:
+    """消息帧中的 bytes 字段（截图）转为 base64，便于写入 JSON"""
+    return {key: {'__b64__': base64.b64encode(value).decode('ascii')} if isinstance(value, (bytes, bytearray)) else value
+            for key, value in message.items()}
+
+
+def decode_message(message: dict) -> dict:
+    return {key: base64.b64decode(value['__b64__']) if isinstance(value, dict) and '__b64__' in value else value
+            for key, value in message.items()}
+
+
+def load_events(path: str) -> List[dict]:
+    events = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # 录制进程中断时最后一行可能不完整
+                continue
+    return events
+
+
+class SessionRecorder:
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _write(self, event: dict) -> None:
+        event['ts'] = time.time()
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def record_frame(self, session_id: str, message: dict) -> None:
+        if not self.enabled:
+            return
+        try:
+            self._write({'event': 'frame', 'session': session_id, 'message': encode_message(message)})
+        except Exception as e:
+            log(f"录制消息帧失败: {e}", "red")
+
+    def record_chat(self, model: str, messages, content: str, elapsed_ms: float) -> None:
+        try:
+            self._write({'event': 'chat', 'key': request_key('chat', model, messages), 'model': model,
+                         'messages': messages, 'content': content, 'ms': round(elapsed_ms, 3)})
+        except Exception as e:
+            log(f"录制 query 失败: {e}", "red")
+
+    def record_embedding(self, model: str, texts: List[str], vectors: List[List[float]], elapsed_ms: float) -> None:
+        try:
+            self._write({'event': 'embedding', 'model': model, 'texts': texts, 'vectors': vectors,
+                         'ms': round(elapsed_ms, 3)})
+        except Exception as e:
+            log(f"录制嵌入请求失败: {e}", "red")
+
+    def install(self) -> None:
+        """用录制代理包装共享客户端，之后所有 query / 嵌入请求都会被记录"""
+        from utils.llm_client import get_client, set_client_override
+        set_client_override(RecordingClient(get_client(), self))
+        log(f"会话录制已开启: {os.path.abspath(self.path)}", "green")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class _RecordingCompletions:
+
+    def __init__(self, inner, recorder: SessionRecorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    def create(self, **kwargs):
+        start = time.perf_counter()
+        response = self._inner.create(**kwargs)
+        if kwargs.get('stream'):
+            return self._record_stream(response, kwargs, start)
+        content = response.choices[0].message.content if response.choices else ""
+        self._recorder.record_chat(kwargs.get('model'), kwargs.get('messages'), content,
+                                   (time.perf_counter() - start) * 1000.0)
+        return response
+
+    def _record_stream(self, stream, kwargs: dict, start: float):
+        # 流式响应接收完毕后按拼接后的完整内容记录（与非流式请求的录制格式相同）
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        self._recorder.record_chat(kwargs.get('model'), kwargs.get('messages'), "".join(parts),
+                                   (time.perf_counter() - start) * 1000.0)
+
+
+class _RecordingEmbeddings:
+
+    def __init__(self, inner, recorder: SessionRecorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    def create(self, input, model, **kwargs):
+        start = time.perf_counter()
+        response = self._inner.create(input=input, model=model, **kwargs)
+        texts = [input] if isinstance(input, str) else list(input)
+        vectors = [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+        self._recorder.record_embedding(model, texts, vectors, (time.perf_counter() - start) * 1000.0)
+        return response
+
+
+class _Namespace:
+    pass
+
+
+class RecordingClient:
+    """OpenAI 客户端代理：转发请求并记录请求/响应"""
+
+    def __init__(self, inner, recorder: SessionRecorder):
+        self._inner = inner
+        self.chat = _Namespace()
+        self.chat.completions = _RecordingCompletions(inner.chat.completions, recorder)
+        self.embeddings = _RecordingEmbeddings(inner.embeddings, recorder)
+
+    def close(self):
+        self._inner.close()
+
+
+# 全局录制器（REPLAY_RECORD_FILE 为空时不录制）
+recorder = SessionRecorder(os.getenv("REPLAY_RECORD_FILE") or None)
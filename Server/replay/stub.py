@@ -0,0 +1,169 @@
+"""
+确定性大模型替身
+按录制文件中的请求指纹返回原始响应；未录制过的请求返回固定的兜底响应（不访问网络）。
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from replay.recorder import request_key
+
+DEFAULT_EMBEDDING_DIM = 1536
+
+# 兜底对象同时满足各智能体需要的字段：task_agent(api/found_match)、select/derive(action/speak/...)、
+# ReflectorVL(need_back/problem_type/advice)。
+# 对象内不含 '['，query(is_list=True) 会跳过它而取后面的列表部分（explore/subtask_merge）。
+_FALLBACK_OBJECT = {
+    "api": {"name": "replayTask", "description": "replayed task", "parameters": {}, "app": "replay"},
+    "found_match": "false",
+    "action": {"name": "finish", "parameters": {}},
+    "speak": "replay",
+    "completion_rate": 100,
+    "reasoning": "replay stub",
+    "plan": "replay stub",
+    "need_back": False,
+    "problem_type": "action",
+    "advice": "replay stub",
+    "summary": "replay stub",
+}
+
+# 可点击元素（button/checker/input）的 index，作为兜底子任务的 trigger_UIs
+_INDEX_PATTERN = re.compile(r"""<(?:button|checker|input)\b[^>]*?\bindex=["'](\d+)["']""")
+
+
+def _message_text(messages) -> str:
+    parts = []
+    for message in messages or []:
+        content = message.get('content', '') if isinstance(message, dict) else ''
+        if isinstance(content, list):
+            content = " ".join(item.get('text', '') for item in content if isinstance(item, dict))
+        parts.append(str(content))
+    return "\n".join(parts)
+
+
+def fallback_content(messages) -> str:
+    """未命中录制时的确定性响应；列表部分的 trigger_UIs 取提示词中第一个可点击元素的 index"""
+    if messages and isinstance(messages[-1].get('content'), list):
+        # 多模态请求（ReflectorVL）直接 json.loads 整个响应，只返回对象
+        return json.dumps(_FALLBACK_OBJECT)
+    match = _INDEX_PATTERN.search(_message_text(messages[-1:] if messages else []))
+    trigger_uis = [int(match.group(1))] if match else []
+    subtasks = [{"name": "replay_subtask", "description": "replayed subtask", "parameters": {},
+                 "trigger_UIs": trigger_uis}]
+    return json.dumps(_FALLBACK_OBJECT) + "\n" + json.dumps(subtasks)
+
+
+def fallback_embedding(text: str, dim: int) -> List[float]:
+    seed = int(hashlib.md5((text or "").encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist()
+
+
+class _Completions:
+
+    def __init__(self, client: 'ReplayClient'):
+        self._client = client
+
+    # 流式响应每个分块的字符数
+    STREAM_CHUNK_CHARS = 16
+
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        content = self._client.chat_content(model, messages)
+        if stream:
+            return self._stream(content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    def _stream(self, content: str):
+        for i in range(0, len(content), self.STREAM_CHUNK_CHARS):
+            delta = SimpleNamespace(content=content[i:i + self.STREAM_CHUNK_CHARS])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class _Embeddings:
+
+    def __init__(self, client: 'ReplayClient'):
+        self._client = client
+
+    def create(self, input, model=None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        vectors = self._client.embedding_vectors(model, texts)
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=v) for i, v in enumerate(vectors)])
+
+
+class ReplayClient:
+    """
+    替代 OpenAI 客户端（通过 llm_client.set_client_override 安装）。
+    - chat：同一指纹录制了多次时按顺序返回，用尽后重复最后一次
+    - embeddings：按 (model, text) 查找录制向量，未命中时按文本哈希生成固定向量
+    - latency_ms：每次请求额外等待的时间，用于模拟模型耗时
+    """
+
+    def __init__(self, events: Optional[List[dict]] = None, latency_ms: float = 0.0,
+                 embedding_dim: Optional[int] = None):
+        self.latency = max(0.0, latency_ms) / 1000.0
+        self._lock = threading.Lock()
+        self._chats: Dict[str, deque] = {}
+        self._last_chat: Dict[str, str] = {}
+        self._vectors: Dict[Tuple[str, str], List[float]] = {}
+        self._stats = {'chat_hits': 0, 'chat_misses': 0, 'embed_hits': 0, 'embed_misses': 0}
+
+        for event in events or []:
+            if event.get('event') == 'chat':
+                self._chats.setdefault(event['key'], deque()).append(event.get('content') or "")
+            elif event.get('event') == 'embedding':
+                for text, vector in zip(event.get('texts', []), event.get('vectors', [])):
+                    self._vectors[(event.get('model'), text)] = vector
+
+        if embedding_dim is None:
+            embedding_dim = len(next(iter(self._vectors.values()))) if self._vectors else DEFAULT_EMBEDDING_DIM
+        self.embedding_dim = embedding_dim
+
+        self.chat = SimpleNamespace(completions=_Completions(self))
+        self.embeddings = _Embeddings(self)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def chat_content(self, model, messages) -> str:
+        self._wait()
+        key = request_key('chat', model, messages)
+        with self._lock:
+            recorded = self._chats.get(key)
+            if recorded:
+                content = recorded.popleft()
+                self._last_chat[key] = content
+            else:
+                content = self._last_chat.get(key)
+            self._stats['chat_hits' if content is not None else 'chat_misses'] += 1
+        return content if content is not None else fallback_content(messages)
+
+    def embedding_vectors(self, model, texts: List[str]) -> List[List[float]]:
+        self._wait()
+        vectors = []
+        hits = 0
+        for text in texts:
+            vector = self._vectors.get((model, text))
+            if vector is None:
+                vector = fallback_embedding(text, self.embedding_dim)
+            else:
+                hits += 1
+            vectors.append(vector)
+        with self._lock:
+            self._stats['embed_hits'] += hits
+            self._stats['embed_misses'] += len(texts) - hits
+        return vectors
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        pass
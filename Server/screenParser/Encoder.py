@@ -2,9 +2,8 @@ import os
 import re
 
 import xml.etree.ElementTree as ET
-import xml.dom.minidom
 
-from screenParser import parseXML
+from screenParser.cache import get_screen
 
 
 def parse_bounds(bounds):
@@ -113,20 +112,13 @@ class xmlEncoder:
 # raw_xml 是手机dump下来的xml字符串
 
     def encode(self, raw_xml, index):
-        parsed_xml, hierarchy_xml = self.parse(raw_xml, index)
-        tree = ET.fromstring(parsed_xml)
+        # 单次解析：parsed / hierarchy / encoded / pretty 均来自同一棵内存树
+        screen = get_screen(raw_xml)
+        parsed_xml, hierarchy_xml = self.__save_parsed(screen, index)
 
-        # 把 bounds / important / class 三个属性全部删掉，只保留对 LLM 更友好的部分。
-        for element in tree.iter():
-            if 'bounds' in element.attrib:
-                del element.attrib['bounds']
-            if 'important' in element.attrib:
-                del element.attrib['important']
-            if 'class' in element.attrib:
-                del element.attrib['class']
-
-        encoded_xml = ET.tostring(tree, encoding='unicode')
-        pretty_xml = xml.dom.minidom.parseString(encoded_xml).toprettyxml()
+        # encoded_xml 已去掉 bounds / important / class 三个属性，只保留对 LLM 更友好的部分。
+        encoded_xml = screen.encoded_xml
+        pretty_xml = screen.pretty_xml
         encoded_xml_path = os.path.join(self.xml_directory, f"{index}_encoded.xml")
         pretty_xml_path = os.path.join(self.xml_directory, f"{index}_pretty.xml")
 
@@ -145,10 +137,13 @@ class xmlEncoder:
 
 
     def parse(self, raw_xml, index):
-        # 步骤1：调用自定义parseXML工具，处理手机原始XML（生成包含完整控件属性的XML）
-        parsed_xml = parseXML.parse(raw_xml)
-        # 步骤2：调用自定义工具，提取XML的层级结构（仅保留控件嵌套关系，简化内容）
-        hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
+        return self.__save_parsed(get_screen(raw_xml), index)
+
+    def __save_parsed(self, screen, index):
+        # 步骤1：处理手机原始XML（生成包含完整控件属性的XML）
+        parsed_xml = screen.parsed_xml
+        # 步骤2：提取XML的层级结构（仅保留控件嵌套关系，简化内容）
+        hierarchy_xml = screen.hierarchy_xml
 
         parsed_xml_path = os.path.join(self.xml_directory, f"{index}_parsed.xml")
         hierarchy_parsed_xml_path = os.path.join(self.xml_directory, f"{index}_hierarchy_parsed.xml")
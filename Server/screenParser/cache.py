@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from screenParser.pipeline import ScreenPipeline
+
+
+def screen_digest(raw_xml: str) -> str:
+    return hashlib.blake2b((raw_xml or "").encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ScreenCache:
+    """
+    按原始 XML 摘要缓存屏幕解析产物（ScreenPipeline）的 LRU 缓存，线程安全，按字节数淘汰。
+    同一屏幕在一次 step 内会被多处使用（接收、错误恢复、按页落盘），客户端在动作失败后
+    也常会重发未变化的界面，命中缓存即可复用已生成的 parsed / hierarchy / encoded / pretty。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[str, ScreenPipeline]" = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def get(self, raw_xml: str) -> ScreenPipeline:
+        """返回 raw_xml 对应的 ScreenPipeline；未命中时解析并生成 parsed / hierarchy / encoded 后入缓存"""
+        key = screen_digest(raw_xml)
+        with self._lock:
+            screen = self._entries.get(key)
+            if screen is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                self._resize(key, screen)
+                return screen
+            self.stats['misses'] += 1
+
+        # 解析放在锁外，避免大 XML 阻塞其他会话
+        screen = ScreenPipeline(raw_xml)
+        screen.encode()
+
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                # 并发未命中：保留先入缓存的实例，保证所有消费者共享同一份产物
+                self._entries.move_to_end(key)
+                return existing
+            self._entries[key] = screen
+            self._sizes[key] = 0
+            self._resize(key, screen)
+        return screen
+
+    def _resize(self, key: str, screen: ScreenPipeline) -> None:
+        # 惰性视图（如 pretty_xml）可能在入缓存后才生成，因此每次访问都重新计量
+        size = screen.nbytes
+        self._total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._evict()
+
+    def _evict(self) -> None:
+        # 至少保留最近使用的一项，即使它单独超过上限
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, _ = self._entries.popitem(last=False)
+            self._total_bytes -= self._sizes.pop(key, 0)
+            self.stats['evictions'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hit_rate': (self.stats['hits'] / lookups) if lookups > 0 else 0.0,
+            }
+
+
+# 全局屏幕缓存实例
+screen_cache = ScreenCache(max_bytes=int(os.getenv("SCREEN_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+
+def get_screen(raw_xml: str) -> ScreenPipeline:
+    return screen_cache.get(raw_xml)
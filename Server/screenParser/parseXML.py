@@ -1,24 +1,35 @@
 import xml.etree.ElementTree as ET
 
 
+EMPTY_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+<hierarchy>
+  <node resource-id="empty" class="Empty" text="Empty XML" clickable="false" enabled="false" bounds="[0,0][0,0]"/>
+</hierarchy>"""
+
+PARSE_ERROR_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+<hierarchy>
+  <node resource-id="parse_error" class="ParseError" text="XML Parse Error" clickable="false" enabled="false" bounds="[0,0][0,0]"/>
+</hierarchy>"""
+
+
 def reformat_xml(xml_string):
     # 检查XML字符串是否为空或无效
     if not xml_string or xml_string.strip() == "":
         print("Warning: Empty XML string received")
-        return """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
-<hierarchy>
-  <node resource-id="empty" class="Empty" text="Empty XML" clickable="false" enabled="false" bounds="[0,0][0,0]"/>
-</hierarchy>"""
-    
+        return EMPTY_XML
+
     try:
         tree = ET.fromstring(xml_string)
     except ET.ParseError as e:
         print(f"XML Parse Error: {e}")
         print(f"Received XML: {xml_string[:200]}...")  # 只打印前200个字符
-        return """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
-<hierarchy>
-  <node resource-id="parse_error" class="ParseError" text="XML Parse Error" clickable="false" enabled="false" bounds="[0,0][0,0]"/>
-</hierarchy>"""
+        return PARSE_ERROR_XML
+
+    return ET.tostring(reformat_tree(tree), encoding='unicode')
+
+
+def reformat_tree(tree):
+    """将无障碍服务 dump 的原始节点树转换为 HTML 风格的元素树（返回新树，不修改入参）"""
 
     def process_element(element):
         attrib_text = {
@@ -110,13 +121,17 @@ def reformat_xml(xml_string):
 
         return new_element
 
-    new_tree = process_element(tree)
-    return ET.tostring(new_tree, encoding='unicode')
+    return process_element(tree)
 
 
 def hierarchy_parse(parsed_xml):
     tree = ET.fromstring(parsed_xml)
+    strip_semantic_info(tree)
+    remove_redundant_scroll_items(tree)
+    return ET.tostring(tree, encoding='unicode')
+
 
+def strip_semantic_info(tree):
     # Remove any semantic info
     for element in tree.iter():
         if 'bounds' in element.attrib:
@@ -134,15 +149,15 @@ def hierarchy_parse(parsed_xml):
         if 'text' in element.attrib:
             del element.attrib['text']
 
-    hierarchy_xml = ET.tostring(tree, encoding='unicode')
-
-    hierarchy_xml = remove_redundancies(hierarchy_xml)
-
-    return hierarchy_xml
-
 
 def delete_option_information(parsed_xml):
     tree = ET.fromstring(parsed_xml)
+    strip_option_information(tree)
+    return ET.tostring(tree, encoding='unicode')
+
+
+def strip_option_information(tree):
+    # 把 bounds / important / class 三个属性全部删掉，只保留对 LLM 更友好的部分。
     for element in tree.iter():
         if 'bounds' in element.attrib:
             del element.attrib['bounds']
@@ -151,10 +166,6 @@ def delete_option_information(parsed_xml):
         if 'class' in element.attrib:
             del element.attrib['class']
 
-    encoded_xml = ET.tostring(tree, encoding='unicode')
-
-    return encoded_xml
-
 
 def remove_nodes_with_empty_bounds(element):
     for node in list(element):
@@ -163,11 +174,16 @@ def remove_nodes_with_empty_bounds(element):
         else:
             remove_nodes_with_empty_bounds(node)
 
+
 def simplify_structure(xml_string):
-    tree = ET.ElementTree(ET.fromstring(xml_string))
-    root = tree.getroot()
+    root = ET.fromstring(xml_string)
+    simplify_tree(root)
+    return ET.tostring(root, encoding='unicode')
+
+
+def simplify_tree(root):
     def simplify_element(elem):
-        while len(list(elem)) == 1 and all(x not in elem.attrib for x in ['text', 'description']):
+        while len(elem) == 1 and all(x not in elem.attrib for x in ['text', 'description']):
             if elem.tag in ['button', 'checker']:
                 break
             child = elem[0]
@@ -181,11 +197,14 @@ def simplify_structure(xml_string):
 
     simplify_element(root)
 
-    return ET.tostring(root, encoding='unicode')
 
 def remove_redundancies(xml_string):
-    tree = ET.ElementTree(ET.fromstring(xml_string))
-    root = tree.getroot()
+    root = ET.fromstring(xml_string)
+    remove_redundant_scroll_items(root)
+    return ET.tostring(root, encoding='unicode')
+
+
+def remove_redundant_scroll_items(root):
     def elem_key(elem):
         return (
             elem.tag, tuple(elem.attrib.items()),
@@ -204,16 +223,25 @@ def remove_redundancies(xml_string):
         for item in items_to_remove:
             scroll.remove(item)
 
-    return ET.tostring(root, encoding='unicode')
-
-
-def parse(raw_xml):
-    reformatted_xml = reformat_xml(raw_xml)
-
-    simplified_xml = simplify_structure(reformatted_xml)
-    root = ET.fromstring(simplified_xml)
 
+def parse_tree(raw_xml):
+    """parse() 的单树版本：原始 XML 只解析一次，返回 parsed 树（Element）"""
+    # 与 reformat_xml 一致：空串/解析失败时直接使用占位 XML（不再经过 reformat）
+    if not raw_xml or raw_xml.strip() == "":
+        print("Warning: Empty XML string received")
+        root = ET.fromstring(EMPTY_XML)
+    else:
+        try:
+            root = reformat_tree(ET.fromstring(raw_xml))
+        except ET.ParseError as e:
+            print(f"XML Parse Error: {e}")
+            print(f"Received XML: {raw_xml[:200]}...")  # 只打印前200个字符
+            root = ET.fromstring(PARSE_ERROR_XML)
+
+    simplify_tree(root)
     remove_nodes_with_empty_bounds(root)
-    parsed_xml = ET.tostring(root, encoding='unicode')
+    return root
 
-    return parsed_xml
+
+def parse(raw_xml):
+    return ET.tostring(parse_tree(raw_xml), encoding='unicode')
@@ -0,0 +1,91 @@
+import copy
+import sys
+import threading
+import xml.dom.minidom
+import xml.etree.ElementTree as ET
+
+from screenParser import parseXML
+
+
+class ScreenPipeline:
+    """
+    单次解析的屏幕处理管线：原始 XML 只 fromstring 一次，所有变换都在同一棵内存树上完成，
+    parsed / hierarchy / encoded / pretty 四种视图按需（惰性）生成并缓存。
+
+    等价于旧流程：
+        parsed_xml    = parseXML.parse(raw_xml)
+        hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
+        encoded_xml   = parseXML.delete_option_information(parsed_xml)
+        pretty_xml    = minidom.parseString(encoded_xml).toprettyxml()
+    """
+
+    def __init__(self, raw_xml: str):
+        self.raw_xml = raw_xml
+        self._lock = threading.RLock()
+        self._root = None
+        self._parsed_xml = None
+        self._hierarchy_xml = None
+        self._encoded_xml = None
+        self._pretty_xml = None
+
+    def _tree(self) -> ET.Element:
+        if self._root is None:
+            self._root = parseXML.parse_tree(self.raw_xml)
+        return self._root
+
+    def _derive(self, transform) -> str:
+        """在 parsed 树的副本上执行破坏性变换；若它是最后一个需要树的视图，则直接复用原树并释放。"""
+        root = self._tree()
+        if self._parsed_xml is None:
+            self._parsed_xml = ET.tostring(root, encoding='unicode')
+        pending = (self._hierarchy_xml is None) + (self._encoded_xml is None)
+        if pending > 1:
+            root = copy.deepcopy(root)
+        else:
+            self._root = None
+        transform(root)
+        return ET.tostring(root, encoding='unicode')
+
+    @property
+    def parsed_xml(self) -> str:
+        with self._lock:
+            if self._parsed_xml is None:
+                self._parsed_xml = ET.tostring(self._tree(), encoding='unicode')
+            return self._parsed_xml
+
+    @property
+    def hierarchy_xml(self) -> str:
+        with self._lock:
+            if self._hierarchy_xml is None:
+                self._hierarchy_xml = self._derive(_to_hierarchy)
+            return self._hierarchy_xml
+
+    @property
+    def encoded_xml(self) -> str:
+        with self._lock:
+            if self._encoded_xml is None:
+                self._encoded_xml = self._derive(parseXML.strip_option_information)
+            return self._encoded_xml
+
+    @property
+    def pretty_xml(self) -> str:
+        with self._lock:
+            if self._pretty_xml is None:
+                self._pretty_xml = xml.dom.minidom.parseString(self.encoded_xml).toprettyxml()
+            return self._pretty_xml
+
+    def encode(self) -> (str, str, str):
+        """返回 MobileGPT.get_next_action 所需的 (parsed_xml, hierarchy_xml, encoded_xml)"""
+        return self.parsed_xml, self.hierarchy_xml, self.encoded_xml
+
+    @property
+    def nbytes(self) -> int:
+        """当前已生成的字符串视图（含原始 XML）占用的字节数，供缓存按大小淘汰"""
+        with self._lock:
+            views = (self.raw_xml, self._parsed_xml, self._hierarchy_xml, self._encoded_xml, self._pretty_xml)
+            return sum(sys.getsizeof(v) for v in views if v is not None)
+
+
+def _to_hierarchy(root: ET.Element) -> None:
+    parseXML.strip_semantic_info(root)
+    parseXML.remove_redundant_scroll_items(root)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import sys
@@ -5,6 +6,7 @@ import socket
 import threading
 import queue
 import time
+from collections import deque
 from typing import Optional
 
 # 添加项目根目录到系统路径（必须在其他import之前）
@@ -24,10 +26,17 @@ from async_processor import async_processor, message_queue
 from Reflector_Agent.base import AgentMemory,AgentMemoryVL
 from Reflector_Agent.reflector import Reflector
 from Reflector_Agent.reflector_vl import ReflectorVL
-from utils.mongo_utils import reconnect
+from utils.mongo_utils import reconnect, bootstrap_schema
 import traceback
-from screenParser import parseXML
-import xml.etree.ElementTree as ET
+from screenParser.cache import get_screen, screen_cache
+from utils.llm_client import get_client_stats
+from replay.recorder import recorder
+from utils.write_behind import write_behind
+from utils.blob_store import blob_store
+from utils.dataframe_cache import dataframe_cache
+from utils.llm_cache import llm_cache
+from utils.disk_queue import DiskSpillQueue
+from pymongo import ReplaceOne
 
 
 class Server:
@@ -45,7 +54,15 @@ class Server:
         self.memory_directory = Config.MEMORY_DIRECTORY
         self.enable_db = Config.ENABLE_DB
         self.db_queue: "queue.Queue[dict]" = queue.Queue(maxsize=1000)
+        # 队列满或写入失败时的磁盘溢出队列，以及写入指标
+        self.db_spill = DiskSpillQueue(os.path.join(self.memory_directory, "db_spill.jsonl"))
+        self._db_metrics = {'written': 0, 'batches': 0, 'spilled': 0, 'replayed': 0, 'failed': 0}
+        self._db_latencies = deque(maxlen=512)
+        self._db_metrics_lock = threading.Lock()
         self._db_worker_thread = threading.Thread(target=self._db_worker, name="db-writer", daemon=True)
+        # 进程级共享事件循环（asyncio 模式下为服务器主循环）
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
 
         # 打印配置信息
         Config.print_config()
@@ -61,6 +78,12 @@ class Server:
             else:
                 log("MongoDB连接正常", "green")
                 # MongoDB连接池信息日志已删除，减少日志噪音
+        if self.enable_db:
+            self._bootstrap_schema()
+
+        # 录制模式：记录入站消息帧与模型请求/响应，供 replay.bench 回放
+        if recorder.enabled:
+            recorder.install()
 
         # Create the directory for saving received files if it doesn't exist
         if not os.path.exists(self.memory_directory):
@@ -85,6 +108,29 @@ class Server:
 
         message_queue.start(dummy_message_processor)
 
+    def _bootstrap_schema(self):
+        """为热点集合建立并校验索引（global_tasks.name、page_*_actions、临时截图/XML 集合等），记录集合与索引大小"""
+        try:
+            report = bootstrap_schema()
+        except Exception as e:
+            log(f"索引初始化失败: {e}", "red")
+            return
+        for collection_name, info in report.items():
+            stats = info['stats'] or {}
+            if info['missing']:
+                log(f"集合 {collection_name} 缺少索引: {info['missing']}", "yellow")
+            log(f"集合 {collection_name}: 文档数={stats.get('count', 0)}, 数据={stats.get('size_bytes', 0)} 字节, "
+                f"索引={stats.get('index_sizes', {})}", "cyan")
+        log(f"索引初始化完成: 集合数={len(report)}", "green")
+        try:
+            from utils.migrate_pages import legacy_page_collections
+            legacy = legacy_page_collections(get_db())
+            if legacy:
+                log(f"发现 {len(legacy)} 个旧布局的页面集合（page_<i>_*），其数据不再被读取，"
+                    f"请运行 python -m utils.migrate_pages 迁移到合并集合", "yellow")
+        except Exception:
+            pass
+
     def open(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
@@ -309,9 +355,14 @@ class Server:
             return None
 
     def _handle_message_async(self, session: ClientSession, message: dict):
-        """异步处理消息"""
+        """异步处理消息；处理期间登记的写后持久化归属于该会话"""
+        with write_behind.owner(session.session_id):
+            self._dispatch_message(session, message)
+
+    def _dispatch_message(self, session: ClientSession, message: dict):
         message_type = message.get('messageType', '')
         log(f"收到消息: 类型={message_type}, 会话={session.session_id}", "blue")
+        recorder.record_frame(session.session_id, message)
         
         if message_type == 'instruction' or message_type == 'I':  # 指令消息
             log("处理指令消息", "green")
@@ -492,15 +543,7 @@ class Server:
             log("开始优化版本XML处理", "green")
             
             # 解析XML数据
-            screen_parser = xmlEncoder()
-            parsed_xml = parseXML.parse(xml_content)
-            hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-            tree = ET.fromstring(parsed_xml)
-            for element in tree.iter():
-                for k in ("bounds", "important", "class"):
-                    if k in element.attrib:
-                        del element.attrib[k]
-            encoded_xml = ET.tostring(tree, encoding='unicode')
+            parsed_xml, hierarchy_xml, encoded_xml = get_screen(xml_content).encode()
             
             # 确保XML也进入缓冲，与截图配对
             try:
@@ -530,16 +573,10 @@ class Server:
             use_optimization = os.getenv("MOBILEGPT_OPTIMIZATION", "true").lower() == "true"
             
             if use_optimization and hasattr(mobilegpt, 'get_next_action_optimized'):
-                # 使用异步优化版本
-                import asyncio
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    action = loop.run_until_complete(
-                        mobilegpt.get_next_action_optimized(parsed_xml, hierarchy_xml, encoded_xml)
-                    )
-                finally:
-                    loop.close()
+                # 使用异步优化版本：提交到进程级共享事件循环，不再为每条消息新建/销毁事件循环
+                action = self._run_coroutine(
+                    mobilegpt.get_next_action_optimized(parsed_xml, hierarchy_xml, encoded_xml)
+                )
             else:
                 # 回退到同步版本
                 action = mobilegpt.get_next_action(parsed_xml, hierarchy_xml, encoded_xml)
@@ -570,6 +607,20 @@ class Server:
             # 回退到原始处理方式
             self._process_xml_directly(session, xml_content)
 
+    def _get_event_loop(self) -> asyncio.AbstractEventLoop:
+        """获取进程级共享事件循环；线程模式下首次调用时在后台线程中启动"""
+        if self._loop is None:
+            with self._loop_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="event-loop", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def _run_coroutine(self, coro):
+        """在共享事件循环上执行协程并阻塞等待结果（供工作线程调用）"""
+        return asyncio.run_coroutine_threadsafe(coro, self._get_event_loop()).result()
+
     def _wait_for_mobilegpt(self, session: ClientSession, xml_content: str, max_wait: int = 15):
         """等待MobileGPT实例准备就绪"""
         
@@ -610,15 +661,7 @@ class Server:
             log("开始处理XML内容", "green")
             
             # 解析XML数据
-            screen_parser = xmlEncoder()
-            parsed_xml = parseXML.parse(xml_content)
-            hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-            tree = ET.fromstring(parsed_xml)
-            for element in tree.iter():
-                for k in ("bounds", "important", "class"):
-                    if k in element.attrib:
-                        del element.attrib[k]
-            encoded_xml = ET.tostring(tree, encoding='unicode')
+            parsed_xml, hierarchy_xml, encoded_xml = get_screen(xml_content).encode()
             # 将原始XML缓存在 mobilegpt 上，与最近一次截图对齐（_screen_count - 1）
             try:
                 mobilegpt = session.mobilegpt
@@ -677,15 +720,7 @@ class Server:
             log("使用MobileGPT直接处理XML", "green")
             
             # 解析XML数据
-            screen_parser = xmlEncoder()
-            parsed_xml = parseXML.parse(xml_content)
-            hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-            tree = ET.fromstring(parsed_xml)
-            for element in tree.iter():
-                for k in ("bounds", "important", "class"):
-                    if k in element.attrib:
-                        del element.attrib[k]
-            encoded_xml = ET.tostring(tree, encoding='unicode')
+            parsed_xml, hierarchy_xml, encoded_xml = get_screen(xml_content).encode()
             
             
 
@@ -984,14 +1019,7 @@ class Server:
             return
 
         try:
-            parsed_xml = parseXML.parse(current_xml)
-            hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-            tree = ET.fromstring(parsed_xml)
-            for element in tree.iter():
-                for k in ("bounds", "important", "class"):
-                    if k in element.attrib:
-                        del element.attrib[k]
-            encoded_xml = ET.tostring(tree, encoding='unicode')
+            parsed_xml, hierarchy_xml, encoded_xml = get_screen(current_xml).encode()
             # 将原始XML缓存在 mobilegpt 上，与最近一次截图对齐（_screen_count - 1）
             try:
                 mobilegpt = session.mobilegpt
@@ -1141,14 +1169,7 @@ class Server:
             return
 
         try:
-            parsed_xml = parseXML.parse(current_xml)
-            hierarchy_xml = parseXML.hierarchy_parse(parsed_xml)
-            tree = ET.fromstring(parsed_xml)
-            for element in tree.iter():
-                for k in ("bounds", "important", "class"):
-                    if k in element.attrib:
-                        del element.attrib[k]
-            encoded_xml = ET.tostring(tree, encoding='unicode')
+            parsed_xml, hierarchy_xml, encoded_xml = get_screen(current_xml).encode()
             page_index, _ = mobileGPT.memory.search_node(parsed_xml, hierarchy_xml, encoded_xml)
 
             # 使用derive_agent重新生成动作，传入反思建议
@@ -1335,29 +1356,110 @@ class Server:
         return error_info
 
     def _enqueue_db_doc(self, doc: dict):
+        """入队；队列满时最多阻塞 0.5 秒（背压），仍满则溢出到磁盘队列，不丢弃"""
         try:
             self.db_queue.put(doc, timeout=0.5)
         except queue.Full:
-            log("DB queue full, dropping doc", "yellow")
+            self.db_spill.put_many([doc])
+            with self._db_metrics_lock:
+                self._db_metrics['spilled'] += 1
+
+    @staticmethod
+    def _put_bundle_blobs(doc: dict) -> dict:
+        blobs = {}
+        if doc.get('screenshot_bytes'):
+            blobs['screenshot'] = blob_store.put(doc['screenshot_bytes'])
+        for name, field in (('raw', 'raw_xml'), ('parsed', 'parsed_xml'), ('hierarchy', 'hierarchy_xml'),
+                            ('html', 'encoded_xml')):
+            if doc.get(field):
+                blobs[name] = blob_store.put(doc[field], compress=True)
+        return blobs
+
+    def _db_operation(self, doc: dict):
+        """文档 → (集合名, 幂等键, 待保存内容)；未知类型返回 None"""
+        kind = doc.get('kind')
+        key = {
+            'task_name': doc.get('task_name', 'unknown'),
+            'screen_count': doc.get('screen_count', -1)
+        }
+        to_save = {
+            **key,
+            'screenshot_path': doc.get('screenshot_path'),
+            'created_at': doc.get('created_at', datetime.now())
+        }
+        if kind == 'screen_bundle':
+            # 截图与 XML 正文写入内容寻址仓库，文档只保存哈希（相同屏幕只存一份）
+            to_save['blobs'] = self._put_bundle_blobs(doc)
+            return 'temp_xmls_bundle', key, to_save
+        if kind == 'screenshot':
+            return 'temp_screenshots_meta', key, to_save
+        return None
+
+    def _write_db_batch(self, db, batch: list) -> None:
+        """每个集合一次 bulk_write；同一批内同一键只保留最后一条（与逐条 replace_one 的结果一致）"""
+        grouped = {}
+        for doc in batch:
+            try:
+                operation = self._db_operation(doc)
+            except Exception as e:
+                log(f"DB doc prepare failed: {e}", "red")
+                continue
+            if operation is None:
+                continue
+            collection_name, key, to_save = operation
+            grouped.setdefault(collection_name, {})[(key['task_name'], key['screen_count'])] = (key, to_save)
+
+        for collection_name, operations in grouped.items():
+            requests = [ReplaceOne(key, to_save, upsert=True) for key, to_save in operations.values()]
+            db[collection_name].bulk_write(requests, ordered=False)
+
+    def _record_db_batch(self, size: int, elapsed_ms: float) -> None:
+        with self._db_metrics_lock:
+            self._db_metrics['written'] += size
+            self._db_metrics['batches'] += 1
+            self._db_latencies.append(elapsed_ms)
+
+    def get_db_queue_stats(self) -> dict:
+        with self._db_metrics_lock:
+            latencies = sorted(self._db_latencies)
+            metrics = dict(self._db_metrics)
+
+        def percentile(q):
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3) if latencies else 0.0
+
+        return {
+            'db_queue_size': self.db_queue.qsize(),
+            'db_queue_maxsize': self.db_queue.maxsize,
+            'db_spill_size': len(self.db_spill),
+            **metrics,
+            'write_ms_p50': percentile(0.5),
+            'write_ms_p95': percentile(0.95),
+        }
 
     def _db_worker(self):
-        """后台DB写入线程：批量、合并策略"""
+        """后台DB写入线程：批量拉取，按集合 bulk_write；写入失败或队列拥堵时溢出到磁盘，空闲时回放"""
         db = None
-        collection_xml = None
-        collection_shot = None
         while True:
             try:
-                # 批量拉取
+                # 批量拉取；队列为空时从磁盘溢出队列回放
                 batch = []
-                item = self.db_queue.get()
-                if item is not None:
-                    batch.append(item)
+                try:
+                    item = self.db_queue.get(timeout=1.0)
+                    if item is not None:
+                        batch.append(item)
+                except queue.Empty:
+                    pass
                 t0 = time.time()
-                while len(batch) < 50 and (time.time() - t0) < 0.5:
+                while batch and len(batch) < 50 and (time.time() - t0) < 0.5:
                     try:
                         batch.append(self.db_queue.get(timeout=0.05))
                     except queue.Empty:
                         break
+                if len(batch) < 50 and self.db_queue.empty() and len(self.db_spill):
+                    replayed = self.db_spill.take(50 - len(batch))
+                    batch.extend(replayed)
+                    with self._db_metrics_lock:
+                        self._db_metrics['replayed'] += len(replayed)
 
                 if not batch:
                     continue
@@ -1366,49 +1468,27 @@ class Server:
                 if db is None:
                     try:
                         db = get_db()
-                        collection_xml = db['temp_xmls_bundle']
-                        collection_shot = db['temp_screenshots_meta']
                     except Exception as e:
                         log(f"DB init failed in worker: {e}", "red")
                         db = None
+                        self.db_spill.put_many(batch)
+                        with self._db_metrics_lock:
+                            self._db_metrics['spilled'] += len(batch)
+                        time.sleep(1.0)
                         continue
 
                 # 写入
-                for doc in batch:
-                    kind = doc.get('kind')
-                    if kind == 'screen_bundle' and collection_xml is not None:
-                        # 合并为一个文档（同一screen_count幂等）
-                        key = {
-                            'task_name': doc.get('task_name', 'unknown'),
-                            'screen_count': doc.get('screen_count', -1)
-                        }
-                        to_save = {
-                            **key,
-                            'screenshot_path': doc.get('screenshot_path'),
-                            'raw_xml': doc.get('raw_xml'),
-                            'parsed_xml': doc.get('parsed_xml'),
-                            'hierarchy_xml': doc.get('hierarchy_xml'),
-                            'encoded_xml': doc.get('encoded_xml'),
-                            'created_at': doc.get('created_at', datetime.now())
-                        }
-                        try:
-                            collection_xml.replace_one(key, to_save, upsert=True)
-                        except Exception as e:
-                            log(f"DB write (bundle) failed: {e}", "red")
-                    elif kind == 'screenshot' and collection_shot is not None:
-                        key = {
-                            'task_name': doc.get('task_name', 'unknown'),
-                            'screen_count': doc.get('screen_count', -1)
-                        }
-                        to_save = {
-                            **key,
-                            'screenshot_path': doc.get('screenshot_path'),
-                            'created_at': doc.get('created_at', datetime.now())
-                        }
-                        try:
-                            collection_shot.replace_one(key, to_save, upsert=True)
-                        except Exception as e:
-                            log(f"DB write (shot) failed: {e}", "red")
+                start = time.perf_counter()
+                try:
+                    self._write_db_batch(db, batch)
+                    self._record_db_batch(len(batch), (time.perf_counter() - start) * 1000.0)
+                except Exception as e:
+                    log(f"DB bulk write failed, spilled {len(batch)} docs: {e}", "red")
+                    self.db_spill.put_many(batch)
+                    with self._db_metrics_lock:
+                        self._db_metrics['failed'] += 1
+                        self._db_metrics['spilled'] += len(batch)
+                    time.sleep(1.0)
             except Exception as e:
                 log(f"DB worker loop error: {e}", "red")
 
@@ -1455,12 +1535,15 @@ class Server:
                 'enable_db': self.enable_db
             },
             'database': None,
-            'queue': {
-                'db_queue_size': self.db_queue.qsize(),
-                'db_queue_maxsize': self.db_queue.maxsize
-            },
+            'queue': self.get_db_queue_stats(),
             'sessions': self.session_manager.get_session_stats(),
             'async_processor': async_processor.get_stats(),
+            'screen_cache': screen_cache.get_stats(),
+            'llm_clients': get_client_stats(),
+            'llm_cache': llm_cache.get_stats(),
+            'write_behind': write_behind.get_stats(),
+            'dataframe_cache': dataframe_cache.get_stats(),
+            'blob_store': blob_store.get_stats(),
             'message_queue': message_queue.get_status()
         }
 
@@ -1487,13 +1570,25 @@ class Server:
         self.session_manager.shutdown()
         log("会话管理器已关闭", "green")
 
+        # 落盘写后队列中剩余的写入（需在关闭 MongoDB 连接之前）
+        write_behind.close()
+        log("写后持久化队列已落盘", "green")
+
+        # 等待DB写入队列处理完成（最多10秒），剩余文档溢出到磁盘，下次启动后回放
+        deadline = time.time() + 10
+        while not self.db_queue.empty() and time.time() < deadline:
+            time.sleep(0.1)
+        remaining = []
+        while True:
+            try:
+                remaining.append(self.db_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.db_spill.put_many([doc for doc in remaining if doc is not None])
+
         # 关闭MongoDB连接
         if self.enable_db:
             close_connection()
             log("MongoDB连接已关闭", "green")
 
-        # 等待队列处理完成
-        while not self.db_queue.empty():
-            time.sleep(0.1)
-
         log("服务器已关闭", "green")
\ No newline at end of file
@@ -14,6 +14,7 @@ import json
 from mobilegpt import MobileGPT
 from memory.memory_manager import Memory
 from log_config import log
+from utils.write_behind import write_behind
 
 
 @dataclass
@@ -168,6 +169,9 @@ class SessionManager:
                 session.client_socket.close()
         except Exception as e:
             log(f"清理会话资源时出错: {e}", "red")
+
+        # 会话结束时只落盘该会话登记的写入（及其之前的条目），不等待其他会话
+        write_behind.flush_owner(session_id)
         
         # 移除会话和锁
         with self.session_locks.get(session_id, threading.RLock()):
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import env_config  # noqa: E402,F401  开启 Copy-on-Write
+from utils.dataframe_cache import DataFrameCache  # noqa: E402
+
+KEY = ("tasks", ("index", "name"), ())
+
+
+def _cached_frame():
+    cache = DataFrameCache(max_bytes=1 << 20, ttl_seconds=0)
+    df = pd.DataFrame({"index": [0, 1, 2], "name": ["a", "b", "c"]})
+    cache.put(KEY, df)
+    return cache, df
+
+
+def test_copy_on_write_enabled_at_startup():
+    assert pd.get_option("mode.copy_on_write")
+    assert DataFrameCache().get_stats()["copy_on_write"]
+
+
+def test_hit_shares_data_with_cached_frame():
+    cache, df = _cached_frame()
+    hit = cache.get(KEY)
+    assert hit is not df
+    assert np.shares_memory(hit["index"].to_numpy(), df["index"].to_numpy())
+
+
+def test_mutating_hit_does_not_change_cached_frame():
+    cache, df = _cached_frame()
+    hit = cache.get(KEY)
+    hit.loc[0, "index"] = 99
+    hit["name"] = "x"
+    hit.set_index("index", drop=False, inplace=True)
+
+    assert df["index"].tolist() == [0, 1, 2]
+    assert df["name"].tolist() == ["a", "b", "c"]
+    again = cache.get(KEY)
+    assert again["index"].tolist() == [0, 1, 2]
+    assert again["name"].tolist() == ["a", "b", "c"]
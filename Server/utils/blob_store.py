@@ -0,0 +1,226 @@
+"""
+内容寻址的 blob 仓库
+截图与各类 XML 按 SHA-256 存放在 MEMORY_DIRECTORY/blobs/<前2位>/<哈希>，相同内容只存一份；
+XML 在安装了 zstandard 时压缩存放（<哈希>.zst）。页面 screen 目录与 MongoDB 文档只记录哈希。
+
+用法（清理未被引用的 blob）：
+    python -m utils.blob_store --gc [--grace-hours 24] [--dry-run]
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from env_config import Config
+
+# zstd 为可选依赖（zstandard）
+_HAS_ZSTD = importlib.util.find_spec("zstandard") is not None
+
+# 页面截图/XML 清单文件名（memory/log/<task>/pages/<index>/screen/manifest.jsonl）
+MANIFEST_NAME = "manifest.jsonl"
+# 清单中引用 blob 的字段
+SCREEN_VIEWS = ('screenshot', 'raw', 'parsed', 'hierarchy', 'html', 'pretty')
+
+
+class BlobStore:
+
+    def __init__(self, root: str, compress_text: bool = True):
+        self.root = root
+        self.compress_text = compress_text and _HAS_ZSTD
+        self._lock = threading.Lock()
+        self._stats = {'puts': 0, 'dedup_hits': 0, 'bytes_written': 0, 'bytes_deduped': 0}
+
+    def _path(self, digest: str, compressed: bool) -> str:
+        return os.path.join(self.root, digest[:2], digest + (".zst" if compressed else ""))
+
+    def path_for(self, digest: str) -> Optional[str]:
+        for compressed in (False, True):
+            path = self._path(digest, compressed)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def exists(self, digest: str) -> bool:
+        return self.path_for(digest) is not None
+
+    def put(self, data, compress: bool = False) -> str:
+        """写入内容并返回 SHA-256；已存在时不重复写入。compress=True 且可用时以 zstd 压缩存放"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._stats['puts'] += 1
+        existing = self.path_for(digest)
+        if existing is not None:
+            # 刷新修改时间：并发 GC 的宽限期按 mtime 判断，刚被重新引用的旧 blob 不会被删除
+            try:
+                os.utime(existing)
+            except OSError:
+                pass
+            with self._lock:
+                self._stats['dedup_hits'] += 1
+                self._stats['bytes_deduped'] += len(data)
+            return digest
+
+        compressed = compress and self.compress_text
+        payload = data
+        if compressed:
+            import zstandard
+            payload = zstandard.ZstdCompressor(level=3).compress(data)
+        path = self._path(digest, compressed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 临时文件名带线程标识，多个线程同时写入同一内容时互不影响
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._stats['bytes_written'] += len(payload)
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        path = self.path_for(digest)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if path.endswith(".zst"):
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def iter_digests(self) -> Iterable[tuple]:
+        """遍历 (哈希, 路径)"""
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.endswith(".tmp"):
+                    continue
+                yield name.split(".", 1)[0], os.path.join(prefix_dir, name)
+
+    def gc(self, referenced: Set[str], grace_seconds: float = 24 * 3600, dry_run: bool = False) -> dict:
+        """删除未被引用且超过 grace_seconds 未修改的 blob（新写入、清单尚未落盘的 blob 不会被误删）"""
+        now = time.time()
+        removed = kept = freed = 0
+        for digest, path in list(self.iter_digests()):
+            if digest in referenced:
+                kept += 1
+                continue
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime < grace_seconds:
+                    kept += 1
+                    continue
+                if not dry_run:
+                    os.remove(path)
+                removed += 1
+                freed += stat.st_size
+            except OSError:
+                continue
+        return {'removed': removed, 'kept': kept, 'freed_bytes': freed}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+def write_screen_bundle(dest_dir: str, screenshot: Optional[bytes], views: Dict[str, str], **meta) -> dict:
+    """截图与 XML 视图写入 blob 仓库，并在 dest_dir/manifest.jsonl 追加一条引用记录（不覆盖历史）"""
+    record = {'ts': time.time(), **meta}
+    if screenshot:
+        record['screenshot'] = blob_store.put(screenshot)
+    for name, content in views.items():
+        if content is not None:
+            record[name] = blob_store.put(content, compress=True)
+    os.makedirs(dest_dir, exist_ok=True)
+    with open(os.path.join(dest_dir, MANIFEST_NAME), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    return record
+
+
+def read_screen_bundle(dest_dir: str, position: int = -1) -> Optional[dict]:
+    """读取清单中的一条记录（默认最新一条），返回 {字段: 内容}；截图为 bytes，XML 为 str"""
+    path = os.path.join(dest_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    if not records:
+        return None
+    record = records[position]
+    bundle = {key: value for key, value in record.items() if key not in SCREEN_VIEWS}
+    for name in SCREEN_VIEWS:
+        if name in record:
+            data = blob_store.get(record[name])
+            bundle[name] = data if name == 'screenshot' or data is None else data.decode("utf-8")
+    return bundle
+
+
+def collect_local_references(root: Optional[str] = None) -> Set[str]:
+    """扫描 memory/log 下所有 screen 清单中引用的哈希"""
+    root = root or os.path.join(Config.MEMORY_DIRECTORY, "log")
+    referenced: Set[str] = set()
+    for directory, _, files in os.walk(root):
+        if MANIFEST_NAME not in files:
+            continue
+        with open(os.path.join(directory, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                referenced.update(record[name] for name in SCREEN_VIEWS if record.get(name))
+    return referenced
+
+
+def collect_db_references() -> Set[str]:
+    """MongoDB 中引用的哈希（screen_bundles 与 temp_xmls_bundle 文档的 blobs 字段）"""
+    from utils.mongo_utils import get_db
+    db = get_db()
+    referenced: Set[str] = set()
+    for collection_name in ('screen_bundles', 'temp_xmls_bundle'):
+        for doc in db[collection_name].find({'blobs': {'$exists': True}}, {'blobs': 1, '_id': 0}):
+            referenced.update(value for value in (doc.get('blobs') or {}).values() if value)
+    return referenced
+
+
+# 全局 blob 仓库
+blob_store = BlobStore(os.path.join(Config.MEMORY_DIRECTORY, "blobs"), compress_text=Config.BLOB_STORE_COMPRESS_XML)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="内容寻址 blob 仓库维护")
+    parser.add_argument("--gc", action="store_true", help="删除未被任何清单/数据库文档引用的 blob")
+    parser.add_argument("--grace-hours", type=float, default=24.0, help="最近修改过的 blob 不删除（小时）")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不删除")
+    args = parser.parse_args(argv)
+
+    if not args.gc:
+        count = sum(1 for _ in blob_store.iter_digests())
+        print(f"blobs={count} root={os.path.abspath(blob_store.root)} zstd={'on' if blob_store.compress_text else 'off'}")
+        return
+
+    referenced = collect_local_references()
+    if Config.ENABLE_DB:
+        referenced |= collect_db_references()
+    result = blob_store.gc(referenced, grace_seconds=args.grace_hours * 3600, dry_run=args.dry_run)
+    print(f"blob GC{'（dry-run）' if args.dry_run else ''}: 引用={len(referenced)}, 删除={result['removed']}, "
+          f"保留={result['kept']}, 释放={result['freed_bytes']} 字节")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+load_dataframe 的进程级 DataFrame 缓存
+- 线程安全，按字节数做 LRU 淘汰（DataFrame 的 memory_usage(deep=True)）
+- 失效由事件驱动：MongoDB 变更流（副本集/分片集群）通知其他进程的写入；
+  变更流不可用（单机 mongod）时退回本进程写入钩子 + 最长存活时间
+- 每个集合维护版本号：加载期间集合被写入或作废时不缓存加载结果，避免留下旧数据
+- 命中返回只读视图：Copy-on-Write 生效时为浅拷贝（调用方修改会在其自己的副本上进行），
+  否则退回深拷贝；env_config 在启动时开启 Copy-on-Write（PANDAS_COPY_ON_WRITE）
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import pandas as pd
+
+from env_config import Config
+
+
+def _copy_on_write_enabled() -> bool:
+    if int(pd.__version__.split(".", 1)[0]) >= 3:
+        return True
+    try:
+        return bool(pd.get_option("mode.copy_on_write"))
+    except (KeyError, ValueError):
+        return False
+
+
+def readonly_view(df: pd.DataFrame) -> pd.DataFrame:
+    """返回与缓存共享数据、但修改不会影响缓存的 DataFrame"""
+    return df.copy(deep=not _copy_on_write_enabled())
+
+
+def _frame_bytes(df: pd.DataFrame) -> int:
+    try:
+        return int(df.memory_usage(index=True, deep=True).sum())
+    except Exception:
+        return 0
+
+
+class _Entry:
+    __slots__ = ('df', 'nbytes', 'loaded_at')
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.nbytes = _frame_bytes(df)
+        self.loaded_at = time.time()
+
+
+class DataFrameCache:
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl_seconds: float = 300):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # 键为 (集合名, 列元组, scope 元组)
+        self._entries: "OrderedDict[Tuple[str, tuple, tuple], _Entry]" = OrderedDict()
+        self._total_bytes = 0
+        self._versions: Dict[str, int] = {}
+        self._watching = False
+        self._watcher = None
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0,
+                       'refreshes': 0, 'change_events': 0}
+
+    # ---- 读写 ----
+
+    def version(self, collection_name: str) -> int:
+        with self._lock:
+            return self._versions.get(collection_name, 0)
+
+    def get(self, key: Tuple[str, tuple, tuple]) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            # 有变更流时条目只会被事件作废；否则按存活时间兜底其他进程的写入
+            if not self._watching and self.ttl_seconds > 0 and time.time() - entry.loaded_at > self.ttl_seconds:
+                self._remove(key)
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            df = entry.df
+        return readonly_view(df)
+
+    def put(self, key: Tuple[str, tuple, tuple], df: pd.DataFrame, version: Optional[int] = None) -> None:
+        """缓存一份调用方不再修改的 DataFrame；version 与集合当前版本不一致时放弃"""
+        entry = _Entry(df)
+        with self._lock:
+            if version is not None and self._versions.get(key[0], 0) != version:
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._total_bytes += entry.nbytes
+            self._evict()
+
+    def load(self, key: Tuple[str, tuple, tuple], loader: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """命中时返回只读视图；未命中时调用 loader 加载并缓存"""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        version = self.version(key[0])
+        df = loader()
+        self.put(key, df, version)
+        return readonly_view(df)
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry.nbytes
+
+    def _evict(self) -> None:
+        # 至少保留最近使用的一项，即使它单独超过上限
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry.nbytes
+            self._stats['evictions'] += 1
+
+    # ---- 写入钩子 ----
+
+    def refresh(self, collection_name: str, build: Callable[[pd.DataFrame, tuple], Optional[pd.DataFrame]],
+                scope: tuple = ()) -> None:
+        """
+        本进程写入成功后用新内容替换该集合（scope 范围内）的已缓存投影（而不是整体丢弃）。
+        build(旧 DataFrame, 列) 返回新的投影，返回 None 时作废该条目。
+        """
+        with self._lock:
+            self._versions[collection_name] = self._versions.get(collection_name, 0) + 1
+            version = self._versions[collection_name]
+            keys = [key for key in self._entries if key[0] == collection_name and key[2] == scope]
+            current = {key: self._entries[key].df for key in keys}
+        for key in keys:
+            try:
+                new_df = build(current[key], key[1])
+            except Exception:
+                new_df = None
+            if new_df is None:
+                with self._lock:
+                    self._remove(key)
+                continue
+            self.put(key, new_df, version)
+            with self._lock:
+                self._stats['refreshes'] += 1
+
+    def invalidate(self, collection_name: str) -> None:
+        with self._lock:
+            self._versions[collection_name] = self._versions.get(collection_name, 0) + 1
+            for key in [key for key in self._entries if key[0] == collection_name]:
+                self._remove(key)
+            self._stats['invalidations'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for collection_name in {key[0] for key in self._entries}:
+                self._versions[collection_name] = self._versions.get(collection_name, 0) + 1
+            self._entries.clear()
+            self._total_bytes = 0
+
+    # ---- 变更流 ----
+
+    @property
+    def watching(self) -> bool:
+        return self._watching
+
+    def start_change_stream(self, get_db: Callable) -> None:
+        """后台订阅数据库级变更流，其他进程/服务器的写入到达时作废对应集合（只启动一次）"""
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, args=(get_db,), name="dataframe-cache-watch",
+                                             daemon=True)
+        self._watcher.start()
+
+    def _watch(self, get_db: Callable) -> None:
+        from pymongo.errors import OperationFailure, PyMongoError
+
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete',
+                                                          'drop', 'rename', 'dropDatabase', 'invalidate']}}}]
+        backoff = 1.0
+        while True:
+            try:
+                with get_db().watch(pipeline) as stream:
+                    # 订阅建立之前缓存的内容可能已过期
+                    self.clear()
+                    self._watching = True
+                    backoff = 1.0
+                    print("DataFrame 缓存已订阅 MongoDB 变更流")
+                    for change in stream:
+                        self._on_change(change)
+                # 流被服务器关闭（如 invalidate 事件）后重新订阅
+                self._watching = False
+                self.clear()
+            except OperationFailure as e:
+                # 单机 mongod 不支持变更流（需副本集）：退回写入钩子 + 存活时间
+                self._watching = False
+                print(f"MongoDB 变更流不可用，DataFrame 缓存改用写入钩子失效: {e}")
+                return
+            except PyMongoError as e:
+                # 连接中断期间可能漏掉事件，清空后重连
+                self._watching = False
+                self.clear()
+                print(f"MongoDB 变更流中断，{backoff:.0f}s 后重试: {e}")
+            except Exception as e:
+                self._watching = False
+                self.clear()
+                print(f"MongoDB 变更流异常: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+    def _on_change(self, change: dict) -> None:
+        with self._lock:
+            self._stats['change_events'] += 1
+        operation = change.get('operationType')
+        if operation in ('dropDatabase', 'invalidate'):
+            self.clear()
+            return
+        collection_name = (change.get('ns') or {}).get('coll')
+        if collection_name:
+            self.invalidate(collection_name)
+        target = (change.get('to') or {}).get('coll')
+        if target:
+            self.invalidate(target)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hit_rate': (self._stats['hits'] / lookups) if lookups > 0 else 0.0,
+                'change_stream': self._watching,
+                'copy_on_write': _copy_on_write_enabled(),
+            }
+
+    def cached_keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._entries)
+
+
+# 全局 DataFrame 缓存实例
+dataframe_cache = DataFrameCache(max_bytes=Config.DATAFRAME_CACHE_MAX_MB * 1024 * 1024,
+                                 ttl_seconds=Config.DATAFRAME_CACHE_TTL_SECONDS)
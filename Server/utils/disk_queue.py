@@ -0,0 +1,87 @@
+"""
+本地磁盘溢出队列（JSON Lines）
+DB 写入队列已满或数据库暂时不可用时，文档先追加到磁盘，待队列空闲后再取回写入，不再直接丢弃。
+文档中的 bytes / datetime 字段按标记编码，取回时还原。
+"""
+
+import base64
+import json
+import os
+import threading
+from datetime import datetime
+from typing import List
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__b64__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {'__dt__': value.isoformat()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '__b64__' in value:
+            return base64.b64decode(value['__b64__'])
+        if '__dt__' in value:
+            return datetime.fromisoformat(value['__dt__'])
+    return value
+
+
+class DiskSpillQueue:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._size = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._size is None:
+                self._size = len(self._read_lines())
+            return self._size
+
+    def _read_lines(self) -> List[str]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return [line for line in f if line.strip()]
+
+    def put_many(self, docs: List[dict]) -> None:
+        if not docs:
+            return
+        lines = [json.dumps({k: _encode(v) for k, v in doc.items()}, ensure_ascii=False, default=str) + "\n"
+                 for doc in docs]
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            if self._size is not None:
+                self._size += len(lines)
+
+    def take(self, max_items: int) -> List[dict]:
+        """按写入顺序取出最多 max_items 条（从文件中移除）；进程中断留下的不完整行被丢弃"""
+        with self._lock:
+            lines = self._read_lines()
+            if not lines:
+                self._size = 0
+                return []
+            taken, rest = lines[:max_items], lines[max_items:]
+            if rest:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.writelines(rest)
+                os.replace(tmp_path, self.path)
+            else:
+                os.remove(self.path)
+            self._size = len(rest)
+        docs = []
+        for line in taken:
+            try:
+                docs.append({k: _decode(v) for k, v in json.loads(line).items()})
+            except ValueError:
+                continue
+        return docs
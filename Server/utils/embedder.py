@@ -0,0 +1,119 @@
+"""
+微批量嵌入器
+汇总所有会话在短时间窗口（默认 5ms）内的嵌入请求，合并为一次 embeddings.create 调用后把结果分发回各调用方；
+另提供 embed_many 批量接口（用于整任务重新嵌入，走后台限流通道，不与交互请求争抢）。
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+from log_config import log
+from utils.llm_client import get_client, model_slot
+from utils.rate_limiter import BACKGROUND, NORMAL
+
+
+class MicroBatchEmbedder:
+
+    def __init__(self, max_batch: int = 10, max_wait_ms: float = 5.0):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: "queue.Queue[Tuple[str, str, str, dict, Future]]" = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'texts': 0, 'batches': 0, 'errors': 0}
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._worker_lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                    self._worker.start()
+
+    def submit(self, text: str, model: str, **kwargs) -> Future:
+        """提交一个待嵌入文本，返回 Future；同一窗口内相同 (model, kwargs) 的请求会被合并"""
+        future = Future()
+        group = json.dumps([model, kwargs], sort_keys=True, default=str)
+        self._queue.put((group, text, model, kwargs, future))
+        self._ensure_worker()
+        return future
+
+    def embed(self, text: str, model: str, **kwargs) -> List[float]:
+        return self.submit(text, model, **kwargs).result()
+
+    def embed_many(self, texts: List[str], model: str, **kwargs) -> List[List[float]]:
+        """批量接口：直接按 max_batch 切块请求，不经过合并队列；相同文本只请求一次"""
+        unique = list(dict.fromkeys(texts))
+        vectors: Dict[str, List[float]] = {}
+        for i in range(0, len(unique), self.max_batch):
+            chunk = unique[i:i + self.max_batch]
+            vectors.update(zip(chunk, self._create(chunk, model, kwargs, priority=BACKGROUND)))
+        return [vectors[t] for t in texts]
+
+    def _create(self, texts: List[str], model: str, kwargs: dict, priority: int = NORMAL) -> List[List[float]]:
+        tokens = sum(len(text.encode('utf-8')) for text in texts) // 3
+        with model_slot(model, priority, tokens) as slot:
+            response = get_client().embeddings.create(input=texts, model=model, **kwargs)
+            slot.record_usage(response)
+        ordered = sorted(response.data, key=lambda d: d.index)
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['texts'] += len(texts)
+        return [d.embedding for d in ordered]
+
+    def _collect(self) -> list:
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            with self._stats_lock:
+                self._stats['requests'] += len(items)
+
+            groups: Dict[str, list] = {}
+            for item in items:
+                groups.setdefault(item[0], []).append(item)
+
+            for batch in groups.values():
+                _, _, model, kwargs, _ = batch[0]
+                texts = list(dict.fromkeys(item[1] for item in batch))
+                try:
+                    vectors = dict(zip(texts, self._create(texts, model, kwargs)))
+                except Exception as e:
+                    with self._stats_lock:
+                        self._stats['errors'] += 1
+                    log(f"批量嵌入请求失败: model={model}, size={len(texts)}, error={e}", "red")
+                    for item in batch:
+                        item[4].set_exception(e)
+                    continue
+                for _, text, _, _, future in batch:
+                    future.set_result(vectors[text])
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['avg_batch_size'] = stats['texts'] / stats['batches'] if stats['batches'] else 0.0
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+
+# 全局嵌入器实例（DashScope text-embedding 单次最多 10~25 条输入，默认取 10）
+embedder = MicroBatchEmbedder(
+    max_batch=int(os.getenv("EMBED_BATCH_SIZE", "10")),
+    max_wait_ms=float(os.getenv("EMBED_BATCH_WAIT_MS", "5")),
+)
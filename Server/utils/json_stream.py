@@ -0,0 +1,94 @@
+"""
+大模型输出的增量 JSON 解析
+逐块输入流式输出的文本，在第一个顶层 JSON 对象中某个键的值完整出现时立即解析出来，
+不必等待整个对象（及其后的说明文字）输出完毕。
+与 utils.utils 中 __parse_json 的约定一致：跳过第一个 '{' 之前的内容，只关注第一个顶层对象。
+"""
+
+import json
+from typing import Any, Dict, List
+
+
+class IncrementalJSONObject:
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        # 第一个顶层对象已闭合
+        self.closed = False
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        # 顶层对象内的状态：key（等待键）/ colon（等待冒号）/ value（读取值）
+        self._expect = 'key'
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk: str) -> List[str]:
+        """输入一段文本，返回本次新解析完成的顶层键"""
+        if self.closed or not chunk:
+            return []
+        self._text += chunk
+        completed = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._expect == 'key':
+                        try:
+                            self._key = json.loads(text[self._string_start:i + 1])
+                        except ValueError:
+                            self._key = text[self._string_start + 1:i]
+                        self._expect = 'colon'
+                continue
+
+            if self._depth == 0:
+                # 第一个 '{' 之前的内容（如 ```json 前缀）直接跳过
+                if ch == '{':
+                    self._depth = 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in ']}':
+                if self._depth == 1:
+                    self._complete_value(text, i, completed)
+                    self.closed = True
+                    self._pos = i + 1
+                    return completed
+                self._depth -= 1
+            elif self._depth == 1:
+                if ch == ':' and self._expect == 'colon':
+                    self._expect = 'value'
+                    self._value_start = i + 1
+                elif ch == ',':
+                    self._complete_value(text, i, completed)
+        self._pos = len(text)
+        return completed
+
+    def _complete_value(self, text: str, end: int, completed: List[str]) -> None:
+        if self._expect == 'value':
+            raw = text[self._value_start:end].strip()
+            try:
+                self.fields[self._key] = json.loads(raw)
+                completed.append(self._key)
+            except ValueError:
+                # 值不是合法 JSON（模型输出格式错误）：忽略该键，整段输出结束后再按完整文本解析
+                pass
+        self._expect = 'key'
+        self._key = None
+        self._value_start = None
+
+    def has(self, keys) -> bool:
+        return all(key in self.fields for key in keys)
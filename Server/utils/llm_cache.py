@@ -0,0 +1,256 @@
+"""
+持久化 LLM 响应缓存（query 的第二级缓存，进程内 OrderedDict 之后；LLM_CACHE_BACKEND=memory 时不启用）
+- sqlite：MEMORY_DIRECTORY/llm_cache.sqlite（WAL 模式），同一主机上的多个服务器进程共享，重启后仍有效
+- mongo：llm_cache 集合，多台服务器共享；过期由 TTL 索引清理
+- 条目按写入时间过期（LLM_CACHE_TTL_SECONDS），超过 LLM_CACHE_MAX_ENTRIES 时按最近访问时间淘汰
+- 缓存键可由各 agent 按语义给出（如 derive：子任务 + 规范化后的界面），界面 XML 中每次运行都会变化的
+  view id 在计算键之前去掉，同一任务在多台设备上回放时命中相同的 select / derive 调用
+只缓存解析成功的 JSON（dict / list）。
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from env_config import Config
+from log_config import log
+
+# 解析器为每个节点生成的 id（view_<hash>）在不同设备/运行间不同，动作只引用 index
+_VIEW_ID = re.compile(r'\s+id="view_[^"]*"')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def canonical_screen(screen: Any) -> str:
+    """界面 XML 的规范形式：去掉 view id、合并空白"""
+    if not isinstance(screen, str):
+        screen = json.dumps(screen, ensure_ascii=False, sort_keys=True, default=str)
+    return _WHITESPACE.sub(" ", _VIEW_ID.sub("", screen)).strip()
+
+
+def make_key(*parts) -> str:
+    raw = json.dumps([Config.LLM_CACHE_NAMESPACE, *parts], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SqliteBackend:
+
+    # 每写入多少条检查一次容量与过期
+    MAINTAIN_EVERY = 256
+
+    def __init__(self, path: str, ttl_seconds: int, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache ("
+                         "key TEXT PRIMARY KEY, agent TEXT, value TEXT NOT NULL, "
+                         "created REAL NOT NULL, accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每个线程一个连接；WAL 允许多进程并发读、单写
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        row = conn.execute("SELECT value, created, accessed FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created, accessed = row
+        now = time.time()
+        if self.ttl_seconds > 0 and now - created > self.ttl_seconds:
+            return None
+        # 访问时间只用于容量淘汰，粗粒度更新即可，避免每次命中都写库
+        if now - accessed > 60:
+            try:
+                with conn:
+                    conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            except sqlite3.Error:
+                pass
+        return value
+
+    def set(self, key: str, value: str, agent: Optional[str]) -> None:
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, agent, value, created, accessed) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, agent, value, now, now))
+        with self._lock:
+            self._writes += 1
+            maintain = self._writes % self.MAINTAIN_EVERY == 0
+        if maintain:
+            self.maintain()
+
+    def maintain(self) -> int:
+        """删除过期条目并按最近访问时间淘汰超出容量的条目，返回删除数"""
+        conn = self._connect()
+        removed = 0
+        with conn:
+            if self.ttl_seconds > 0:
+                removed += conn.execute("DELETE FROM llm_cache WHERE created < ?",
+                                        (time.time() - self.ttl_seconds,)).rowcount
+            count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if self.max_entries > 0 and count > self.max_entries:
+                # 一次多淘汰 10%，避免每次写入都触发
+                excess = count - int(self.max_entries * 0.9)
+                removed += conn.execute("DELETE FROM llm_cache WHERE key IN "
+                                        "(SELECT key FROM llm_cache ORDER BY accessed LIMIT ?)", (excess,)).rowcount
+        return removed
+
+    def get_stats(self) -> dict:
+        try:
+            count = self._connect().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        except sqlite3.Error:
+            count = None
+        return {'backend': 'sqlite', 'path': self.path, 'entries': count}
+
+
+class MongoBackend:
+
+    MAINTAIN_EVERY = 256
+
+    def __init__(self, collection_name: str, ttl_seconds: int, max_entries: int):
+        from utils.mongo_utils import get_db
+        self.collection = get_db()[collection_name]
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        if ttl_seconds > 0:
+            try:
+                self.collection.create_index('created_at', expireAfterSeconds=ttl_seconds)
+            except Exception as e:
+                # 已有不同过期时间的同名索引：读取时仍按 created_at 判断过期
+                log(f"LLM 缓存 TTL 索引创建失败: {e}", "yellow")
+        self.collection.create_index('accessed_at')
+
+    def get(self, key: str) -> Optional[str]:
+        doc = self.collection.find_one({'_id': key}, {'value': 1, 'created_at': 1, 'accessed_at': 1})
+        if doc is None:
+            return None
+        now = datetime.utcnow()
+        if self.ttl_seconds > 0 and now - doc['created_at'] > timedelta(seconds=self.ttl_seconds):
+            return None
+        if now - doc.get('accessed_at', doc['created_at']) > timedelta(seconds=60):
+            self.collection.update_one({'_id': key}, {'$set': {'accessed_at': now}})
+        return doc['value']
+
+    def set(self, key: str, value: str, agent: Optional[str]) -> None:
+        now = datetime.utcnow()
+        self.collection.replace_one({'_id': key}, {'_id': key, 'agent': agent, 'value': value,
+                                                   'created_at': now, 'accessed_at': now}, upsert=True)
+        with self._lock:
+            self._writes += 1
+            maintain = self._writes % self.MAINTAIN_EVERY == 0
+        if maintain:
+            self.maintain()
+
+    def maintain(self) -> int:
+        # 过期由 TTL 索引清理，这里只处理容量
+        count = self.collection.estimated_document_count()
+        if self.max_entries <= 0 or count <= self.max_entries:
+            return 0
+        excess = count - int(self.max_entries * 0.9)
+        oldest = [doc['_id'] for doc in self.collection.find({}, {'_id': 1}).sort('accessed_at', 1).limit(excess)]
+        return self.collection.delete_many({'_id': {'$in': oldest}}).deleted_count
+
+    def get_stats(self) -> dict:
+        try:
+            count = self.collection.estimated_document_count()
+        except Exception:
+            count = None
+        return {'backend': 'mongo', 'collection': self.collection.name, 'entries': count}
+
+
+class PersistentLLMCache:
+
+    def __init__(self, backend: str, ttl_seconds: int, max_entries: int, path: str = ""):
+        self.backend_name = backend
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path or os.path.join(Config.MEMORY_DIRECTORY, "llm_cache.sqlite")
+        self._backend = None
+        self._init_lock = threading.Lock()
+        self._disabled = backend in ("", "memory", "off", "none", "false")
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return not self._disabled
+
+    def _get_backend(self):
+        if self._backend is None and not self._disabled:
+            with self._init_lock:
+                if self._backend is None and not self._disabled:
+                    try:
+                        if self.backend_name == "mongo":
+                            self._backend = MongoBackend("llm_cache", self.ttl_seconds, self.max_entries)
+                        else:
+                            self._backend = SqliteBackend(self.path, self.ttl_seconds, self.max_entries)
+                    except Exception as e:
+                        # 后端不可用时只保留进程内缓存
+                        log(f"持久化 LLM 缓存不可用（{self.backend_name}），已停用: {e}", "yellow")
+                        self._disabled = True
+        return self._backend
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get(self, key: str):
+        backend = self._get_backend()
+        if backend is None:
+            return None
+        try:
+            raw = backend.get(key)
+        except Exception as e:
+            self._count('errors')
+            log(f"读取 LLM 缓存失败: {e}", "yellow")
+            return None
+        if raw is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return json.loads(raw)
+
+    def set(self, key: str, value, agent: Optional[str] = None) -> None:
+        if not isinstance(value, (dict, list)):
+            return
+        backend = self._get_backend()
+        if backend is None:
+            return
+        try:
+            backend.set(key, json.dumps(value, ensure_ascii=False), agent)
+            self._count('writes')
+        except Exception as e:
+            self._count('errors')
+            log(f"写入 LLM 缓存失败: {e}", "yellow")
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats, enabled=self.enabled)
+        if self._backend is not None:
+            stats.update(self._backend.get_stats())
+        return stats
+
+
+# 全局持久化 LLM 缓存（首次使用时才打开后端）
+llm_cache = PersistentLLMCache(Config.LLM_CACHE_BACKEND, Config.LLM_CACHE_TTL_SECONDS, Config.LLM_CACHE_MAX_ENTRIES,
+                               path=Config.LLM_CACHE_PATH)
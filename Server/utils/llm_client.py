@@ -0,0 +1,245 @@
+"""
+进程级共享的大模型客户端注册表
+- 按 (base_url, api_key) 复用 OpenAI 客户端及其 httpx 连接池（keep-alive），避免每次请求重新建连/TLS 握手
+- 异步客户端（AsyncOpenAI）按事件循环区分，供 aquery 等协程使用
+- 按模型自适应限流（utils.rate_limiter：RPM/TPM 令牌桶、AIMD 并发上限、优先级通道），同步与异步调用共享
+- 超时与连接池大小由 env_config.Config 统一配置
+"""
+
+import asyncio
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from types import SimpleNamespace
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from env_config import Config
+from utils.rate_limiter import NORMAL, ModelGovernor, is_rate_limited, parse_rate_limits, retry_after
+
+_clients: Dict[Tuple[str, str], OpenAI] = {}
+_clients_lock = threading.Lock()
+# httpx.AsyncClient 的连接绑定创建它的事件循环，异步客户端按循环分别创建
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]]" = \
+    weakref.WeakKeyDictionary()
+# 进程级客户端替身（录制/回放工具使用），设置后 get_client 一律返回它
+_client_override = None
+_async_client_override = None
+
+_governors: Dict[str, ModelGovernor] = {}
+_governors_lock = threading.Lock()
+
+
+def _parse_model_concurrency(spec: str) -> Dict[str, int]:
+    limits = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            limits[name.strip()] = max(1, int(value.strip()))
+        except ValueError:
+            continue
+    return limits
+
+
+_configured_limits = _parse_model_concurrency(Config.LLM_MODEL_CONCURRENCY)
+_configured_rates = parse_rate_limits(Config.LLM_MODEL_RATE_LIMITS)
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=Config.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=Config.LLM_MAX_KEEPALIVE,
+        keepalive_expiry=Config.LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _build_http_client() -> httpx.Client:
+    return httpx.Client(
+        limits=_http_limits(),
+        timeout=httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+    )
+
+
+def get_client(base_url: Optional[str] = None, api_key: Optional[str] = None) -> OpenAI:
+    """获取共享的 OpenAI 客户端（线程安全，同一端点全进程只创建一次）"""
+    if _client_override is not None:
+        return _client_override
+    base_url = base_url or Config.LLM_BASE_URL
+    api_key = api_key or Config.LLM_API_KEY
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    timeout=httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+                    http_client=_build_http_client(),
+                )
+                _clients[key] = client
+    return client
+
+
+def get_async_client(base_url: Optional[str] = None, api_key: Optional[str] = None) -> AsyncOpenAI:
+    """获取当前事件循环上共享的 AsyncOpenAI 客户端（须在协程中调用）"""
+    if _async_client_override is not None:
+        return _async_client_override
+    loop = asyncio.get_running_loop()
+    base_url = base_url or Config.LLM_BASE_URL
+    api_key = api_key or Config.LLM_API_KEY
+    key = (base_url, api_key)
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+                http_client=httpx.AsyncClient(
+                    limits=_http_limits(),
+                    timeout=httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+                ),
+            )
+            clients[key] = client
+    return client
+
+
+class _AsyncClientAdapter:
+    """把同步客户端替身包装成 AsyncOpenAI 的调用方式：请求在默认线程池中执行"""
+
+    def __init__(self, client):
+        async def create_completion(*args, **kwargs):
+            return await asyncio.to_thread(client.chat.completions.create, *args, **kwargs)
+
+        async def create_embedding(*args, **kwargs):
+            return await asyncio.to_thread(client.embeddings.create, *args, **kwargs)
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create_completion))
+        self.embeddings = SimpleNamespace(create=create_embedding)
+
+
+def set_client_override(client) -> None:
+    """
+    替换进程内所有 get_client() / get_async_client() 的返回值（传 None 恢复）；
+    client 需提供 chat.completions.create / embeddings.create（同步接口，异步调用时在线程池中执行）
+    """
+    global _client_override, _async_client_override
+    _client_override = client
+    _async_client_override = _AsyncClientAdapter(client) if client is not None else None
+
+
+def _get_governor(model: str) -> ModelGovernor:
+    governor = _governors.get(model)
+    if governor is None:
+        with _governors_lock:
+            governor = _governors.get(model)
+            if governor is None:
+                rpm, tpm = _configured_rates.get(model, (Config.LLM_DEFAULT_RPM, Config.LLM_DEFAULT_TPM))
+                governor = ModelGovernor(
+                    model,
+                    max_concurrency=_configured_limits.get(model, Config.LLM_DEFAULT_CONCURRENCY),
+                    rpm=rpm,
+                    tpm=tpm,
+                    min_concurrency=Config.LLM_MIN_CONCURRENCY,
+                    latency_target=Config.LLM_LATENCY_TARGET,
+                    background_share=Config.LLM_BACKGROUND_SHARE,
+                )
+                _governors[model] = governor
+    return governor
+
+
+class SlotLease:
+    """model_slot 的占用凭据；调用方拿到响应后通过 record_usage 上报实际 token 数（用于修正 TPM 令牌桶）"""
+    __slots__ = ('used_tokens',)
+
+    def __init__(self):
+        self.used_tokens = None
+
+    def record_usage(self, response) -> None:
+        total = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+        if isinstance(total, int):
+            self.used_tokens = total
+
+
+def _finish_slot(governor: ModelGovernor, lease: SlotLease, started: float, tokens: int, error=None) -> None:
+    if error is None:
+        governor.release(time.monotonic() - started, lease.used_tokens, tokens)
+        return
+    if is_rate_limited(error):
+        governor.rate_limited(retry_after(error))
+    governor.release(None)
+
+
+@contextmanager
+def model_slot(model: str, priority: int = NORMAL, tokens: int = 0):
+    """
+    占用一个模型请求名额：按优先级排队，等待 RPM/TPM 令牌（tokens 为估算的 token 数）与并发名额。
+    块内抛出的 429 会降低该模型的并发上限并按 Retry-After 暂停放行
+    """
+    governor = _get_governor(model)
+    governor.acquire(priority, tokens)
+    lease = SlotLease()
+    started = time.monotonic()
+    try:
+        yield lease
+    except BaseException as e:
+        _finish_slot(governor, lease, started, tokens, e)
+        raise
+    _finish_slot(governor, lease, started, tokens)
+
+
+@asynccontextmanager
+async def async_model_slot(model: str, priority: int = NORMAL, tokens: int = 0):
+    """model_slot 的协程版本：与同步调用共享限流状态，排队期间让出事件循环"""
+    governor = _get_governor(model)
+    await governor.aacquire(priority, tokens)
+    lease = SlotLease()
+    started = time.monotonic()
+    try:
+        yield lease
+    except BaseException as e:
+        _finish_slot(governor, lease, started, tokens, e)
+        raise
+    _finish_slot(governor, lease, started, tokens)
+
+
+def get_client_stats() -> dict:
+    with _governors_lock:
+        governors = dict(_governors)
+    models = {name: governor.get_stats() for name, governor in governors.items()}
+    with _clients_lock:
+        async_clients = sum(len(clients) for clients in _async_clients.values())
+    return {
+        'clients': len(_clients),
+        'async_clients': async_clients,
+        'models': models,
+    }
+
+
+def close_clients() -> None:
+    with _clients_lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception:
+                pass
+        _clients.clear()
+
+
+async def aclose_clients() -> None:
+    """关闭当前事件循环上的异步客户端（事件循环退出前调用）"""
+    with _clients_lock:
+        clients = list(_async_clients.pop(asyncio.get_running_loop(), {}).values())
+    for client in clients:
+        try:
+            await client.close()
+        except Exception:
+            pass
@@ -1,7 +1,20 @@
+import importlib.util
 import os
 import pandas as pd
 
 from env_config import Config
+from log_config import log
+from utils.row_log import row_log
+from utils.write_behind import write_behind
+
+# parquet 为可选依赖（pyarrow）
+_HAS_PARQUET = importlib.util.find_spec("pyarrow") is not None
+if Config.LOCAL_STORE_FORMAT == "parquet" and not _HAS_PARQUET:
+    log("LOCAL_STORE_FORMAT=parquet 需要安装 pyarrow，已回退到 csv", "yellow")
+
+
+def _use_parquet() -> bool:
+    return Config.LOCAL_STORE_FORMAT == "parquet" and _HAS_PARQUET
 
 
 def _csv_root() -> str:
@@ -17,95 +30,196 @@ def _task_root(task_name: str) -> str:
     return root
 
 
-def read_dataframe_csv(collection_name: str, headers: list, task_name: str | None = None, page_index: int | None = None) -> pd.DataFrame:
+def _resolve_csv_path(collection_name: str, task_name: str | None = None, page_index: int | None = None) -> str:
     if task_name is None:
         # global-level（根级）。与 Server_origin 对齐：global_tasks → tasks.csv
         base = _csv_root()
         filename = "tasks.csv" if collection_name == "global_tasks" else f"{collection_name}.csv"
-        file_path = os.path.join(base, filename)
-    else:
-        # task-level
-        task_dir = _task_root(task_name)
-        if collection_name in ("tasks", "pages", "hierarchy"):
-            file_path = os.path.join(task_dir, f"{collection_name}.csv")
-        else:
-            # page-level
-            if page_index is None:
-                # fallback to task root collection file
-                file_path = os.path.join(task_dir, f"{collection_name}.csv")
-            else:
-                page_dir = os.path.join(task_dir, "pages", str(page_index))
-                os.makedirs(page_dir, exist_ok=True)
-                file_map = {
-                    f"page_{page_index}_subtasks": "subtasks.csv",
-                    f"page_{page_index}_available_subtasks": "available_subtasks.csv",
-                    f"page_{page_index}_actions": "actions.csv",
-                }
-                filename = file_map.get(collection_name, f"{collection_name}.csv")
-                file_path = os.path.join(page_dir, filename)
-    if not os.path.exists(file_path):
-        df = pd.DataFrame([], columns=headers)
-        # 列补齐与顺序
-        for h in headers:
-            if h not in df.columns:
-                df[h] = None
-        return df[headers]
-    try:
-        df = pd.read_csv(file_path)
-        # 确保列齐全且顺序稳定
-        for h in headers:
-            if h not in df.columns:
-                df[h] = None
-        return df[headers]
-    except Exception:
-        df = pd.DataFrame([], columns=headers)
-        for h in headers:
-            if h not in df.columns:
-                df[h] = None
-        return df[headers]
+        return os.path.join(base, filename)
+    # task-level
+    task_dir = _task_root(task_name)
+    if collection_name in ("tasks", "pages", "hierarchy"):
+        return os.path.join(task_dir, f"{collection_name}.csv")
+    # page-level
+    if page_index is None:
+        # fallback to task root collection file
+        return os.path.join(task_dir, f"{collection_name}.csv")
+    page_dir = os.path.join(task_dir, "pages", str(page_index))
+    os.makedirs(page_dir, exist_ok=True)
+    file_map = {
+        f"page_{page_index}_subtasks": "subtasks.csv",
+        f"page_{page_index}_available_subtasks": "available_subtasks.csv",
+        f"page_{page_index}_actions": "actions.csv",
+    }
+    filename = file_map.get(collection_name, f"{collection_name}.csv")
+    return os.path.join(page_dir, filename)
+
+
+def _row_log_path(file_path: str) -> str:
+    # pages/<i>/actions.csv → pages/<i>/actions.rows.jsonl
+    return os.path.splitext(file_path)[0] + ".rows.jsonl"
+
+
+def _empty_frame(headers: list) -> pd.DataFrame:
+    df = pd.DataFrame([], columns=headers)
+    # 列补齐与顺序
+    for h in headers:
+        if h not in df.columns:
+            df[h] = None
+    return df[headers]
+
+
+def _parquet_path(file_path: str) -> str:
+    return os.path.splitext(file_path)[0] + ".parquet"
+
+
+def _read_snapshot(file_path: str, columns: list | None = None) -> pd.DataFrame | None:
+    """
+    读取快照（CSV 或 parquet，优先当前配置的格式；切换格式后旧格式的快照仍可读取）。
+    columns 为列投影：只解析需要的列，快照中不存在的列由调用方补齐。
+    """
+    parquet_path = _parquet_path(file_path)
+    candidates = [(parquet_path, "parquet"), (file_path, "csv")]
+    if not _use_parquet():
+        candidates.reverse()
+    for path, fmt in candidates:
+        if not os.path.exists(path) or (fmt == "parquet" and not _HAS_PARQUET):
+            continue
+        try:
+            if fmt == "parquet":
+                import pyarrow.parquet as pq
+                names = pq.read_schema(path).names
+                return pd.read_parquet(path, columns=[c for c in columns if c in names] if columns else None)
+            return pd.read_csv(path, usecols=(lambda c: c in columns) if columns else None)
+        except Exception:
+            return None
+    return None
+
+
+def _to_columnar(df: pd.DataFrame) -> pd.DataFrame:
+    """object 列中的非字符串值（dict/list/混合类型）按 CSV 的写法转成字符串，保证两种格式读回的内容一致"""
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        values = df[column]
+        if not values.map(lambda v: v is None or isinstance(v, str) or (isinstance(v, float) and v != v)).all():
+            df[column] = values.map(lambda v: None if v is None or (isinstance(v, float) and v != v) else str(v))
+    return df
+
+
+def _merge_rows(snapshot: pd.DataFrame | None, rows: list) -> pd.DataFrame | None:
+    """快照 + 行日志（日志行在后）"""
+    if not rows:
+        return snapshot
+    log_df = pd.DataFrame(rows)
+    if snapshot is None or snapshot.empty:
+        return log_df
+    return pd.concat([snapshot, log_df], ignore_index=True)
 
 
-def write_dataframe_csv(collection_name: str, df: pd.DataFrame, task_name: str | None = None, page_index: int | None = None) -> None:
+def read_dataframe_csv(collection_name: str, headers: list, task_name: str | None = None, page_index: int | None = None) -> pd.DataFrame:
+    """读取快照 + 行日志（叠加写后队列中尚未落盘的内容）；只解析 headers 中的列"""
+    file_path = _resolve_csv_path(collection_name, task_name, page_index)
+    log_path = _row_log_path(file_path)
+    with write_behind.lock_for(file_path):
+        pending, pending_rows = write_behind.view(file_path)
+        if pending is not None:
+            df = _merge_rows(pending.copy(), pending_rows)
+        else:
+            with row_log.lock_for(log_path):
+                df = _merge_rows(_read_snapshot(file_path, headers), row_log.read(log_path))
+    if df is None:
+        return _empty_frame(headers)
+    # 确保列齐全且顺序稳定
+    for h in headers:
+        if h not in df.columns:
+            df[h] = None
+    return df[headers]
+
+
+def _write_snapshot(file_path: str, df: pd.DataFrame) -> None:
+    # 先写临时文件再原子替换，避免中断时留下半个文件；另一种格式的旧快照随之删除
+    if _use_parquet():
+        target, stale = _parquet_path(file_path), file_path
+        tmp_path = target + ".tmp"
+        _to_columnar(df).to_parquet(tmp_path, index=False)
+    else:
+        target, stale = file_path, _parquet_path(file_path)
+        tmp_path = target + ".tmp"
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, target)
+    if os.path.exists(stale):
+        os.remove(stale)
+
+
+def _csv_writer(file_path: str):
+    def write(snapshot: pd.DataFrame | None, rows: list) -> None:
+        log_path = _row_log_path(file_path)
+        with row_log.lock_for(log_path):
+            if snapshot is None:
+                for row in rows:
+                    row_log.append(log_path, row)
+                return
+            # 整表写入即为最新全量，已有的行日志随之作废
+            _write_snapshot(file_path, _merge_rows(snapshot, rows))
+            row_log.discard(log_path)
+    return write
+
+
+def write_dataframe_csv(collection_name: str, df: pd.DataFrame, task_name: str | None = None, page_index: int | None = None,
+                        deferred: bool = False) -> None:
+    """整表写入；deferred=True 时交给写后队列在后台落盘"""
     if Config.ENABLE_DB:
         return
     try:
-        if task_name is None:
-            base = _csv_root()
-            filename = "tasks.csv" if collection_name == "global_tasks" else f"{collection_name}.csv"
-            file_path = os.path.join(base, filename)
-        else:
-            task_dir = _task_root(task_name)
-            if collection_name in ("tasks", "pages", "hierarchy"):
-                file_path = os.path.join(task_dir, f"{collection_name}.csv")
-            else:
-                if page_index is None:
-                    file_path = os.path.join(task_dir, f"{collection_name}.csv")
-                else:
-                    page_dir = os.path.join(task_dir, "pages", str(page_index))
-                    os.makedirs(page_dir, exist_ok=True)
-                    file_map = {
-                        f"page_{page_index}_subtasks": "subtasks.csv",
-                        f"page_{page_index}_available_subtasks": "available_subtasks.csv",
-                        f"page_{page_index}_actions": "actions.csv",
-                    }
-                    filename = file_map.get(collection_name, f"{collection_name}.csv")
-                    file_path = os.path.join(page_dir, filename)
-        df.to_csv(file_path, index=False)
+        file_path = _resolve_csv_path(collection_name, task_name, page_index)
+        write_behind.submit(file_path, _csv_writer(file_path), snapshot=df.copy() if deferred else df)
+        if not deferred:
+            write_behind.flush_key(file_path)
     except Exception:
         pass
 
 
+def compact_csv(collection_name: str, task_name: str | None = None, page_index: int | None = None) -> None:
+    """把行日志合并进 CSV 快照并删除日志"""
+    file_path = _resolve_csv_path(collection_name, task_name, page_index)
+    log_path = _row_log_path(file_path)
+    with write_behind.lock_for(file_path):
+        if write_behind.has_pending(file_path):
+            # 待落盘的整表快照已包含日志内容，落盘时会删除日志
+            return
+        with row_log.lock_for(log_path):
+            rows = row_log.read(log_path)
+            if not rows:
+                return
+            _write_snapshot(file_path, _merge_rows(_read_snapshot(file_path), rows))
+            row_log.discard(log_path)
+
+
 def append_one_csv(collection_name: str, doc: dict, task_name: str | None = None, page_index: int | None = None) -> None:
+    """追加一行：只写行日志（O(1)），累计 LOCAL_LOG_COMPACT_ROWS 行后再合并进 CSV"""
     if Config.ENABLE_DB:
         return
     try:
-        existing = read_dataframe_csv(collection_name, list(doc.keys()), task_name=task_name, page_index=page_index)
-        df = pd.concat([existing, pd.DataFrame([doc])], ignore_index=True)
-        write_dataframe_csv(collection_name, df, task_name=task_name, page_index=page_index)
+        file_path = _resolve_csv_path(collection_name, task_name, page_index)
+        log_path = _row_log_path(file_path)
+        with write_behind.lock_for(file_path):
+            # 该文件有未落盘的整表写入时，追加到其后，保证先后顺序
+            if write_behind.append_pending(file_path, doc):
+                return
+            with row_log.lock_for(log_path):
+                if row_log.append(log_path, doc) >= Config.LOCAL_LOG_COMPACT_ROWS:
+                    compact_csv(collection_name, task_name=task_name, page_index=page_index)
     except Exception:
         pass
 
 
+def get_task_dir(task_name: str) -> str:
+    # memory/log/<task>
+    return _task_root(task_name)
+
+
 def get_screen_bundle_dir(task_name: str, page_index: int) -> str:
     # memory/log/<task>/pages/<index>/screen
     page_dir = os.path.join(_task_root(task_name), "pages", str(page_index))
@@ -0,0 +1,91 @@
+"""
+页面集合迁移：旧布局（每个页面三个集合 page_{i}_subtasks / page_{i}_available_subtasks / page_{i}_actions）
+→ 三个合并集合 page_subtasks / page_available_subtasks / page_actions，文档带 task_name / page_index 字段。
+
+用法：
+    python -m utils.migrate_pages [--dry-run] [--force] [--drop]
+
+- 目标集合中该页面已有文档（已迁移或新布局已写入）时跳过，--force 时以旧集合内容覆盖
+- 按旧集合的自然顺序插入，迁移后页面动作的先后顺序不变
+- --drop 在写入并核对文档数后删除旧集合
+"""
+
+import argparse
+from typing import Optional
+
+from utils.mongo_utils import (LEGACY_PAGE_COLLECTION, PAGE_COLLECTIONS, PAGE_SCOPE_FIELDS, ensure_indexes,
+                               get_db, index_specs_for)
+
+
+def legacy_page_collections(db) -> list:
+    """[(集合名, 页面索引, 类型)]，按页面索引排序"""
+    found = []
+    for name in db.list_collection_names():
+        match = LEGACY_PAGE_COLLECTION.match(name)
+        if match:
+            found.append((name, int(match.group(1)), match.group(2)))
+    return sorted(found, key=lambda item: (item[1], item[2]))
+
+
+def migrate_collection(db, name: str, page_index: int, kind: str, task_name: Optional[str] = None,
+                       dry_run: bool = False, force: bool = False, drop: bool = False,
+                       batch_size: int = 1000) -> str:
+    """迁移一个旧集合，返回结果（migrated / skipped / mismatch / dry-run）"""
+    # DB 模式下页面不区分任务，与 PageManager 的 scope 一致（task_name=None）
+    scope = dict(zip(PAGE_SCOPE_FIELDS, (task_name, page_index)))
+    target = db[PAGE_COLLECTIONS[kind]]
+    docs = [{**doc, **scope} for doc in db[name].find({}, {'_id': 0})]
+    existing = target.count_documents(scope)
+    if existing and not force:
+        print(f"跳过 {name}: {PAGE_COLLECTIONS[kind]} 中已有 {existing} 条该页面文档（--force 覆盖）")
+        return 'skipped'
+    if dry_run:
+        print(f"[dry-run] {name} → {PAGE_COLLECTIONS[kind]}: {len(docs)} 条" + (f"（覆盖 {existing} 条）" if existing else ""))
+        return 'dry-run'
+
+    if existing:
+        target.delete_many(scope)
+    for i in range(0, len(docs), batch_size):
+        target.insert_many(docs[i:i + batch_size])
+    written = target.count_documents(scope)
+    if written != len(docs):
+        print(f"⚠️ {name}: 写入后文档数不一致（旧集合 {len(docs)} 条，合并集合 {written} 条），保留旧集合")
+        return 'mismatch'
+    if drop:
+        db[name].drop()
+    print(f"{name} → {PAGE_COLLECTIONS[kind]}: {len(docs)} 条" + ("，已删除旧集合" if drop else ""))
+    return 'migrated'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按页面集合 → 合并集合迁移")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不写入")
+    parser.add_argument("--force", action="store_true", help="合并集合中已有该页面文档时以旧集合覆盖")
+    parser.add_argument("--drop", action="store_true", help="迁移并核对后删除旧集合")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    db = get_db()
+    legacy = legacy_page_collections(db)
+    if not legacy:
+        print("没有旧布局的页面集合")
+        return
+
+    if not args.dry_run:
+        for collection_name in PAGE_COLLECTIONS.values():
+            ensure_indexes(collection_name, index_specs_for(collection_name))
+
+    results = {}
+    for name, page_index, kind in legacy:
+        try:
+            result = migrate_collection(db, name, page_index, kind, dry_run=args.dry_run, force=args.force,
+                                        drop=args.drop, batch_size=args.batch_size)
+        except Exception as e:
+            print(f"迁移失败 {name}: {e}")
+            result = 'failed'
+        results[result] = results.get(result, 0) + 1
+    print(f"页面集合迁移完成: 旧集合={len(legacy)}, " + ", ".join(f"{k}={v}" for k, v in sorted(results.items())))
+
+
+if __name__ == "__main__":
+    main()
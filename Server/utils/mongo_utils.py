@@ -1,22 +1,43 @@
+import hashlib
+import json
 import os
+import re
 import threading
-import time
 from typing import List, Optional, Dict, Any
 
 import pandas as pd
-from pymongo import MongoClient
+from pymongo import DeleteMany, MongoClient, ReplaceOne
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 
 # 导入配置管理
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from env_config import Config
+from utils.dataframe_cache import dataframe_cache
+from utils.write_behind import write_behind
 
 
 # 全局连接池实例
 _mongo_client: Optional[MongoClient] = None
 _lock = threading.Lock()
 
+# 页面数据合并集合（取代每个页面三个集合 page_{i}_subtasks / page_{i}_available_subtasks / page_{i}_actions），
+# 每条文档带 PAGE_SCOPE_FIELDS 字段，读写时以 scope={'task_name': ..., 'page_index': ...} 限定到一个页面
+PAGE_COLLECTIONS = {
+    'subtasks': 'page_subtasks',
+    'available_subtasks': 'page_available_subtasks',
+    'actions': 'page_actions',
+}
+PAGE_SCOPE_FIELDS = ('task_name', 'page_index')
+# 旧布局的按页面集合名（utils.migrate_pages 迁移用）
+LEGACY_PAGE_COLLECTION = re.compile(r'^page_(\d+)_(subtasks|available_subtasks|actions)$')
+
+# 增量同步使用的自然键（按顺序取第一个在 DataFrame 列中齐全的）
+_NATURAL_KEYS = (('subtask_name', 'step'), ('index',), ('name',))
+# 各集合（或集合内一个 scope）最近一次与数据库一致的内容：{(集合名, scope): (列, {自然键: 行指纹})}
+_synced: Dict[tuple, tuple] = {}
+_synced_lock = threading.Lock()
+
 
 def get_db():
     """
@@ -61,24 +82,53 @@ def get_db():
     return _mongo_client[Config.MONGODB_DB]
 
 
-def load_dataframe(collection_name: str, columns: List[str], use_cache: bool = True) -> pd.DataFrame:
-    """加载DataFrame，使用智能缓存优化；当 ENABLE_DB=False 时改用本地CSV。"""
+def load_dataframe(collection_name: str, columns: List[str], use_cache: bool = True,
+                   scope: Optional[dict] = None) -> pd.DataFrame:
+    """
+    加载DataFrame，使用进程级缓存（utils.dataframe_cache）；当 ENABLE_DB=False 时改用本地CSV。
+    scope 为等值过滤条件（如页面合并集合的 task_name/page_index），只读取该范围内的文档，返回的列不含 scope 字段。
+    """
     # 本地模式：直接读CSV
     if not Config.ENABLE_DB:
         from utils.local_store import read_dataframe_csv
         return read_dataframe_csv(collection_name, columns)
-    # 使用缓存键
-    cache_key = f"dataframe_{collection_name}_{hash(tuple(columns))}"
-    
-    # 检查缓存
-    if use_cache and hasattr(load_dataframe, '_cache'):
-        if cache_key in load_dataframe._cache:
-            cached_data, timestamp, version = load_dataframe._cache[cache_key]
-            # 智能缓存：根据数据大小调整缓存时间
-            cache_duration = min(300, max(60, len(cached_data) * 0.1))  # 60秒到5分钟
-            if time.time() - timestamp < cache_duration:
-                return cached_data.copy()
-    
+
+    # 写后队列中有未落盘的写入时，以其为准（不走缓存）
+    key = _queue_key(collection_name, scope)
+    with write_behind.lock_for(key):
+        pending, pending_rows = write_behind.view(key)
+        if pending is not None or pending_rows:
+            base = pending if pending is not None else _find_dataframe(collection_name, columns, scope)
+            df = pd.concat([base, pd.DataFrame(pending_rows)], ignore_index=True) if pending_rows else base.copy()
+            for col in columns:
+                if col not in df.columns:
+                    df[col] = None
+            return df[columns]
+
+    cache_key = (collection_name, tuple(columns), _scope_key(scope))
+    if not use_cache:
+        df = _find_dataframe(collection_name, columns, scope)
+        # 绕过缓存的读取也是最新内容，顺便更新缓存
+        dataframe_cache.put(cache_key, df.copy(), dataframe_cache.version(collection_name))
+        return df
+
+    if Config.DATAFRAME_CACHE_CHANGE_STREAMS:
+        dataframe_cache.start_change_stream(get_db)
+    # 命中返回只读视图（与缓存共享数据），调用方修改时在自己的副本上进行
+    return dataframe_cache.load(cache_key, lambda: _find_dataframe(collection_name, columns, scope))
+
+
+def _scope_key(scope: Optional[dict]) -> tuple:
+    return tuple(sorted(scope.items())) if scope else ()
+
+
+def _queue_key(collection_name: str, scope: Optional[dict] = None) -> tuple:
+    if scope:
+        return "mongo", collection_name, _scope_key(scope)
+    return "mongo", collection_name
+
+
+def _find_dataframe(collection_name: str, columns: List[str], scope: Optional[dict] = None) -> pd.DataFrame:
     db = get_db()
     collection = db[collection_name]
     
@@ -86,9 +136,13 @@ def load_dataframe(collection_name: str, columns: List[str], use_cache: bool = T
     projection = {col: 1 for col in columns}
     projection['_id'] = 0  # 排除_id字段
     
-    docs = list(collection.find({}, projection))
+    if scope:
+        # 合并集合按 scope 索引查询，按 _id 排序保持写入顺序
+        docs = list(collection.find(dict(scope), projection).sort('_id', 1))
+    else:
+        docs = list(collection.find({}, projection))
     if len(docs) == 0:
-        result_df = pd.DataFrame([], columns=columns)
+        df = pd.DataFrame([], columns=columns)
     else:
         df = pd.DataFrame(docs)
         # Ensure all columns exist
@@ -96,60 +150,212 @@ def load_dataframe(collection_name: str, columns: List[str], use_cache: bool = T
             if col not in df.columns:
                 df[col] = None
         # Keep column order as provided
-        result_df = df[columns]
-    
-    # 智能缓存结果
-    if use_cache:
-        if not hasattr(load_dataframe, '_cache'):
-            load_dataframe._cache = {}
-        # 添加版本号用于缓存失效
-        version = time.time()
-        load_dataframe._cache[cache_key] = (result_df.copy(), time.time(), version)
-    
-    return result_df
+        df = df[columns]
+    _remember_synced(collection_name, df, replace=False, scope=scope)
+    return df
+
+
+def _collection_writer(collection_name: str, batch_size: int = 1000, scope: Optional[dict] = None):
+    """写后队列的落盘函数：有快照时整表（或整个 scope）替换，否则只插入追加行"""
+    def write(snapshot: Optional[pd.DataFrame], rows: List[dict]) -> None:
+        ensure_schema_indexes(collection_name)
+        if snapshot is None:
+            if rows:
+                get_db()[collection_name].insert_many([{**row, **(scope or {})} for row in rows])
+                _forget_synced(collection_name, scope)
+                _append_cache(collection_name, rows, scope)
+            return
+        if rows:
+            snapshot = pd.concat([snapshot, pd.DataFrame(rows)], ignore_index=True)
+        _replace_collection(collection_name, snapshot, batch_size, scope)
+    return write
 
 
-def save_dataframe(collection_name: str, df: pd.DataFrame, batch_size: int = 1000) -> None:
+def save_dataframe(collection_name: str, df: pd.DataFrame, batch_size: int = 1000, deferred: bool = False,
+                   scope: Optional[dict] = None) -> None:
     """保存DataFrame；当 ENABLE_DB=False 时改用本地CSV。
     注意：为避免生成平铺文件，以下集合在本地模式下不在此处写入：
       - 以 page_ 开头的集合（由 PageManager 负责写入 pages/<index>/ 下的 CSV）
       - tasks / pages / hierarchy（由 Memory 负责按任务目录写入）
     其他集合（如 global_tasks）仍按全局写入 memory/log/<collection>.csv。
+    deferred=True 时只登记到写后队列，由后台线程合并落盘。
+    scope 不为空时只替换集合中该范围内的文档（写入的文档自动带上 scope 字段）。
     """
     if not Config.ENABLE_DB:
         if collection_name.startswith("page_") or collection_name in ("tasks", "pages", "hierarchy"):
             return
         from utils.local_store import write_dataframe_csv
-        write_dataframe_csv(collection_name, df)
+        write_dataframe_csv(collection_name, df, deferred=deferred)
         return
-    db = get_db()
-    collection = db[collection_name]
-    
-    # 使用批量操作优化
-    if df.empty:
-        collection.delete_many({})
+    key = _queue_key(collection_name, scope)
+    write_behind.submit(key, _collection_writer(collection_name, batch_size, scope),
+                        snapshot=df.copy() if deferred else df)
+    if not deferred:
+        write_behind.flush_key(key)
+
+
+def _plain(value):
+    """numpy 标量转为 Python 值，NaN 视为 None，使读回与写入的同一行指纹一致"""
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        try:
+            value = value.item()
+        except (ValueError, TypeError):
+            pass
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _natural_key(columns) -> Optional[tuple]:
+    for fields in _NATURAL_KEYS:
+        if all(field in columns for field in fields):
+            return fields
+    return None
+
+
+def _fingerprints(records: List[dict], key_fields: tuple) -> Optional[Dict[tuple, str]]:
+    """{自然键: 行指纹}；自然键不唯一时返回 None（只能整表替换）"""
+    result = {}
+    for record in records:
+        key = tuple(_plain(record.get(field)) for field in key_fields)
+        if key in result:
+            return None
+        raw = json.dumps({k: _plain(v) for k, v in record.items()}, sort_keys=True, ensure_ascii=False, default=str)
+        result[key] = hashlib.md5(raw.encode("utf-8")).hexdigest()
+    return result
+
+
+def _remember_synced(collection_name: str, df: pd.DataFrame, replace: bool = True,
+                     scope: Optional[dict] = None) -> None:
+    """
+    记录数据库中该集合（或其中一个 scope）的当前内容（读取整表或写入成功后调用），下次写入只同步有变化的行。
+    replace=False（读取时）不覆盖按其他列记录的内容，避免投影读取打断整表写入的比对。
+    """
+    sync_key = (collection_name, _scope_key(scope))
+    columns = tuple(df.columns)
+    with _synced_lock:
+        baseline = _synced.get(sync_key)
+    if not replace and baseline is not None and baseline[0] != columns:
         return
-    
-    records = df.to_dict(orient="records")
-    
+    key_fields = _natural_key(columns)
+    fingerprints = _fingerprints(df.to_dict(orient="records"), key_fields) if key_fields else None
+    with _synced_lock:
+        if fingerprints is None:
+            _synced.pop(sync_key, None)
+        else:
+            _synced[sync_key] = (columns, fingerprints)
+
+
+def _forget_synced(collection_name: str, scope: Optional[dict] = None) -> None:
+    with _synced_lock:
+        _synced.pop((collection_name, _scope_key(scope)), None)
+
+
+def _forget_synced_collection(collection_name: str) -> None:
+    """作废该集合所有 scope 的同步记录"""
+    with _synced_lock:
+        for sync_key in [key for key in _synced if key[0] == collection_name]:
+            del _synced[sync_key]
+
+
+def _refresh_cache(collection_name: str, df: pd.DataFrame, scope: Optional[dict] = None) -> None:
+    """写入后用新内容更新该集合的 load_dataframe 缓存（不再整体丢弃）"""
+    def build(_, columns: tuple) -> pd.DataFrame:
+        projected = df.copy()
+        for col in columns:
+            if col not in projected.columns:
+                projected[col] = None
+        return projected[list(columns)].reset_index(drop=True)
+    dataframe_cache.refresh(collection_name, build, _scope_key(scope))
+
+
+def _append_cache(collection_name: str, rows: List[dict], scope: Optional[dict] = None) -> None:
+    if not rows:
+        return
+
+    def build(cached_data: pd.DataFrame, columns: tuple) -> pd.DataFrame:
+        appended = pd.concat([cached_data, pd.DataFrame(rows)], ignore_index=True)
+        for col in columns:
+            if col not in appended.columns:
+                appended[col] = None
+        return appended[list(columns)]
+    dataframe_cache.refresh(collection_name, build, _scope_key(scope))
+
+
+def _rewrite_collection(collection, records: List[dict], batch_size: int, scope: Optional[dict] = None) -> None:
     # 分批插入，避免内存问题
+    collection.delete_many(dict(scope or {}))
     for i in range(0, len(records), batch_size):
-        batch = records[i:i + batch_size]
-        if i == 0:
-            # 第一批：清空并插入
-            collection.delete_many({})
-            collection.insert_many(batch)
+        collection.insert_many([{**record, **(scope or {})} for record in records[i:i + batch_size]])
+
+
+def _replace_collection(collection_name: str, df: pd.DataFrame, batch_size: int = 1000,
+                        scope: Optional[dict] = None) -> None:
+    """
+    让集合（scope 不为空时为集合中该范围内的文档）与 df 一致：按自然键（subtask_name+step / index / name）
+    比较行指纹，只 upsert 有变化的行、删除 df 中已不存在的行；自然键不唯一时退回整表重写。
+    """
+    db = get_db()
+    collection = db[collection_name]
+    scope = dict(scope or {})
+    sync_key = (collection_name, _scope_key(scope))
+    records = df.to_dict(orient="records")
+    columns = tuple(df.columns)
+    key_fields = _natural_key(columns)
+    fingerprints = _fingerprints(records, key_fields) if key_fields else None
+
+    try:
+        if fingerprints is None:
+            _rewrite_collection(collection, [dict(r) for r in records], batch_size, scope)
+            _forget_synced(collection_name, scope)
+            _refresh_cache(collection_name, df, scope)
+            return
+
+        with _synced_lock:
+            baseline = _synced.get(sync_key)
+        if baseline is not None and baseline[0] == columns:
+            previous = baseline[1]
         else:
-            # 后续批次：直接插入
-            collection.insert_many(batch)
-    
-    # 清除相关缓存
-    clear_cache_for_collection(collection_name)
+            # 首次同步：只取自然键，全部 upsert 一次；已有重复键时整表重写
+            projection = {field: 1 for field in key_fields}
+            projection['_id'] = 0
+            existing = [tuple(_plain(doc.get(field)) for field in key_fields)
+                        for doc in collection.find(scope, projection)]
+            if len(existing) != len(set(existing)):
+                _rewrite_collection(collection, [dict(r) for r in records], batch_size, scope)
+                _remember_synced(collection_name, df, scope=scope)
+                _refresh_cache(collection_name, df, scope)
+                return
+            previous = dict.fromkeys(existing)
+
+        operations = []
+        for record, (key, digest) in zip(records, fingerprints.items()):
+            if previous.get(key) != digest:
+                operations.append(ReplaceOne({**scope, **dict(zip(key_fields, key))}, {**record, **scope},
+                                             upsert=True))
+        removed = [key for key in previous if key not in fingerprints]
+        if removed and len(key_fields) == 1:
+            operations.append(DeleteMany({**scope, key_fields[0]: {'$in': [key[0] for key in removed]}}))
+        else:
+            operations.extend(DeleteMany({**scope, **dict(zip(key_fields, key))}) for key in removed)
+
+        for i in range(0, len(operations), batch_size):
+            collection.bulk_write(operations[i:i + batch_size], ordered=True)
+    except Exception:
+        # 数据库状态未知，下次写入重新比对
+        _forget_synced(collection_name, scope)
+        clear_cache_for_collection(collection_name)
+        raise
+
+    with _synced_lock:
+        _synced[sync_key] = (columns, fingerprints)
+    _refresh_cache(collection_name, df, scope)
 
 
-def append_one(collection_name: str, doc: dict) -> None:
+def append_one(collection_name: str, doc: dict, deferred: bool = False, scope: Optional[dict] = None) -> None:
     """插入单条记录；当 ENABLE_DB=False 时改用本地CSV。
     为避免生成平铺文件：以 page_ 开头的集合在此处不写，由调用方传 task/page 定位写入。
+    deferred=True 时登记到写后队列；集合有未落盘的写入时总是追加到其后。
     """
     if not Config.ENABLE_DB:
         if collection_name.startswith("page_"):
@@ -157,9 +363,18 @@ def append_one(collection_name: str, doc: dict) -> None:
         from utils.local_store import append_one_csv
         append_one_csv(collection_name, doc)
         return
-    db = get_db()
-    db[collection_name].insert_one(doc)
-    clear_cache_for_collection(collection_name)
+    key = _queue_key(collection_name, scope)
+    with write_behind.lock_for(key):
+        if write_behind.append_pending(key, doc):
+            return
+        if deferred:
+            write_behind.submit(key, _collection_writer(collection_name, scope=scope), rows=[dict(doc)])
+            return
+        ensure_schema_indexes(collection_name)
+        db = get_db()
+        db[collection_name].insert_one({**doc, **(scope or {})})
+        _forget_synced(collection_name, scope)
+        _append_cache(collection_name, [doc], scope)
 
 
 def append_many(collection_name: str, docs: List[dict], batch_size: int = 1000) -> None:
@@ -167,6 +382,7 @@ def append_many(collection_name: str, docs: List[dict], batch_size: int = 1000)
     if not docs:
         return
     
+    write_behind.flush_key(_queue_key(collection_name))
     db = get_db()
     collection = db[collection_name]
     
@@ -195,6 +411,7 @@ def upsert_one(collection_name: str, filter_doc: dict, doc: dict) -> None:
         df = pd.concat([df, pd.DataFrame([doc])], ignore_index=True)
         write_dataframe_csv(collection_name, df)
         return
+    write_behind.flush_key(_queue_key(collection_name))
     db = get_db()
     db[collection_name].replace_one(filter_doc, doc, upsert=True)
     clear_cache_for_collection(collection_name)
@@ -228,6 +445,7 @@ def upsert_many(collection_name: str, operations: List[dict], batch_size: int =
     if not operations:
         return
     
+    write_behind.flush_key(_queue_key(collection_name))
     db = get_db()
     collection = db[collection_name]
     
@@ -241,28 +459,99 @@ def upsert_many(collection_name: str, operations: List[dict], batch_size: int =
 
 
 def clear_cache_for_collection(collection_name: str) -> None:
-    """清除指定集合的缓存"""
-    if hasattr(load_dataframe, '_cache'):
-        keys_to_remove = [key for key in load_dataframe._cache.keys() if collection_name in key]
-        for key in keys_to_remove:
-            del load_dataframe._cache[key]
-
-
-def ensure_indexes(collection_name: str, indexes: List[dict]) -> None:
-    """确保集合有必要的索引"""
+    """清除指定集合（所有 scope）的缓存"""
+    _forget_synced_collection(collection_name)
+    dataframe_cache.invalidate(collection_name)
+
+
+# 各集合需要的索引：(集合名或正则, 索引列表)；upsert / 按键替换都依赖这些索引，否则为全表扫描
+INDEX_SCHEMA = (
+    ('global_tasks', [{'keys': [('name', 1)]}]),
+    ('tasks', [{'keys': [('name', 1)]}]),
+    ('pages', [{'keys': [('index', 1)]}]),
+    ('hierarchy', [{'keys': [('index', 1)]}]),
+    (PAGE_COLLECTIONS['actions'], [{'keys': [('task_name', 1), ('page_index', 1), ('subtask_name', 1), ('step', 1)]}]),
+    (PAGE_COLLECTIONS['subtasks'], [{'keys': [('task_name', 1), ('page_index', 1), ('name', 1)]}]),
+    (PAGE_COLLECTIONS['available_subtasks'], [{'keys': [('task_name', 1), ('page_index', 1), ('name', 1)]}]),
+    ('temp_xmls_bundle', [{'keys': [('task_name', 1), ('screen_count', 1)]}]),
+    ('temp_screenshots_meta', [{'keys': [('task_name', 1), ('screen_count', 1)]}]),
+    ('screen_bundles', [{'keys': [('task_name', 1), ('page_index', 1), ('screen_num', 1)]}]),
+)
+# 已确保过索引的集合（按页面集合首次写入时补建索引）
+_indexed: set = set()
+_indexed_lock = threading.Lock()
+
+
+def index_specs_for(collection_name: str) -> List[dict]:
+    """INDEX_SCHEMA 中为该集合声明的索引"""
+    specs = []
+    for pattern, indexes in INDEX_SCHEMA:
+        if pattern == collection_name if isinstance(pattern, str) else pattern.match(collection_name):
+            specs.extend(indexes)
+    return specs
+
+
+def _index_name(keys) -> str:
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def ensure_indexes(collection_name: str, indexes: List[dict]) -> List[str]:
+    """确保集合有必要的索引（已存在时 create_index 不做任何事），返回创建成功的索引名"""
     db = get_db()
     collection = db[collection_name]
     
+    created = []
     for index_spec in indexes:
         try:
-            collection.create_index(
+            created.append(collection.create_index(
                 index_spec['keys'],
                 background=True,  # 后台创建索引
                 unique=index_spec.get('unique', False),
                 sparse=index_spec.get('sparse', False)
-            )
+            ))
         except Exception as e:
             print(f"创建索引失败 {collection_name}: {e}")
+    with _indexed_lock:
+        _indexed.add(collection_name)
+    return created
+
+
+def ensure_schema_indexes(collection_name: str) -> None:
+    """按 INDEX_SCHEMA 为集合建索引，每个集合每个进程只执行一次（写入路径调用）"""
+    with _indexed_lock:
+        if collection_name in _indexed:
+            return
+    ensure_indexes(collection_name, index_specs_for(collection_name))
+
+
+def verify_indexes(collection_name: str, indexes: List[dict]) -> List[str]:
+    """返回声明了但集合上不存在的索引（按键比较）"""
+    existing = {tuple((field, int(direction)) for field, direction in info['key'])
+                for info in get_db()[collection_name].index_information().values()}
+    return [_index_name(spec['keys']) for spec in indexes
+            if tuple((field, direction) for field, direction in spec['keys']) not in existing]
+
+
+def bootstrap_schema() -> Dict[str, Dict[str, Any]]:
+    """
+    启动时的模式初始化：为已有集合与固定集合建立 INDEX_SCHEMA 中声明的索引并校验，
+    返回 {集合名: {'indexes': [...], 'missing': [...], 'stats': get_collection_stats(...)}}。
+    """
+    db = get_db()
+    names = set(db.list_collection_names())
+    names.update(pattern for pattern, _ in INDEX_SCHEMA if isinstance(pattern, str))
+    report = {}
+    for collection_name in sorted(names):
+        specs = index_specs_for(collection_name)
+        if not specs:
+            continue
+        ensure_indexes(collection_name, specs)
+        report[collection_name] = {
+            'indexes': [_index_name(spec['keys']) for spec in specs],
+            'missing': verify_indexes(collection_name, specs),
+            'stats': get_collection_stats(collection_name),
+        }
+    return report
 
 
 def get_collection_stats(collection_name: str) -> Optional[Dict[str, Any]]:
@@ -392,7 +681,8 @@ def get_collection_stats(collection_name: str) -> Optional[Dict[str, Any]]:
             'avg_obj_size': stats.get('avgObjSize', 0),
             'storage_size': stats.get('storageSize', 0),
             'indexes': stats.get('nindexes', 0),
-            'total_index_size': stats.get('totalIndexSize', 0)
+            'total_index_size': stats.get('totalIndexSize', 0),
+            'index_sizes': dict(stats.get('indexSizes', {}))
         }
     except Exception as e:
         print(f"获取集合 {collection_name} 统计信息失败: {e}")
@@ -434,8 +724,7 @@ def clear_cache():
     """
     清理缓存
     """
-    if hasattr(load_dataframe, '_cache'):
-        load_dataframe._cache.clear()
+    dataframe_cache.clear()
     print("数据库缓存已清理")
 
 
@@ -443,14 +732,12 @@ def get_cache_stats() -> Dict[str, Any]:
     """
     获取缓存统计信息
     """
-    if not hasattr(load_dataframe, '_cache'):
-        return {'cache_size': 0, 'cached_keys': []}
-    
-    cache = load_dataframe._cache
+    stats = dataframe_cache.get_stats()
     return {
-        'cache_size': len(cache),
-        'cached_keys': list(cache.keys()),
-        'cache_hit_rate': getattr(load_dataframe, '_cache_hits', 0) / max(getattr(load_dataframe, '_cache_requests', 1), 1)
+        'cache_size': stats['entries'],
+        'cached_keys': dataframe_cache.cached_keys(),
+        'cache_hit_rate': stats['hit_rate'],
+        **stats
     }
 
 
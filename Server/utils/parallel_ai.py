@@ -1,4 +1,7 @@
 import asyncio
+import contextvars
+import functools
+import os
 from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Callable, List, Tuple
 
@@ -22,20 +25,24 @@ class ParallelAIExecutor:
 
         def submit(spec):
             func, args, kwargs = spec
-            return loop.run_in_executor(self.executor, func, *args, **kwargs)
+            return loop.run_in_executor(self.executor, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
 
         tasks = [submit(spec) for spec in call_specs]
         results = await asyncio.gather(*tasks, return_exceptions=True)
         return results
 
 
+# 进程级共享执行器：MobileGPT 优化路径与 parallel_query 共用，避免每次调用新建线程池
+parallel_executor = ParallelAIExecutor(max_workers=int(os.getenv("PARALLEL_AI_WORKERS", "16")))
+
+
 async def parallel_query(message_model_pairs: List[Tuple[list, str]], is_list_flags: List[bool] = None):
     """Run multiple utils.query calls in parallel.
 
     message_model_pairs: list of (messages, model)
     is_list_flags: optional list of is_list flags per call
     """
-    executor = ParallelAIExecutor()
+    executor = parallel_executor
 
     specs = []
     for idx, pair in enumerate(message_model_pairs):
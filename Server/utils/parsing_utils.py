@@ -8,6 +8,7 @@ import xml.etree.ElementTree as ET
 from log_config import log
 from env_config import Config
 from utils.local_store import get_screen_bundle_dir
+from utils.blob_store import blob_store, write_screen_bundle
 
 
 def find_parent_node(root, child_index: int) -> (int, ET):
@@ -291,9 +292,9 @@ def find_element_by_depth_and_rank(element, target_depth, rank, current_depth=1)
     return None
 
 
-def save_screen_info_local(task_name: str, dest_dir: str, screen_num: int | None = None) -> None:
+def _locate_session_screen(task_name: str, screen_num: int | None = None) -> dict | None:
     """
-    将最近一次会话日志中的截图与各类XML文件拷贝到指定目录，便于后续训练/排查。
+    定位最近一次会话日志中某一屏的截图与各类XML文件。
 
     源目录结构（与本项目一致）：
       Config.LOG_DIRECTORY/<task_name>/<timestamp>/
@@ -305,17 +306,9 @@ def save_screen_info_local(task_name: str, dest_dir: str, screen_num: int | None
             <index>_parsed.xml
             <index>_pretty.xml
 
-    目标目录：
-      dest_dir/
-        screenshot.jpg
-        raw.xml
-        html.xml
-        hierarchy.xml
-        parsed.xml
-        pretty.xml
+    返回 {'index': 屏幕序号, 'screenshot': 路径, 'raw'/'html'/'hierarchy'/'parsed'/'pretty': 路径}，找不到时返回 None
     """
     import os
-    import shutil
     from datetime import datetime
 
     def parse_ts(name: str):
@@ -330,7 +323,7 @@ def save_screen_info_local(task_name: str, dest_dir: str, screen_num: int | None
 
     base_path = os.path.join(Config.LOG_DIRECTORY, task_name)
     if not os.path.isdir(base_path):
-        return
+        return None
 
     # 选择最新的时间戳目录
     subdirs = [d for d in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, d))]
@@ -340,14 +333,14 @@ def save_screen_info_local(task_name: str, dest_dir: str, screen_num: int | None
         if dt is not None:
             dated.append((dt, d))
     if not dated:
-        return
+        return None
     dated.sort(reverse=True)
     latest_dir = dated[0][1]
 
     shots_dir = os.path.join(base_path, latest_dir, "screenshots")
     xmls_dir = os.path.join(base_path, latest_dir, "xmls")
     if not os.path.isdir(xmls_dir):
-        return
+        return None
 
     # 选择索引
     def get_index_from_filename(fname: str) -> int | None:
@@ -384,24 +377,64 @@ def save_screen_info_local(task_name: str, dest_dir: str, screen_num: int | None
             else:
                 index = 0
 
-    os.makedirs(dest_dir, exist_ok=True)
+    return {
+        'index': index,
+        'screenshot': os.path.join(shots_dir, f"{index}.jpg"),
+        'raw': os.path.join(xmls_dir, f"{index}.xml"),
+        'html': os.path.join(xmls_dir, f"{index}_encoded.xml"),
+        'hierarchy': os.path.join(xmls_dir, f"{index}_hierarchy_parsed.xml"),
+        'parsed': os.path.join(xmls_dir, f"{index}_parsed.xml"),
+        'pretty': os.path.join(xmls_dir, f"{index}_pretty.xml"),
+    }
 
-    # 复制文件（存在则复制）
-    def try_copy(src: str, dst: str):
+
+def _read_session_screen(files: dict) -> (bytes | None, dict):
+    """读取 _locate_session_screen 找到的文件（存在则读取）"""
+    def try_read(path: str, mode: str):
         try:
-            if os.path.exists(src):
-                shutil.copy(src, dst)
+            if os.path.exists(path):
+                with open(path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+                    return f.read()
         except Exception:
             pass
+        return None
+
+    screenshot = try_read(files['screenshot'], 'rb')
+    views = {name: try_read(files[name], 'r') for name in ('raw', 'html', 'hierarchy', 'parsed', 'pretty')}
+    return screenshot, views
+
 
-    # screenshot
-    try_copy(os.path.join(shots_dir, f"{index}.jpg"), os.path.join(dest_dir, "screenshot.jpg"))
-    # xml variants
-    try_copy(os.path.join(xmls_dir, f"{index}.xml"), os.path.join(dest_dir, "raw.xml"))
-    try_copy(os.path.join(xmls_dir, f"{index}_encoded.xml"), os.path.join(dest_dir, "html.xml"))
-    try_copy(os.path.join(xmls_dir, f"{index}_hierarchy_parsed.xml"), os.path.join(dest_dir, "hierarchy.xml"))
-    try_copy(os.path.join(xmls_dir, f"{index}_parsed.xml"), os.path.join(dest_dir, "parsed.xml"))
-    try_copy(os.path.join(xmls_dir, f"{index}_pretty.xml"), os.path.join(dest_dir, "pretty.xml"))
+def save_screen_info_local(task_name: str, dest_dir: str, screen_num: int | None = None) -> None:
+    """
+    将最近一次会话日志中的截图与各类XML写入内容寻址 blob 仓库（相同内容只存一份），
+    并在 dest_dir/manifest.jsonl 追加一条引用记录，便于后续训练/排查（读取见 blob_store.read_screen_bundle）。
+    """
+    files = _locate_session_screen(task_name, screen_num)
+    if files is None:
+        return
+    screenshot, views = _read_session_screen(files)
+    try:
+        write_screen_bundle(dest_dir, screenshot, views, screen_num=files['index'])
+    except Exception:
+        pass
+
+
+def save_screen_info_to_mongo(task_name: str, page_index: int, screen_num: int | None = None) -> None:
+    """DB 模式：截图与XML写入 blob 仓库，screen_bundles 集合只保存哈希引用"""
+    files = _locate_session_screen(task_name, screen_num)
+    if files is None:
+        return
+    screenshot, views = _read_session_screen(files)
+    blobs = {}
+    if screenshot:
+        blobs['screenshot'] = blob_store.put(screenshot)
+    for name, content in views.items():
+        if content is not None:
+            blobs[name] = blob_store.put(content, compress=True)
+
+    from utils.mongo_utils import get_db
+    key = {'task_name': task_name, 'page_index': page_index, 'screen_num': files['index']}
+    get_db()['screen_bundles'].replace_one(key, {**key, 'blobs': blobs, 'created_at': datetime.now()}, upsert=True)
 
 
 def save_screen_info_local_aligned(task_name: str, page_index: int, screen_num: int | None = None) -> None:
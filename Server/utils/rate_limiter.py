@@ -0,0 +1,282 @@
+"""
+按模型的自适应限流
+- 令牌桶：每分钟请求数（RPM）与每分钟 token 数（TPM），token 数按消息长度估算，拿到 usage 后按实际值修正
+- AIMD 并发控制：请求成功且耗时未超过目标时并发上限缓慢增加（每轮 +1），
+  收到 429 或耗时超标时减半；429 的 Retry-After 期间整个模型暂停放行，各会话不再各自重试、互相放大
+- 优先级通道：排队的请求按通道放行（交互 > 普通 > 后台），后台通道最多占用部分并发名额，
+  为 select / derive 留出余量
+线程与协程共用同一个 ModelGovernor。
+"""
+
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+# 优先级通道（数值越小越先放行）
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+_LANE_NAMES = {INTERACTIVE: 'interactive', NORMAL: 'normal', BACKGROUND: 'background'}
+
+# 单个图片输入按固定 token 数估算
+_IMAGE_TOKENS = 1000
+
+
+def estimate_tokens(messages, completion_tokens: int = 256) -> int:
+    """按 UTF-8 字节数估算 token（中文约 1 字 1 token，英文约 3~4 字符 1 token），另加预计的输出长度"""
+    total = 0
+    for message in messages or []:
+        content = message.get('content', '') if isinstance(message, dict) else message
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and item.get('type') == 'text':
+                    total += len(str(item.get('text', '')).encode('utf-8')) // 3
+                else:
+                    total += _IMAGE_TOKENS
+        else:
+            total += len(str(content).encode('utf-8')) // 3
+    return total + completion_tokens
+
+
+class TokenBucket:
+    """每分钟补充 per_minute 个令牌，容量为一分钟的量"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """还需等待多少秒才能取出 amount 个令牌（超过容量的请求按容量计）"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self._level >= amount else (amount - self._level) / self.rate
+
+    def take(self, amount: float) -> None:
+        # 调用方已确认令牌足够；usage 修正时可以为负（退还）
+        self._level = min(self.capacity, self._level - amount)
+
+    @property
+    def level(self) -> float:
+        return self._level
+
+
+class _Waiter:
+    __slots__ = ('priority', 'tokens', 'admitted', 'cancelled', 'wake')
+
+    def __init__(self, priority: int, tokens: int, wake):
+        self.priority = priority
+        self.tokens = tokens
+        self.admitted = False
+        self.cancelled = False
+        self.wake = wake
+
+
+class ModelGovernor:
+
+    def __init__(self, model: str, max_concurrency: int, rpm: int = 0, tpm: int = 0, min_concurrency: int = 1,
+                 latency_target: float = 0.0, background_share: float = 0.5):
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.latency_target = latency_target
+        self.background_share = background_share
+        self._limit = float(self.max_concurrency)
+        self._requests = TokenBucket(rpm) if rpm > 0 else None
+        self._tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._stats = {'admitted': 0, 'rate_limited': 0, 'slow': 0, 'decreases': 0}
+
+    # ---- 放行 ----
+
+    def _capacity(self, priority: int) -> int:
+        limit = int(self._limit)
+        if priority >= BACKGROUND:
+            # 后台通道只用一部分名额，交互请求到达时不必等后台请求结束
+            return max(1, int(limit * self.background_share))
+        return limit
+
+    def _admit_locked(self) -> float:
+        """按优先级放行排队的请求；返回队首还需等待令牌 / 暂停结束的秒数（0 表示等待有请求结束）"""
+        now = time.monotonic()
+        while self._waiters:
+            priority, _, waiter = self._waiters[0]
+            if waiter.cancelled:
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._paused_until - now
+            if self._in_flight >= self._capacity(priority):
+                return max(0.0, wait)
+            if self._requests is not None:
+                wait = max(wait, self._requests.wait_time(1, now))
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.wait_time(waiter.tokens, now))
+            if wait > 0:
+                # 让队首按等待时间定时重试（其余等待方在有请求结束时再被唤醒）
+                waiter.wake()
+                return wait
+            if self._requests is not None:
+                self._requests.take(1)
+            if self._tokens is not None:
+                self._tokens.take(min(waiter.tokens, self._tokens.capacity))
+            heapq.heappop(self._waiters)
+            self._in_flight += 1
+            self._stats['admitted'] += 1
+            waiter.admitted = True
+            waiter.wake()
+        return 0.0
+
+    def acquire(self, priority: int = NORMAL, tokens: int = 0) -> None:
+        event = threading.Event()
+        waiter = _Waiter(priority, tokens, event.set)
+        with self._lock:
+            heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        while True:
+            with self._lock:
+                wait = self._admit_locked()
+                if waiter.admitted:
+                    return
+                event.clear()
+            event.wait(wait if wait > 0 else None)
+
+    async def aacquire(self, priority: int = NORMAL, tokens: int = 0) -> None:
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = _Waiter(priority, tokens, lambda: loop.call_soon_threadsafe(event.set))
+        with self._lock:
+            heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        try:
+            while True:
+                with self._lock:
+                    wait = self._admit_locked()
+                    if waiter.admitted:
+                        return
+                    event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                waiter.cancelled = True
+                admitted = waiter.admitted
+            # 取消时恰好已被放行：归还名额
+            if admitted:
+                self.release(None)
+            raise
+
+    # ---- 反馈 ----
+
+    def _decrease_locked(self, now: float) -> None:
+        # 同一批并发请求的多个失败信号只减半一次
+        if now - self._last_decrease < 1.0:
+            return
+        self._limit = max(float(self.min_concurrency), self._limit / 2)
+        self._last_decrease = now
+        self._stats['decreases'] += 1
+
+    def release(self, latency: Optional[float], used_tokens: Optional[int] = None, estimated_tokens: int = 0) -> None:
+        """请求结束；latency 为成功请求的耗时（失败或取消时为 None），used_tokens 为 usage 中的实际 token 数"""
+        with self._lock:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if used_tokens is not None and self._tokens is not None:
+                self._tokens.take(used_tokens - min(estimated_tokens, self._tokens.capacity))
+            if latency is not None:
+                if self.latency_target > 0 and latency > self.latency_target:
+                    self._stats['slow'] += 1
+                    self._decrease_locked(now)
+                else:
+                    # 加性增长：大约每个并发轮次 +1
+                    self._limit = min(float(self.max_concurrency), self._limit + 1.0 / self._limit)
+            self._admit_locked()
+
+    def rate_limited(self, retry_after: Optional[float] = None) -> float:
+        """收到 429：并发上限减半并暂停放行，返回暂停秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._stats['rate_limited'] += 1
+            self._decrease_locked(now)
+            pause = retry_after if retry_after and retry_after > 0 else 1.0
+            self._paused_until = max(self._paused_until, now + pause)
+            return pause
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            waiting = {}
+            for priority, _, waiter in self._waiters:
+                if not waiter.cancelled:
+                    name = _LANE_NAMES.get(priority, str(priority))
+                    waiting[name] = waiting.get(name, 0) + 1
+            stats = dict(self._stats)
+            stats.update({
+                'limit': int(self._limit),
+                'max_limit': self.max_concurrency,
+                'in_flight': self._in_flight,
+                'waiting': waiting,
+                'paused_seconds': max(0.0, self._paused_until - time.monotonic()),
+            })
+            if self._requests is not None:
+                stats['rpm_available'] = int(self._requests.level)
+            if self._tokens is not None:
+                stats['tpm_available'] = int(self._tokens.level)
+            return stats
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return getattr(error, 'status_code', None) == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """429 响应的 Retry-After（秒）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    for name in ('retry-after-ms', 'retry-after'):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            continue
+        return seconds / 1000.0 if name == 'retry-after-ms' else seconds
+    return None
+
+
+def backoff_delay(attempt: int, error: BaseException, base_delay: float, max_delay: float) -> float:
+    """
+    重试前的等待秒数。429 已由 ModelGovernor 暂停整个模型，重试直接回到队列中排队（不再单独退避）；
+    其他错误按指数退避加全抖动，避免各会话同时重试
+    """
+    if is_rate_limited(error):
+        return 0.0
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def parse_rate_limits(spec: str) -> Dict[str, tuple]:
+    """"model=rpm:tpm,..." → {model: (rpm, tpm)}，省略或 0 表示不限"""
+    limits = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        parts = (value.split(":") + ["0"])[:2]
+        try:
+            limits[name.strip()] = (int(parts[0] or 0), int(parts[1] or 0))
+        except ValueError:
+            continue
+    return limits
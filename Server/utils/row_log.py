@@ -0,0 +1,124 @@
+"""
+只追加的行日志（JSON Lines）
+本地模式下逐条保存的动作/子任务先追加到 <集合>.rows.jsonl，不再每次读出整个 CSV 再重写；
+写入后立即 flush（本进程可见），fsync 由后台线程按 LOCAL_LOG_FSYNC_INTERVAL_MS 批量执行。
+"""
+
+import atexit
+import json
+import os
+import threading
+from typing import Dict, List
+
+from env_config import Config
+from log_config import log
+
+
+class RowLog:
+
+    def __init__(self, fsync_interval_ms: int = 200):
+        self.fsync_interval = max(0, fsync_interval_ms) / 1000.0
+        self._guard = threading.Lock()
+        self._locks: Dict[str, threading.RLock] = {}
+        self._handles = {}
+        self._counts: Dict[str, int] = {}
+        self._dirty = set()
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def lock_for(self, path: str) -> threading.RLock:
+        """同一日志文件的追加、读取与合并需在此锁内进行"""
+        with self._guard:
+            if path not in self._locks:
+                self._locks[path] = threading.RLock()
+            return self._locks[path]
+
+    def _ensure_flusher(self):
+        if self._flusher is None and self.fsync_interval > 0:
+            with self._guard:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run, name="row-log-fsync", daemon=True)
+                    self._flusher.start()
+
+    def append(self, path: str, row: dict) -> int:
+        """追加一行，返回该日志当前的行数"""
+        line = json.dumps(row, ensure_ascii=False, default=str) + "\n"
+        with self.lock_for(path):
+            handle = self._handles.get(path)
+            if handle is None:
+                self._counts[path] = len(self.read(path))
+                handle = open(path, 'a', encoding='utf-8')
+                self._handles[path] = handle
+            handle.write(line)
+            handle.flush()
+            self._counts[path] += 1
+            count = self._counts[path]
+        if self.fsync_interval > 0:
+            with self._guard:
+                self._dirty.add(path)
+            self._ensure_flusher()
+        else:
+            self._fsync(path)
+        return count
+
+    def read(self, path: str) -> List[dict]:
+        """读取全部行；进程中断留下的不完整尾行被忽略"""
+        rows = []
+        if not os.path.exists(path):
+            return rows
+        with self.lock_for(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return rows
+
+    def discard(self, path: str) -> None:
+        """日志内容已写入快照后删除日志"""
+        with self.lock_for(path):
+            handle = self._handles.pop(path, None)
+            if handle is not None:
+                handle.close()
+            self._counts.pop(path, None)
+            with self._guard:
+                self._dirty.discard(path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fsync(self, path: str) -> None:
+        with self.lock_for(path):
+            handle = self._handles.get(path)
+            if handle is None:
+                return
+            try:
+                os.fsync(handle.fileno())
+            except OSError as e:
+                log(f"行日志 fsync 失败: {path}, {e}", "red")
+
+    def flush_all(self) -> None:
+        with self._guard:
+            dirty, self._dirty = self._dirty, set()
+        for path in dirty:
+            self._fsync(path)
+
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            self.flush_all()
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush_all()
+        with self._guard:
+            paths = list(self._handles)
+        for path in paths:
+            with self.lock_for(path):
+                handle = self._handles.pop(path, None)
+                if handle is not None:
+                    handle.close()
+
+
+# 全局行日志实例
+row_log = RowLog(fsync_interval_ms=Config.LOCAL_LOG_FSYNC_INTERVAL_MS)
+atexit.register(row_log.close)
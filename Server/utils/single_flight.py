@@ -0,0 +1,101 @@
+"""
+单飞（single-flight）请求合并
+同一 key 的请求正在执行时，后到的调用方不再重复发起，而是等待这一次的结果（或异常）。
+多台设备在同一界面上执行同一任务时，相同的大模型 / 嵌入请求只发送一次。
+同步调用（do）与协程（ado）共享进行中的请求表，二者之间也会合并。
+"""
+
+import asyncio
+import copy
+import threading
+from concurrent.futures import CancelledError, Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self._stats = {'calls': 0, 'coalesced': 0}
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self._stats['calls'] += 1
+            else:
+                self._stats['coalesced'] += 1
+        return future, leader
+
+    def _leave(self, key: Hashable) -> None:
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行 fn 并返回 (结果, 是否由本调用执行)。key 相同的并发调用只执行一次，
+        等待方拿到结果的深拷贝（调用方常会就地修改返回的 dict）。
+        fn 应在返回前完成缓存写入，使执行结束后到达的请求直接命中缓存。
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return copy.deepcopy(future.result()), False
+            except CancelledError:
+                # 执行方（协程）被取消：重新竞争执行
+                continue
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            self._leave(key)
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """do 的协程版本；等待方被取消不影响执行方，执行方被取消时等待方重新竞争执行"""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            # shield：等待方被取消时不连带取消共享的 Future
+            waiter = asyncio.wrap_future(future)
+            try:
+                result = await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    continue
+                raise
+            return copy.deepcopy(result), False
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            self._leave(key)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls))
@@ -1,21 +1,29 @@
 import os, csv, re
+import asyncio
 import numpy as np
 import json
 import pandas as pd
 
 from termcolor import colored
-from openai import OpenAI
 from typing import List
 from ast import literal_eval
 import threading
 import time
 import hashlib
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 
 # 统一到标准 logging：从 log_config 重导出 log
+from env_config import Config
 from log_config import log
+from utils.llm_client import async_model_slot, get_async_client, get_client, model_slot
+from utils.rate_limiter import NORMAL, backoff_delay, estimate_tokens
+from utils.embedder import embedder
+from utils.json_stream import IncrementalJSONObject
+from utils.llm_cache import canonical_screen, llm_cache, make_key
+from utils.single_flight import SingleFlight
 
 
 def safe_literal_eval(x):
@@ -52,6 +60,11 @@ _DIAG = {
     "query_total_calls": 0,
     "query_cache_hits": 0,
     "query_cache_misses": 0,
+    "query_persistent_hits": 0,
+    "query_coalesced": 0,
+    "query_stream_calls": 0,
+    "query_stream_early": 0,
+    "query_stream_early_ms": 0.0,
     "query_total_duration_ms": 0.0,
     "query_total_retries": 0,
     "query_calls_with_retry": 0,
@@ -59,8 +72,16 @@ _DIAG = {
     "embed_total_calls": 0,
     "embed_cache_hits": 0,
     "embed_cache_misses": 0,
+    "embed_coalesced": 0,
 }
 
+# 进行中的大模型 / 嵌入请求（按缓存键合并）
+_QUERY_FLIGHTS = SingleFlight()
+_EMBED_FLIGHTS = SingleFlight()
+
+# 流式请求在后台线程中接收（调用方拿到提前解析出的字段后即返回）
+_STREAM_EXECUTOR = ThreadPoolExecutor(max_workers=Config.LLM_STREAM_WORKERS, thread_name_prefix="llm-stream")
+
 
 def _diag_update(**kwargs):
     with _DIAG_LOCK:
@@ -80,6 +101,7 @@ def get_ai_diagnostics(reset: bool = False) -> dict:
             "query_avg_retries": snapshot["query_total_retries"] / q_total,
             "query_hit_rate": (snapshot["query_cache_hits"] / total_query_cache) if total_query_cache > 0 else 0.0,
             "query_avg_logging_overhead_ms": snapshot["query_logging_overhead_ms"] / q_total,
+            "query_stream_avg_early_ms": snapshot["query_stream_early_ms"] / max(snapshot["query_stream_early"], 1),
             "embed_hit_rate": (snapshot["embed_cache_hits"] / total_embed_cache) if total_embed_cache > 0 else 0.0,
         })
         result = dict(snapshot)
@@ -121,18 +143,62 @@ def get_openai_embedding(text: str, model="text-embedding-v1", **kwargs) -> List
         _diag_update(embed_total_calls=1, embed_cache_hits=1)
         return cached
 
-    client = OpenAI(
-        # api_key="sk-401cd3617a3b4f96a8cd820d76bacfa1",
-        api_key="sk-c2cc873160714661aa76b6d5ab7239bf",
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
-    response = client.embeddings.create(input=[text_norm], model=model, **kwargs)
-    embedding = response.data[0].embedding
-    _embed_cache_set(cache_key, embedding, max_cache)
-    _diag_update(embed_total_calls=1, embed_cache_misses=1)
+    def fetch():
+        # 经微批量嵌入器与其他会话的请求合并发送
+        vector = embedder.embed(text_norm, model, **kwargs)
+        _embed_cache_set(cache_key, vector, max_cache)
+        return vector
+
+    # 相同文本的并发请求只发送一次
+    embedding, leader = _EMBED_FLIGHTS.do(cache_key, fetch)
+    if leader:
+        _diag_update(embed_total_calls=1, embed_cache_misses=1)
+    else:
+        _diag_update(embed_total_calls=1, embed_coalesced=1)
+    return embedding
+
+
+async def aembed(text: str, model="text-embedding-v1", **kwargs) -> List[float]:
+    """get_openai_embedding 的协程版本：等待微批量嵌入器的 Future，不占用调用线程"""
+    max_cache = int(os.getenv("EMBED_CACHE_MAX", "1024"))
+    text_norm = (text or "").replace("\n", " ")
+    cache_key = _make_cache_key("embed", model, text_norm)
+    cached = _embed_cache_get(cache_key)
+    if cached is not None:
+        _diag_update(embed_total_calls=1, embed_cache_hits=1)
+        return cached
+
+    async def fetch():
+        # shield：调用方被取消时，已提交的批次照常完成并写入缓存
+        vector = await asyncio.shield(asyncio.wrap_future(embedder.submit(text_norm, model, **kwargs)))
+        _embed_cache_set(cache_key, vector, max_cache)
+        return vector
+
+    embedding, leader = await _EMBED_FLIGHTS.ado(cache_key, fetch)
+    if leader:
+        _diag_update(embed_total_calls=1, embed_cache_misses=1)
+    else:
+        _diag_update(embed_total_calls=1, embed_coalesced=1)
     return embedding
 
 
+def get_openai_embeddings(texts: List[str], model="text-embedding-v1", **kwargs) -> List[List[float]]:
+    """批量获取嵌入向量（命中缓存的直接返回，其余按批次请求）"""
+    max_cache = int(os.getenv("EMBED_CACHE_MAX", "1024"))
+    texts_norm = [(t or "").replace("\n", " ") for t in texts]
+    keys = [_make_cache_key("embed", model, t) for t in texts_norm]
+    results = [_embed_cache_get(k) for k in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        vectors = embedder.embed_many([texts_norm[i] for i in missing], model, **kwargs)
+        for i, vector in zip(missing, vectors):
+            results[i] = vector
+            _embed_cache_set(keys[i], vector, max_cache)
+    _diag_update(embed_total_calls=len(texts), embed_cache_hits=len(texts) - len(missing),
+                 embed_cache_misses=len(missing))
+    return results
+
+
 def cosine_similarity(a, b):
     # 兼容 list/tuple 输入
     if isinstance(a, (list, tuple)):
@@ -190,33 +256,113 @@ def _query_cache_set(key: str, value, max_entries: int):
             _QUERY_CACHE.popitem(last=False)
 
 
-def query(messages, model="qwen3-32b", is_list=False):
+def _query_settings():
     cache_enabled = os.getenv("AI_CACHE_ENABLED", "true").lower() == "true"
     cache_ttl = int(os.getenv("AI_CACHE_TTL", "900"))
     cache_max = int(os.getenv("AI_CACHE_MAX", "512"))
-    max_retries = int(os.getenv("AI_MAX_RETRIES", "3"))
-    base_delay = float(os.getenv("AI_RETRY_BASE_DELAY", "0.8"))
-    log_enabled = os.getenv("AI_QUERY_LOG", "true").lower() == "true"
+    return cache_enabled, cache_ttl, cache_max
+
 
+def _query_key(messages, model, is_list, cache_key):
+    """返回 (缓存键, agent 名)"""
+    if cache_key is not None:
+        agent = str(cache_key[0]) if isinstance(cache_key, (tuple, list)) and cache_key else None
+        return make_key("chat", model, is_list, cache_key), agent
+    # 消息中的界面 XML 按规范形式参与计算（不同运行的 view id 不同）
+    canonical = [dict(m, content=canonical_screen(m["content"])) if isinstance(m.get("content"), str) else m
+                 for m in messages]
     try:
-        msg_key = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+        msg_key = json.dumps(canonical, sort_keys=True, ensure_ascii=False)
     except Exception:
-        msg_key = json.dumps([m.get("content", "") for m in messages], ensure_ascii=False)
-    cache_key = _make_cache_key("chat", model, str(is_list), msg_key)
+        msg_key = json.dumps([str(m.get("content", "")) for m in canonical], ensure_ascii=False)
+    return make_key("chat", model, is_list, msg_key), None
+
+
+def _persistent_cache_get(key: str, cache_max: int):
+    cached = llm_cache.get(key)
+    if cached is not None:
+        _query_cache_set(key, cached, cache_max)
+        _diag_update(query_persistent_hits=1)
+    return cached
+
+
+def _record_cache_hit(t_start: float):
+    duration_ms = (time.time() - t_start) * 1000.0
+    _diag_update(query_total_calls=1, query_cache_hits=1, query_total_duration_ms=duration_ms)
+
+
+def _record_coalesced(t_start: float):
+    duration_ms = (time.time() - t_start) * 1000.0
+    _diag_update(query_total_calls=1, query_coalesced=1, query_total_duration_ms=duration_ms)
+
+
+def _record_upstream(t_start: float, attempt: int, cache_enabled: bool, log_overhead: float = 0.0):
+    duration_ms = (time.time() - t_start) * 1000.0
+    _diag_update(
+        query_total_calls=1,
+        query_cache_misses=1 if cache_enabled else 0,
+        query_total_duration_ms=duration_ms,
+        query_total_retries=max(0, attempt),
+        query_calls_with_retry=1 if attempt > 0 else 0,
+        query_logging_overhead_ms=log_overhead * 1000.0,
+    )
+
+
+def _chat_request(model, messages) -> dict:
+    return dict(
+        model=model,
+        messages=messages,
+        temperature=0.2,
+        presence_penalty=0.5,
+        seed=1234,
+        extra_body={
+            "enable_thinking": False,
+            "top_k": 10,
+        }
+    )
+
+
+def _parse_content(result: str, is_list: bool):
+    json_formatted_response = __parse_json(result, is_list=is_list)
+    return json.loads(json_formatted_response) if json_formatted_response else result
+
+
+def query(messages, model="qwen3-32b", is_list=False, cache_key=None, priority=NORMAL):
+    """
+    调用大模型并解析 JSON。结果依次查找进程内缓存与持久化缓存（utils.llm_cache）。
+    cache_key 为 agent 给出的语义键（如 ("derive", 子任务, canonical_screen(界面), ...)），
+    未给出时按规范化后的完整消息计算。
+    priority 为限流排队的通道（utils.rate_limiter：INTERACTIVE / NORMAL / BACKGROUND）。
+    """
+    cache_enabled, cache_ttl, cache_max = _query_settings()
+    key, agent = _query_key(messages, model, is_list, cache_key)
 
     t_start = time.time()
     if cache_enabled:
-        cached = _query_cache_get(cache_key, cache_ttl)
+        cached = _query_cache_get(key, cache_ttl)
+        if cached is None:
+            cached = _persistent_cache_get(key, cache_max)
         if cached is not None:
-            duration_ms = (time.time() - t_start) * 1000.0
-            _diag_update(query_total_calls=1, query_cache_hits=1, query_total_duration_ms=duration_ms)
+            _record_cache_hit(t_start)
             return cached
 
-    client = OpenAI(
-        # api_key="sk-401cd3617a3b4f96a8cd820d76bacfa1",
-        api_key="sk-c2cc873160714661aa76b6d5ab7239bf",
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
+    # 相同键的并发请求只向上游发送一次，其余调用方等待并共享解析结果
+    result, leader = _QUERY_FLIGHTS.do(
+        key, lambda: _query_upstream(messages, model, is_list, key, agent, cache_enabled, cache_max, t_start,
+                                     priority))
+    if not leader:
+        _record_coalesced(t_start)
+    return result
+
+
+def _query_upstream(messages, model, is_list, key, agent, cache_enabled, cache_max, t_start, priority=NORMAL):
+    """请求大模型（带重试）并写入缓存；由 query 在单飞保护下调用"""
+    max_retries = int(os.getenv("AI_MAX_RETRIES", "3"))
+    base_delay = float(os.getenv("AI_RETRY_BASE_DELAY", "0.8"))
+    max_delay = float(os.getenv("AI_RETRY_MAX_DELAY", "20"))
+    tokens = estimate_tokens(messages)
+
+    client = get_client()
 
     log_overhead = 0.0
     # if log_enabled:
@@ -232,17 +378,9 @@ def query(messages, model="qwen3-32b", is_list=False):
     last_exception = None
     while attempt <= max_retries:
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.2,
-                presence_penalty=0.5,
-                seed=1234,
-                extra_body={
-                    "enable_thinking": False,
-                    "top_k": 10,
-                }
-            )
+            with model_slot(model, priority, tokens) as slot:
+                response = client.chat.completions.create(**_chat_request(model, messages))
+                slot.record_usage(response)
 
             result = response.choices[0].message.content
             # if log_enabled:
@@ -250,40 +388,190 @@ def query(messages, model="qwen3-32b", is_list=False):
             #     # 注释掉全量结果打印以减少I/O开销
             #     # log(result, 'green')
             #     log_overhead += (time.time() - t_log2)
-            json_formatted_response = __parse_json(result, is_list=is_list)
-            parsed = json.loads(json_formatted_response) if json_formatted_response else result
+            parsed = _parse_content(result, is_list)
 
             if cache_enabled:
-                _query_cache_set(cache_key, parsed, cache_max)
-
-            duration_ms = (time.time() - t_start) * 1000.0
-            _diag_update(
-                query_total_calls=1,
-                query_cache_misses=1 if cache_enabled else 0,
-                query_total_duration_ms=duration_ms,
-                query_total_retries=max(0, attempt),
-                query_calls_with_retry=1 if attempt > 0 else 0,
-                query_logging_overhead_ms=log_overhead * 1000.0,
-            )
+                _query_cache_set(key, parsed, cache_max)
+                llm_cache.set(key, parsed, agent)
+
+            _record_upstream(t_start, attempt, cache_enabled, log_overhead)
             return parsed
         except Exception as e:
             last_exception = e
             if attempt >= max_retries:
                 break
-            delay = base_delay * (2 ** attempt)
-            time.sleep(delay)
+            time.sleep(backoff_delay(attempt, e, base_delay, max_delay))
             attempt += 1
 
     log(f"LLM call failed after retries: {last_exception}", "red")
-    duration_ms = (time.time() - t_start) * 1000.0
-    _diag_update(
-        query_total_calls=1,
-        query_cache_misses=1 if cache_enabled else 0,
-        query_total_duration_ms=duration_ms,
-        query_total_retries=max(0, attempt),
-        query_calls_with_retry=1 if attempt > 0 else 0,
-        query_logging_overhead_ms=log_overhead * 1000.0,
-    )
+    _record_upstream(t_start, attempt, cache_enabled, log_overhead)
+    return "{}" if not is_list else "[]"
+
+
+def query_streaming(messages, model="qwen3-32b", required_keys=("action",), cache_key=None, priority=NORMAL):
+    """
+    流式调用大模型，第一个 JSON 对象中 required_keys 全部解析完成时立即返回 (已完成的字段, Future)。
+    已完成的字段包含此前输出的所有顶层键（如 reasoning、speak）；其余输出在后台继续接收，
+    Future 的结果与 query 的返回值相同（完整解析结果，失败时为 "{}"）并写入缓存。
+    命中缓存、与进行中的相同请求合并或输出中没有这些键时，返回完整结果。
+    """
+    cache_enabled, cache_ttl, cache_max = _query_settings()
+    key, agent = _query_key(messages, model, False, cache_key)
+
+    t_start = time.time()
+    if cache_enabled:
+        cached = _query_cache_get(key, cache_ttl)
+        if cached is None:
+            cached = _persistent_cache_get(key, cache_max)
+        if cached is not None:
+            _record_cache_hit(t_start)
+            done = Future()
+            done.set_result(cached)
+            return cached, done
+
+    early = Future()
+
+    def run():
+        try:
+            result, leader = _QUERY_FLIGHTS.do(
+                key, lambda: _stream_upstream(messages, model, key, agent, cache_enabled, cache_max, t_start,
+                                              required_keys, early, priority))
+            if not leader:
+                _record_coalesced(t_start)
+        except BaseException as e:
+            if not early.done():
+                early.set_exception(e)
+            raise
+        if not early.done():
+            early.set_result(result)
+        return result
+
+    full = _STREAM_EXECUTOR.submit(run)
+    return early.result(), full
+
+
+def _stream_upstream(messages, model, key, agent, cache_enabled, cache_max, t_start, required_keys, early: Future,
+                     priority=NORMAL):
+    """流式请求（带重试）：required_keys 齐全时设置 early，接收完毕后解析完整文本并写入缓存"""
+    max_retries = int(os.getenv("AI_MAX_RETRIES", "3"))
+    base_delay = float(os.getenv("AI_RETRY_BASE_DELAY", "0.8"))
+    max_delay = float(os.getenv("AI_RETRY_MAX_DELAY", "20"))
+    tokens = estimate_tokens(messages)
+
+    client = get_client()
+    _diag_update(query_stream_calls=1)
+
+    attempt = 0
+    last_exception = None
+    while attempt <= max_retries:
+        try:
+            parser = IncrementalJSONObject()
+            chunks = []
+            with model_slot(model, priority, tokens):
+                stream = client.chat.completions.create(**_chat_request(model, messages), stream=True)
+                try:
+                    for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if not delta:
+                            continue
+                        chunks.append(delta)
+                        if not early.done() and parser.feed(delta) and parser.has(required_keys):
+                            early.set_result(dict(parser.fields))
+                            _diag_update(query_stream_early=1,
+                                         query_stream_early_ms=(time.time() - t_start) * 1000.0)
+                finally:
+                    close = getattr(stream, "close", None)
+                    if close is not None:
+                        close()
+
+            parsed = _parse_content("".join(chunks), False)
+            if cache_enabled:
+                _query_cache_set(key, parsed, cache_max)
+                llm_cache.set(key, parsed, agent)
+
+            _record_upstream(t_start, attempt, cache_enabled)
+            return parsed
+        except Exception as e:
+            # 已把部分字段交给调用方后不再重试（重试结果可能与已执行的动作不一致）
+            if early.done():
+                log(f"LLM stream failed after early result: {e}", "red")
+                _record_upstream(t_start, attempt, cache_enabled)
+                raise
+            last_exception = e
+            if attempt >= max_retries:
+                break
+            time.sleep(backoff_delay(attempt, e, base_delay, max_delay))
+            attempt += 1
+
+    log(f"LLM call failed after retries: {last_exception}", "red")
+    _record_upstream(t_start, attempt, cache_enabled)
+    return "{}"
+
+
+async def aquery(messages, model="qwen3-32b", is_list=False, cache_key=None, timeout=None, priority=NORMAL):
+    """
+    query 的协程版本：基于 AsyncOpenAI，重试等待与请求本身都不占用线程，多个会话可在同一事件循环上并发。
+    缓存、单飞合并与解析规则与 query 相同（二者共享缓存与进行中的请求）。
+    timeout 为单次请求的超时秒数（默认 LLM_TIMEOUT），超时按失败重试；任务被取消时立即中止请求。
+    """
+    cache_enabled, cache_ttl, cache_max = _query_settings()
+    key, agent = _query_key(messages, model, is_list, cache_key)
+    timeout = Config.LLM_TIMEOUT if timeout is None else timeout
+
+    t_start = time.time()
+    if cache_enabled:
+        cached = _query_cache_get(key, cache_ttl)
+        if cached is None and llm_cache.enabled:
+            # 持久化缓存是磁盘 / 网络 I/O，放到线程池中执行
+            cached = await asyncio.to_thread(_persistent_cache_get, key, cache_max)
+        if cached is not None:
+            _record_cache_hit(t_start)
+            return cached
+
+    result, leader = await _QUERY_FLIGHTS.ado(
+        key, lambda: _aquery_upstream(messages, model, is_list, key, agent, cache_enabled, cache_max, t_start,
+                                      timeout, priority))
+    if not leader:
+        _record_coalesced(t_start)
+    return result
+
+
+async def _aquery_upstream(messages, model, is_list, key, agent, cache_enabled, cache_max, t_start, timeout,
+                           priority=NORMAL):
+    """_query_upstream 的协程版本；asyncio.CancelledError 不被重试逻辑捕获，直接向上传递"""
+    max_retries = int(os.getenv("AI_MAX_RETRIES", "3"))
+    base_delay = float(os.getenv("AI_RETRY_BASE_DELAY", "0.8"))
+    max_delay = float(os.getenv("AI_RETRY_MAX_DELAY", "20"))
+    tokens = estimate_tokens(messages)
+
+    client = get_async_client()
+
+    attempt = 0
+    last_exception = None
+    while attempt <= max_retries:
+        try:
+            async with async_model_slot(model, priority, tokens) as slot:
+                response = await asyncio.wait_for(client.chat.completions.create(**_chat_request(model, messages)),
+                                                  timeout)
+                slot.record_usage(response)
+            parsed = _parse_content(response.choices[0].message.content, is_list)
+
+            if cache_enabled:
+                _query_cache_set(key, parsed, cache_max)
+                if llm_cache.enabled:
+                    await asyncio.to_thread(llm_cache.set, key, parsed, agent)
+
+            _record_upstream(t_start, attempt, cache_enabled)
+            return parsed
+        except Exception as e:
+            last_exception = e
+            if attempt >= max_retries:
+                break
+            await asyncio.sleep(backoff_delay(attempt, e, base_delay, max_delay))
+            attempt += 1
+
+    log(f"LLM call failed after retries: {last_exception!r}", "red")
+    _record_upstream(t_start, attempt, cache_enabled)
     return "{}" if not is_list else "[]"
 
 
@@ -0,0 +1,238 @@
+"""
+写后（write-behind）持久化队列
+Memory / PageManager 的整表写入只登记到队列，由后台线程落盘（CSV 或 MongoDB），请求路径不再等待磁盘/数据库往返。
+- 写入按登记顺序（FIFO）逐条落盘；只有连续登记的同一 key（CSV 文件路径或集合名）才合并：快照取最新一次，之后的追加行累积在快照之后
+- 进程崩溃时尚未落盘的写入会丢失（不做持久日志），但已落盘的总是登记顺序的一个前缀：单个快照本身是原子替换，只追加行的条目可能只写入部分行
+- 读取方在 lock_for(key) 内通过 view(key) 叠加未落盘的内容，保证读到自己的写入
+- 登记时记录当前 owner（如会话 id），会话结束时 flush_owner() 只等待该会话写入之前的条目；服务器关闭时调用 flush()
+"""
+
+import atexit
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from env_config import Config
+from log_config import log
+
+# writer(snapshot, rows)：snapshot 为整表快照（None 表示只有追加行），rows 为快照之后追加的行
+Writer = Callable[[Optional[pd.DataFrame], List[dict]], None]
+
+# 当前登记写入的归属（会话 id）；跨线程池提交时需用 contextvars.copy_context() 传递
+_owner: contextvars.ContextVar = contextvars.ContextVar('write_behind_owner', default=None)
+
+
+class _Pending:
+    __slots__ = ('key', 'seq', 'writer', 'snapshot', 'rows', 'owners')
+
+    def __init__(self, key: Hashable, seq: int, writer: Writer):
+        self.key = key
+        self.seq = seq
+        self.writer = writer
+        self.snapshot: Optional[pd.DataFrame] = None
+        self.rows: List[dict] = []
+        self.owners: Set[Hashable] = set()
+
+
+class WriteBehindQueue:
+
+    def __init__(self, enabled: bool = True, delay_ms: int = 50):
+        self.enabled = enabled
+        self.delay = max(0, delay_ms) / 1000.0
+        self._cond = threading.Condition()
+        # 登记顺序的条目队列，以及每个 key 尚未落盘的条目（按登记顺序）
+        self._queue: Deque[_Pending] = deque()
+        self._by_key: Dict[Hashable, List[_Pending]] = {}
+        self._seq = 0
+        self._inflight = 0
+        # 弹出队首并落盘在此锁内完成，后台线程与 flush_key 调用方交替落盘时仍保持登记顺序
+        self._write_lock = threading.RLock()
+        self._locks: Dict[Hashable, threading.RLock] = {}
+        self._thread = None
+        self._closed = False
+        self._stats = {'submitted': 0, 'coalesced': 0, 'written': 0, 'failed': 0}
+
+    @staticmethod
+    @contextmanager
+    def owner(tag: Hashable):
+        """在此上下文内登记的写入归属于 tag"""
+        token = _owner.set(tag)
+        try:
+            yield
+        finally:
+            _owner.reset(token)
+
+    def lock_for(self, key: Hashable) -> threading.RLock:
+        """同一 key 的落盘、读取与追加需在此锁内进行"""
+        with self._cond:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                    self._thread.start()
+
+    def _tail_for(self, key: Hashable, writer: Writer) -> _Pending:
+        """队尾是同一 key 时合并进去，否则在队尾新建条目（调用方持有 _cond）"""
+        tail = self._queue[-1] if self._queue else None
+        if tail is not None and tail.key == key:
+            self._stats['coalesced'] += 1
+            return tail
+        self._seq += 1
+        entry = _Pending(key, self._seq, writer)
+        self._queue.append(entry)
+        self._by_key.setdefault(key, []).append(entry)
+        return entry
+
+    def submit(self, key: Hashable, writer: Writer, snapshot: Optional[pd.DataFrame] = None,
+               rows: Optional[List[dict]] = None) -> None:
+        """登记一次写入（snapshot 需为调用方不再修改的副本）；队列关闭或未启用时直接写入"""
+        if not self.enabled or self._closed:
+            with self.lock_for(key):
+                writer(snapshot, list(rows or []))
+            return
+        with self._cond:
+            entry = self._tail_for(key, writer)
+            entry.writer = writer
+            if snapshot is not None:
+                # 新快照已包含调用方看到的全部数据，同一条目内之前登记的内容作废
+                entry.snapshot = snapshot
+                entry.rows = []
+            if rows:
+                entry.rows.extend(rows)
+            owner = _owner.get()
+            if owner is not None:
+                entry.owners.add(owner)
+            self._stats['submitted'] += 1
+            self._cond.notify_all()
+        self._ensure_worker()
+
+    def append_pending(self, key: Hashable, row: dict) -> bool:
+        """key 有未落盘的写入时把一行追加到其后并返回 True；否则返回 False，由调用方直接写入"""
+        with self._cond:
+            entries = self._by_key.get(key)
+            if not entries:
+                return False
+            entry = self._tail_for(key, entries[-1].writer)
+            entry.rows.append(row)
+            owner = _owner.get()
+            if owner is not None:
+                entry.owners.add(owner)
+            self._cond.notify_all()
+            return True
+
+    def view(self, key: Hashable) -> Tuple[Optional[pd.DataFrame], List[dict]]:
+        """未落盘的 (快照, 追加行)；快照为 None 时需从存储读取后再叠加追加行"""
+        with self._cond:
+            snapshot, rows = None, []
+            for entry in self._by_key.get(key, ()):
+                if entry.snapshot is not None:
+                    snapshot, rows = entry.snapshot, []
+                rows.extend(entry.rows)
+            return snapshot, rows
+
+    def has_pending(self, key: Hashable) -> bool:
+        with self._cond:
+            return key in self._by_key
+
+    def _drain(self, through: Optional[int] = None) -> None:
+        """按登记顺序落盘队首条目，直到队列为空或队首序号超过 through"""
+        while True:
+            with self._write_lock:
+                with self._cond:
+                    if not self._queue or (through is not None and self._queue[0].seq > through):
+                        self._cond.notify_all()
+                        return
+                    key = self._queue[0].key
+                    self._inflight += 1
+                try:
+                    with self.lock_for(key):
+                        with self._cond:
+                            # 队首只在 _write_lock 内弹出，此处仍是同一条目
+                            entry = self._queue.popleft()
+                            entries = self._by_key[key]
+                            entries.pop(0)
+                            if not entries:
+                                del self._by_key[key]
+                        self._write(key, entry)
+                finally:
+                    with self._cond:
+                        self._inflight -= 1
+                        self._cond.notify_all()
+
+    def flush_key(self, key: Hashable) -> None:
+        """在调用线程中落盘到指定 key 的最后一个条目为止（非延迟写入前调用，保证顺序）"""
+        with self._cond:
+            entries = self._by_key.get(key)
+            if not entries:
+                return
+            through = entries[-1].seq
+        self._drain(through)
+
+    def flush_owner(self, owner: Hashable) -> None:
+        """在调用线程中落盘到 owner 登记的最后一个条目为止；其他会话之后的写入不等待"""
+        with self._cond:
+            seqs = [entry.seq for entry in self._queue if owner in entry.owners]
+        if seqs:
+            self._drain(max(seqs))
+
+    def _write(self, key: Hashable, entry: _Pending) -> None:
+        try:
+            entry.writer(entry.snapshot, entry.rows)
+            with self._cond:
+                self._stats['written'] += 1
+        except Exception as e:
+            with self._cond:
+                self._stats['failed'] += 1
+            log(f"写后持久化失败: {key}, {e}", "red")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue and self._closed:
+                    return
+            # 短暂等待，让同一 key 的连续写入合并
+            if self.delay:
+                time.sleep(self.delay)
+            self._drain()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待已登记的写入全部落盘；超时返回 False"""
+        if self._thread is None:
+            # 没有后台线程（未启用或尚无写入）时在当前线程落盘
+            self._drain()
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue or self._inflight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.5)
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return dict(self._stats, pending=len(self._queue), inflight=self._inflight)
+
+
+# 全局写后队列
+write_behind = WriteBehindQueue(enabled=Config.WRITE_BEHIND_ENABLED, delay_ms=Config.WRITE_BEHIND_DELAY_MS)
+atexit.register(write_behind.close)